@@ -1,35 +1,225 @@
 import streamlit as st
-import pandas as pd
-import socket
-import struct
-import io
-import time
+import os
+import queue
 from datetime import datetime
+import capture
+import engine
+import metrics
+import rack
+from board_client import BULK_CHUNK_SIZE, get_pool
+from protocol import MAX_24BIT, OP_READ, OP_WRITE
+from stage_client import MotionEstimator
+from log_store import LogStore, LEVELS, format_entry, get_file_logger
+from payload_store import PayloadStore
+
+# pandas / numpy (scan_data, sequences) は読み込みに時間がかかるため、使う機能が操作されたときに import する。
+# 受信データは bytes のままセッションに持たず、payload_store の一時ファイルに置いてIDだけを持つ。
+# 実行中シーケンスの表示は fragment として一定間隔でその部分だけを再実行し、ページ全体は再実行しない。
+
+# 実行中シーケンスの表示を更新する間隔 (秒)
+LIVE_REFRESH_INTERVAL = 0.5
+# ログ表示の1ページあたりの件数 (表示するのはこの件数だけ)
+LOG_PAGE_SIZE = 50
+# ラック一斉実行の基板リストの初期値 (模擬基板をポートを分けて2台起動した場合の例)
+DEFAULT_RACK_BOARDS = "board1, 127.0.0.1, 60202, 60201\nboard2, 127.0.0.1, 60212, 60211\n"
+RACK_OPERATIONS = ["読み出しコマンド (0x3C)", "書き込みコマンド (0x3B)", "初期化シーケンス", "ラインスキャン"]
+
+def get_log_store():
+    """このセッションのログ保管 (別のセッションのログで古いものが押し出されないよう、セッションごとに持つ)
+
+    ログファイルへの出力は全セッション共通。
+    """
+    if 'log_store' not in st.session_state:
+        st.session_state['log_store'] = LogStore(file_logger=get_file_logger())
+    return st.session_state['log_store']
+
+@st.cache_resource
+def get_sequence_log_stores():
+    """実行中のシーケンスのログ保管 {"init": ..., "ls": ...} (シーケンスを開始したセッションのもの)"""
+    return {"init": None, "ls": None}
+
+def tab_log_store(tab):
+    """タブのログ保管。シーケンスのタブはシーケンスと同じく全セッション共通で、開始したセッションのものを使う"""
+    store = get_sequence_log_stores().get(tab)
+    return store if store is not None else get_log_store()
+
+@st.cache_resource
+def get_sequences():
+    """実行中のシーケンス {"init": ..., "ls": ...}
+
+    シーケンスはリスナー (ポート60201) とステージ接続を保持するため、再実行やブラウザの再読み込みで
+    作り直さないようプロセス内で1つだけ保持する。
+    """
+    return {"init": None, "ls": None}
+
+@st.cache_resource
+def get_payload_store():
+    """受信データ (手動コマンドの読み出し・スキャンデータ) の一時ファイル置き場 (全セッション共通)"""
+    return PayloadStore()
+
+def add_log(tab, level, message):
+    get_log_store().add(tab, level, message)
+
+def log_filters(tab):
+    """ログの絞り込み条件 (レベル, 文字列, ページ) の入力欄を表示し、条件を返す"""
+    c1, c2, c3 = st.columns([2, 2, 1])
+    with c1: levels = st.multiselect("レベル", LEVELS, LEVELS, key=f"{tab}_log_levels")
+    with c2: text = st.text_input("絞り込み (文字列)", "", key=f"{tab}_log_text")
+    with c3: page = st.number_input("ページ", 1, 100000, 1, key=f"{tab}_log_page")
+    return {"levels": levels, "text": text, "page": page - 1}
+
+def show_logs(tab, filters, styled=False):
+    """条件に合うログの1ページ分だけを新しい順に表示する (styled=True はレベルごとに色分けする)"""
+    entries, total = tab_log_store(tab).page(tab, page_size=LOG_PAGE_SIZE, **filters)
+    pages = max(1, -(-total // LOG_PAGE_SIZE))
+    st.caption(f"{total} 件 (ページ {filters['page'] + 1}/{pages})")
+    if styled:
+        for entry in entries:
+            if entry.level == "success": st.success(format_entry(entry))
+            elif entry.level == "warning": st.warning(format_entry(entry))
+            elif entry.level == "error": st.error(format_entry(entry))
+            else: st.info(format_entry(entry))
+    else:
+        st.text("\n".join(format_entry(entry) for entry in entries))
+
+def log_panel(tab, styled=False):
+    """絞り込み条件とログ (高さ固定の枠内) を表示する"""
+    filters = log_filters(tab)
+    with st.container(height=400, border=True):
+        show_logs(tab, filters, styled)
+
+def drain_events(sequence, tab):
+    """シーケンスのイベントキューに溜まったログをログ保管へ移す (フェーズと受信データはシーケンスから直接読む)"""
+    while True:
+        try:
+            kind, value = sequence.events.get_nowait()
+        except queue.Empty:
+            return
+        if kind == "log":
+            timestamp, level, message = value
+            tab_log_store(tab).add(tab, level, message, timestamp)
+
+def live_view(tab, render_status):
+    """シーケンスの状態とログを fragment で表示する。実行中は LIVE_REFRESH_INTERVAL ごとにこの部分だけを再実行する"""
+    sequence = get_sequences()[tab]
+    running = sequence is not None and sequence.running
+
+    def view():
+        if sequence: drain_events(sequence, tab)
+        render_status(sequence)
+        log_panel(tab)
+        if running and not sequence.running:
+            # 終了後の最終状態 (ダウンロードボタン等) はページ全体で描画し直し、定期更新も止める
+            st.rerun()
+
+    st.fragment(view, run_every=LIVE_REFRESH_INTERVAL if running else None, key=f"{tab}_live")()
+
+@st.fragment
+def scan_data_view(payload_id):
+    """スキャンデータの統計量とグラフ (グラフには区間ごとの最小/最大値だけを送る)"""
+    st.subheader("スキャンデータ")
+    payload = get_payload_store().get(payload_id)
+    if payload is None:
+        st.warning("スキャンデータは保持容量の上限を超えたため破棄されました。")
+        return
+    # 一時ファイルを mmap したまま解析し、データ全体をメモリへコピーしない
+    with payload.view() as scan_bytes:
+        scan_data_chart(scan_bytes)
+
+def scan_data_chart(scan_bytes):
+    import pandas as pd
+    from scan_data import DTYPES, BYTEORDERS, decode, unused_bytes, summarize, decimate_minmax
+    c1, c2, c3, c4 = st.columns(4)
+    with c1: scan_dtype = st.selectbox("データ型", list(DTYPES), index=list(DTYPES).index("uint16"), key="ls_dtype")
+    with c2: scan_byteorder = st.radio("バイトオーダー", list(BYTEORDERS), key="ls_byteorder")
+    with c3: scan_channels = st.number_input("チャンネル数", 1, 64, 1, key="ls_channels")
+    with c4: scan_layout = st.radio("チャンネルの並び", ["サンプルごと (c0 c1 c0 c1 ...)", "チャンネルごと (c0 c0 ... c1 c1 ...)"], key="ls_layout")
+    scan_values = decode(scan_bytes, scan_dtype, BYTEORDERS[scan_byteorder], scan_channels, scan_layout.startswith("サンプル"))
+    skipped = unused_bytes(scan_bytes, scan_dtype, scan_channels)
+    if skipped: st.warning(f"末尾の {skipped} バイトは1サンプルに満たないため無視しました。")
+    st.caption(f"{scan_values.shape[1]:,} サンプル × {scan_values.shape[0]} チャンネル")
+    st.dataframe(pd.DataFrame(summarize(scan_values)), hide_index=True)
+    x, lo, hi = decimate_minmax(scan_values)
+    if lo is hi:
+        chart = pd.DataFrame({f"ch{c}": lo[c] for c in range(len(lo))}, index=x)
+    else:
+        chart = pd.DataFrame({f"ch{c} {kind}": values[c] for c in range(len(lo)) for kind, values in (("min", lo), ("max", hi))}, index=x)
+    st.line_chart(chart)
+
+def capture_panel():
+    """基板・ステージとの送受信の記録 (capture.py) を開始/停止する"""
+    st.subheader("通信の記録")
+    recorder = capture.active()
+    if recorder:
+        st.caption(f"記録中: {recorder.path} ({recorder.records:,} レコード, {recorder.bytes:,} bytes)")
+        if st.button("記録を停止", key="capture_stop"):
+            capture.stop()
+            st.rerun()
+        return
+    path = st.text_input("記録ファイル", f"logs/capture_{datetime.now():%Y%m%d_%H%M%S}.jgcap", key="capture_path")
+    st.caption("記録したファイルは `python replay.py` で表示・再生できます。")
+    if st.button("記録を開始", key="capture_start"):
+        # プール済みの接続は記録されないため、閉じて以降の通信を新しい接続で行う
+        get_pool().close_all()
+        capture.start(path)
+        st.rerun()
+
+def metrics_panel():
+    """各段階の処理時間の計測結果 (metrics.py) を表示し、CSV / Prometheus テキスト形式で出力する"""
+    st.subheader("計測")
+    # 表の表示には pandas が必要になるため、表示を選んだときだけ描画する
+    if not st.toggle("処理時間の計測結果を表示", key="metrics_show"):
+        return
+    rows = metrics.registry.rows()
+    if not rows:
+        st.caption("まだ計測結果がありません。")
+        return
+    st.dataframe(rows, hide_index=True)
+    with st.expander("項目の説明"):
+        st.markdown("\n".join(f"* `{name}`: {text}" for name, text in metrics.DESCRIPTIONS.items()))
+    c1, c2, c3 = st.columns(3)
+    with c1: st.download_button("CSV", metrics.registry.to_csv(), "metrics.csv", "text/csv", key="metrics_csv")
+    with c2: st.download_button("Prometheus", metrics.registry.to_prometheus(), "metrics.prom", "text/plain", key="metrics_prom")
+    with c3:
+        if st.button("リセット", key="metrics_reset"):
+            metrics.reset()
+            st.rerun()
 
-# --- 共通の関数定義 ---
-def create_command_packet(op_code, command_id, offset, data_size):
-    try:
-        offset_b2 = (offset >> 16) & 0xFF; offset_b1 = (offset >> 8) & 0xFF; offset_b0 = offset & 0xFF
-        size_b2 = (data_size >> 16) & 0xFF; size_b1 = (data_size >> 8) & 0xFF; size_b0 = data_size & 0xFF
-        packet_values = (op_code, 0x00, command_id, offset_b2, offset_b1, offset_b0, size_b2, size_b1, size_b0, 0x00, 0x00, 0x00)
-        return struct.pack('!BBBBBBBBBBBB', *packet_values)
-    except: return None
+def payload_panel():
+    """受信データの一時ファイル (payload_store.py) の使用量と保持容量の上限"""
+    st.subheader("受信データ")
+    store = get_payload_store()
+    budget_mib = st.number_input("保持容量の上限 (MiB)", 1, 65536, store.budget // (1024 * 1024), key="payload_budget")
+    if budget_mib * 1024 * 1024 != store.budget:
+        store.set_budget(budget_mib * 1024 * 1024)
+    payloads = store.items()
+    st.caption(f"{len(payloads)} 件, {store.total / 1024 / 1024:,.1f} MiB 保持中 (上限超過で破棄 {store.evicted} 件)。"
+               "古いものから一時ファイルごと破棄します。")
+    if payloads and st.button("すべて破棄", key="payload_clear"):
+        store.clear()
+        st.rerun()
+
+def payload_download(payload_id, label, file_name, key=None):
+    """一時ファイルの受信データのダウンロードボタン (ファイルはボタンが押されたときだけ読み込む)"""
+    payload = get_payload_store().get(payload_id, touch=False)
+    if payload is None:
+        st.caption("受信データは保持容量の上限を超えたため破棄されました。")
+        return
+    st.download_button(f"{label} ({payload.size:,} bytes)", payload.read, file_name, 'application/octet-stream', key=key)
 
 def main():
 
     # --- Session Stateの初期化 ---
-    if 'log_messages' not in st.session_state: st.session_state['log_messages'] = []
-    if 'received_data' not in st.session_state: st.session_state['received_data'] = None
-    if 'init_phase' not in st.session_state: st.session_state['init_phase'] = "未開始"
-    if 'init_logs' not in st.session_state: st.session_state['init_logs'] = []
-    if 'init_server_socket' not in st.session_state: st.session_state['init_server_socket'] = None
-    if 'ls_phase' not in st.session_state: st.session_state['ls_phase'] = "未開始"
-    if 'ls_logs' not in st.session_state: st.session_state['ls_logs'] = []
-    if 'ls_server_socket' not in st.session_state: st.session_state['ls_server_socket'] = None
-    if 'ls_scan_data' not in st.session_state: st.session_state['ls_scan_data'] = None
-    if 'aries_logs' not in st.session_state: st.session_state['aries_logs'] = []
+    if 'received_payload' not in st.session_state: st.session_state['received_payload'] = None
+    if 'aries_estimator' not in st.session_state: st.session_state['aries_estimator'] = MotionEstimator()
+    if 'rack_results' not in st.session_state: st.session_state['rack_results'] = None
+    sequences = get_sequences()
+    with st.sidebar:
+        capture_panel()
+        metrics_panel()
+        payload_panel()
 
-    tab1, tab2, tab3, tab4 = st.tabs(["手動コマンド", "初期化シーケンス", "ラインスキャン", "ARIESステージ制御"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["手動コマンド", "初期化シーケンス", "ラインスキャン", "ARIESステージ制御", "ラック一斉実行"])
 
 
     # ==============================================================================
@@ -40,15 +230,7 @@ def main():
         st.info("ℹ️ この機能のテストには、ターミナルで `mock_server.py` を起動してください。")
         
         def log_message(level, message):
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            st.session_state.log_messages.insert(0, (level, f"[{timestamp}] {message}"))
-
-        def display_logs(container):
-            for level, message in st.session_state.log_messages:
-                if level == "info": container.info(message)
-                elif level == "success": container.success(message)
-                elif level == "warning": container.warning(message)
-                elif level == "error": container.error(message)
+            add_log("manual", level, message)
 
         col1, col2 = st.columns([1, 1])
         with col1:
@@ -60,51 +242,118 @@ def main():
             op_code = 0x3B if "書き込み" in op_code_option else 0x3C
             is_write_command = (op_code == 0x3B)
             command_id = st.number_input("コマンドID", 0, 255, 1, key="manual_cmd_id")
-            max_24bit = (2**24) - 1
-            offset = st.number_input("オフセット", 0, max_24bit, 0, key="manual_offset")
+            offset = st.number_input("オフセット", 0, MAX_24BIT, 0, key="manual_offset")
             st.subheader("3. データ設定")
             if is_write_command:
-                uploaded_file = st.file_uploader("送信するCSVファイルを選択", type=['csv'])
+                write_mode = st.radio("送信方式", ["ストリーミング (ファイルをそのまま送信)", "CSV整形 (pandas経由)"], key="write_mode")
+                is_streaming = "ストリーミング" in write_mode
+                uploaded_file = st.file_uploader("送信するファイルを選択 (CSV/バイナリ)", type=['csv', 'bin', 'dat'])
+                local_path = st.text_input("またはローカルファイルのパス (指定時はこちらを優先し、sendfileで送信)", "", key="manual_local_path", disabled=not is_streaming)
                 data_size_label = "書き込みデータサイズ (bytes)"
+                segmented = st.checkbox("分割書き込み (セグメントごとにステータスを確認し、失敗時は途中から再開)", key="manual_chunked", disabled=not is_streaming) and is_streaming
+                if segmented:
+                    # 前回の中断位置を再開位置の入力欄へ反映する (入力欄の描画前にしか変更できないため)
+                    if 'manual_resume_pending' in st.session_state:
+                        st.session_state['manual_resume'] = st.session_state.pop('manual_resume_pending')
+                    c1, c2, c3, c4 = st.columns(4)
+                    with c1: segment_kib = st.number_input("セグメント (KiB)", 1, MAX_24BIT // 1024, engine.DEFAULT_SEGMENT_SIZE // 1024, key="manual_segment_kib")
+                    with c2: segment_retries = st.number_input("再試行回数", 0, 10, engine.DEFAULT_SEGMENT_RETRIES, key="manual_segment_retries")
+                    with c3: offset_unit = st.number_input("オフセット単位 (bytes)", 1, 4096, 1, key="manual_offset_unit")
+                    with c4: resume_from = st.number_input("再開位置 (bytes)", 0, 1 << 30, key="manual_resume")
+                    c1, c2 = st.columns(2)
+                    with c1: verify = st.checkbox("書き込み後に読み返して CRC32 を照合", key="manual_verify")
+                    with c2: read_id = st.number_input("読み返しのコマンドID", 0, 255, 1, key="manual_read_id", disabled=not verify)
             else:
                 output_filename = st.text_input("ダウンロードファイル名", "received_data.bin")
+                chunk_kib = st.number_input("受信チャンクサイズ (KiB)", 4, 16384, BULK_CHUNK_SIZE // 1024, key="manual_chunk")
                 data_size_label = "読み出しデータサイズ (bytes)"
-            data_size = st.number_input(data_size_label, 0, max_24bit, 1024, key="manual_size")
-            send_button = st.button("コマンドを送信", type="primary", key="manual_send")
+                segmented = st.checkbox("分割読み出し (オフセット指定のセグメントを複数の接続で並列に読み出す)", key="manual_segmented")
+                if segmented:
+                    c1, c2, c3, c4 = st.columns(4)
+                    with c1: segment_kib = st.number_input("セグメント (KiB)", 1, MAX_24BIT // 1024, engine.DEFAULT_SEGMENT_SIZE // 1024, key="manual_segment_kib")
+                    with c2: concurrency = st.number_input("同時接続数", 1, 64, engine.DEFAULT_CONCURRENCY, key="manual_concurrency")
+                    with c3: segment_retries = st.number_input("再試行回数", 0, 10, engine.DEFAULT_SEGMENT_RETRIES, key="manual_segment_retries")
+                    with c4: offset_unit = st.number_input("オフセット単位 (bytes)", 1, 4096, 1, key="manual_offset_unit")
+            if segmented and is_write_command:
+                data_size = st.number_input("書き込みデータサイズ (合計 bytes, 0 でファイル全体)", 0, 1 << 30, 0, key="manual_write_total_size")
+            elif segmented:
+                # オフセット欄で表せる範囲であれば、1コマンドの上限 (16MiB) を超えて読み出せる
+                # (既定はバイト単位のオフセットで指定できる 16MiB。それ以上はオフセット単位を合わせる)
+                data_size = st.number_input("読み出しデータサイズ (合計 bytes)", 0, 1 << 30, 16 * 1024 * 1024, key="manual_total_size")
+            else:
+                data_size = st.number_input(data_size_label, 0, MAX_24BIT, 1024, key="manual_size")
+            segment_error = None
+            if segmented and data_size:
+                # セグメントのオフセットが24bitに収まるかを送信前に確認する
+                try:
+                    engine.plan_segments(data_size, segment_kib * 1024, offset, offset_unit)
+                except ValueError as e:
+                    segment_error = str(e)
+                    st.error(segment_error)
+            repeat_count = st.number_input("連続送信回数 (同一接続で送信)", 1, 1000, 1, key="manual_repeat", disabled=segmented)
+            send_button = st.button("コマンドを送信", type="primary", key="manual_send", disabled=segment_error is not None)
         
         with col2:
             st.subheader("ログ")
-            log_area = st.container(height=400, border=True)
-            display_logs(log_area)
-            if st.session_state['received_data']:
-                st.download_button("受信データをダウンロード", st.session_state['received_data'], output_filename, 'application/octet-stream')
+            # 絞り込み条件の変更ではログ欄だけを再実行する
+            st.fragment(log_panel, key="manual_logs")("manual", styled=True)
+            if st.session_state['received_payload'] and not is_write_command:
+                payload_download(st.session_state['received_payload'], "受信データをダウンロード", output_filename)
 
         if send_button:
-            st.session_state.log_messages = []
-            st.session_state.received_data = None
+            get_log_store().clear("manual")
+            st.session_state.received_payload = None
             log_message("info", f"処理を開始します... ターゲット: {ip_address}:{port}")
-            command_packet = create_command_packet(op_code, command_id, offset, data_size)
-            if command_packet:
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(5)
-                        s.connect((ip_address, port))
-                        s.sendall(command_packet)
-                        if is_write_command:
-                            df = pd.read_csv(uploaded_file)
-                            data_to_send = df.to_csv(index=False).encode('utf-8')[:data_size]
-                            s.sendall(data_to_send)
+            try:
+                if is_write_command and not is_streaming:
+                    if uploaded_file is None:
+                        raise ValueError("送信するファイルが選択されていません。")
+                    import pandas as pd
+                    source = pd.read_csv(uploaded_file).to_csv(index=False).encode('utf-8')
+                else:
+                    # ファイルの内容をpandasを介さずそのまま data_size バイト送信する
+                    source = (local_path or uploaded_file) if is_write_command else None
+                on_progress = None
+                if is_write_command or segmented:
+                    progress_bar = st.progress(0.0, text="送信待機中" if is_write_command else "受信待機中")
+                    verb = "送信中" if is_write_command else "受信中"
+                    on_progress = lambda done, total: progress_bar.progress(done / total if total else 1.0, text=f"{verb} {done:,} / {total:,} bytes")
+                if segmented and is_write_command:
+                    if not source:
+                        raise ValueError("送信するファイルが選択されていません。")
+                    total = data_size or (os.path.getsize(source) if local_path else source.size)
+                    try:
+                        result = engine.chunked_write((ip_address, port), command_id, source, total, offset, segment_kib * 1024,
+                                                      segment_retries, offset_unit, resume_from, verify, read_id if verify else None,
+                                                      log=log_message, progress=on_progress)
+                    except engine.WriteInterrupted as e:
+                        st.session_state['manual_resume_pending'] = e.written
+                        raise
+                    if result.written == total and result.verified is not False:
+                        st.session_state['manual_resume_pending'] = 0
+                        log_message("success", f"{total} バイトの書き込みが完了しました。(CRC32 {result.crc:08x}, {result.elapsed:.2f}秒)")
+                elif is_write_command:
+                    engine.manual_command((ip_address, port), op_code, command_id, offset, data_size, repeat_count,
+                                          source=source, chunk_size=BULK_CHUNK_SIZE, log=log_message, progress=on_progress)
+                else:
+                    # 一時ファイルへ直接受信し、セッションにはIDだけを持つ
+                    with get_payload_store().writing(data_size, output_filename) as (payload, out):
+                        if segmented:
+                            statuses = engine.segmented_read((ip_address, port), command_id, data_size, offset, segment_kib * 1024,
+                                                             concurrency, segment_retries, offset_unit, log=log_message,
+                                                             progress=on_progress, out=out).statuses
                         else:
-                            received_data = b''
-                            while len(received_data) < data_size:
-                                chunk = s.recv(min(data_size - len(received_data), 4096))
-                                if not chunk: break
-                                received_data += chunk
-                            st.session_state.received_data = received_data
-                        status = s.recv(4)
-                        log_message("success", f"コマンド成功。ステータス: {status.hex()}")
-                except Exception as e:
-                    log_message("error", f"エラー: {e}")
+                            engine.manual_command((ip_address, port), op_code, command_id, offset, data_size, repeat_count,
+                                                  chunk_size=chunk_kib * 1024, log=log_message, out=out)
+                    st.session_state.received_payload = payload.id
+                    if segmented:
+                        failed = [status for status in statuses if status != 0]
+                        if failed:
+                            log_message("error", f"エラーステータスを受信したセグメントがあります ({len(failed)}/{len(statuses)}): {failed[0]:#010x}")
+                        else:
+                            log_message("success", f"全 {len(statuses)} セグメントの読み出しに成功しました。")
+            except Exception as e:
+                log_message("error", f"エラー: {e}")
             st.rerun()
 
     # ==============================================================================
@@ -113,72 +362,37 @@ def main():
     with tab2:
         st.header("初期化シーケンスモニター")
         st.info("ℹ️ この機能のテストには、ターミナルで `mock_board_init.py` を起動してください。")
-        # (コードは前回から変更なし)
-        PHASE_MAP = { 0x00000000: "INITIALIZE", 0x00000008: "STANDBY", 0x0000002E: "RECONSTRUCT", 0x00000010: "IDLE" }
-        def init_log(message):
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            st.session_state.init_logs.insert(0, f"[{timestamp}] {message}")
+        init_sequence = sequences["init"]
         col1, col2 = st.columns(2)
         with col1:
-            if st.button("待機開始", type="primary", disabled=(st.session_state.init_server_socket is not None), key="start_init"):
+            if st.button("待機開始", type="primary", disabled=(init_sequence is not None and init_sequence.running), key="start_init"):
                 try:
-                    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                    server_socket.bind(('127.0.0.1', 60201)); server_socket.listen(5)
-                    st.session_state.init_server_socket = server_socket
-                    st.session_state.init_phase = "待機中"; st.session_state.init_logs = []
-                    init_log("サーバー起動。基板からの接続を待機中...")
+                    from sequences import InitSequence
+                    sequence = InitSequence()
+                    store = get_log_store()
+                    store.clear("init")
+                    sequence.start()
+                    sequences["init"] = sequence
+                    get_sequence_log_stores()["init"] = store
                     st.rerun()
                 except Exception as e: st.error(f"サーバーの起動に失敗: {e}")
         with col2:
-            if st.button("リセット", disabled=(st.session_state.init_server_socket is None), key="reset_init"):
-                if st.session_state.init_server_socket: st.session_state.init_server_socket.close()
-                st.session_state.init_server_socket = None
-                st.session_state.init_phase = "未開始"; st.session_state.init_logs = []
+            if st.button("リセット", disabled=(init_sequence is None), key="reset_init"):
+                if init_sequence: init_sequence.stop()
+                sequences["init"] = None
+                tab_log_store("init").clear("init")
+                get_sequence_log_stores()["init"] = None
                 st.rerun()
         st.divider()
-        status_placeholder = st.empty()
-        log_placeholder = st.container(height=400, border=True)
-        with status_placeholder.container():
+
+        def render_init(sequence):
             st.subheader("現在の制御基板フェーズ")
-            phase = st.session_state.init_phase
+            phase = sequence.phase if sequence else "未開始"
             if phase == "未開始": st.info("「待機開始」ボタンを押してください。")
             elif phase == "完了": st.success("✅ 初期化シーケンスが正常に完了しました。")
             elif phase == "エラー": st.error("❌ エラーが発生しました。ログを確認してください。")
             else: st.warning(f"⏳ {phase}")
-        for log in st.session_state.init_logs: log_placeholder.text(log)
-        if st.session_state.init_server_socket:
-            server_socket = st.session_state.init_server_socket
-            server_socket.setblocking(0)
-            try:
-                conn, addr = server_socket.accept()
-                with conn:
-                    init_log(f"基板から接続: {addr}")
-                    cmd_packet = conn.recv(12); data_packet = conn.recv(4); status_packet = conn.recv(4)
-                    if data_packet:
-                        data_value = struct.unpack('!I', data_packet)[0]
-                        new_phase = PHASE_MAP.get(data_value)
-                        if new_phase:
-                            st.session_state.init_phase = new_phase
-                            init_log(f"状態遷移報告を受信 -> {new_phase}")
-                            if new_phase == "STANDBY":
-                                init_log("STANDBY検出。RECONSTRUCT指令を基板に送信します...")
-                                time.sleep(1)
-                                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_s:
-                                    client_s.connect(('127.0.0.1', 60202))
-                                    cmd = create_command_packet(0x3B, 1, 0, 4); data = struct.pack('!I', 0x2E)
-                                    client_s.sendall(cmd); client_s.sendall(data); client_s.recv(4)
-                                    init_log("状態遷移指令を送信完了。")
-                            elif new_phase == "IDLE":
-                                st.session_state.init_phase = "完了"; init_log("初期化シーケンス完了！")
-                                st.session_state.init_server_socket.close(); st.session_state.init_server_socket = None
-                st.rerun()
-            except BlockingIOError: time.sleep(1); st.rerun()
-            except Exception as e:
-                init_log(f"エラー: {e}"); st.session_state.init_phase = "エラー"
-                if st.session_state.init_server_socket: st.session_state.init_server_socket.close()
-                st.session_state.init_server_socket = None
-                st.rerun()
+        live_view("init", render_init)
 
     # ==============================================================================
     # --- タブ3: ラインスキャン ---
@@ -187,44 +401,7 @@ def main():
         st.header("ラインスキャンシーケンス")
         st.caption("ラインスキャンのシーケンスを実行・モニタリングします。")
         st.info("ℹ️ この機能のテストには、ターミナルで `mock_board_linescan.py` を起動してください。")
-
-        # ▼▼▼【変更点】ステージコントローラへのコマンド送信関数を追加 ▼▼▼
-        def ls_log(message):
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            st.session_state.ls_logs.insert(0, f"[{timestamp}] {message}")
-
-        def send_stage_command(ip, port, command):
-            """ステージコントローラにコマンドを送信し、応答を確認する"""
-            try:
-                ls_log(f"ステージ ({ip}:{port}) へ接続します...")
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as stage_socket:
-                    stage_socket.settimeout(10) # タイムアウトを10秒に設定
-                    stage_socket.connect((ip, port))
-                    
-                    # コマンドはASCII文字列で、終端にキャリッジリターン(\r)を付与
-                    full_command = (command + '\r').encode('ascii')
-                    stage_socket.sendall(full_command)
-                    ls_log(f"コマンド送信: {command}")
-                    
-                    # 応答を受信
-                    response = stage_socket.recv(1024).decode('ascii').strip()
-                    ls_log(f"応答受信: {response}")
-                    
-                    if "OK" in response:
-                        return True
-                    else:
-                        ls_log(f"エラー: ステージから予期せぬ応答がありました。 ({response})")
-                        return False
-            except socket.timeout:
-                ls_log(f"エラー: ステージへの接続がタイムアウトしました。")
-                return False
-            except ConnectionRefusedError:
-                ls_log(f"エラー: ステージへの接続が拒否されました。IP/ポートを確認してください。")
-                return False
-            except Exception as e:
-                ls_log(f"エラー: ステージとの通信中に予期せぬエラーが発生しました。 {e}")
-                return False
-        # ▲▲▲【変更点】▲▲▲
+        ls_sequence = sequences["ls"]
 
         # --- UIレイアウト ---
         st.subheader("設定")
@@ -239,104 +416,64 @@ def main():
             stage_port = st.number_input("ポート番号", 1, 65535, 8000, key="stage_port")
             axis_num = st.number_input("軸番号", 1, 2, 1, key="stage_axis")
             pulse_count = st.number_input("測定移動パルス数", 0, 1000000, 50000, key="stage_pulse")
+            scan_data_size = st.number_input("スキャンデータサイズ (bytes, ID:0x54 読み出し)", 0, MAX_24BIT, 43400, key="ls_data_size")
             # ▲▲▲【変更点】▲▲▲
+        scan_mode = st.radio("スキャンモード", ["ラインスキャン", "ラスタースキャン"], horizontal=True, key="ls_mode")
+        is_raster = scan_mode == "ラスタースキャン"
+        if is_raster:
+            # ライン k の読み出し中に、ステージはライン k+1 の開始位置へ移動しておく
+            step_axis = 3 - axis_num  # 走査軸ではないもう一方の軸を送る
+            r1, r2, r3 = st.columns(3)
+            with r1: raster_lines = st.number_input("ライン数", 1, 100000, 5, key="raster_lines")
+            with r2: raster_step = st.number_input(f"ライン間の送り (軸{step_axis}, パルス)", -1000000, 1000000, 1000, key="raster_step")
+            with r3: raster_path = st.text_input("出力ファイル (.npy)", "raster_scan.npy", key="raster_path")
 
         col1, col2 = st.columns(2)
         with col1:
-            if st.button("スキャン開始", type="primary", disabled=(st.session_state.ls_server_socket is not None), key="start_ls"):
-                # (スキャン開始のロジックは前回と同じ)
-                # ...
-                pass
+            if st.button("スキャン開始", type="primary", disabled=(ls_sequence is not None and ls_sequence.running), key="start_ls"):
+                try:
+                    from sequences import LineScanSequence, RasterScanSequence
+                    if is_raster:
+                        sequence = RasterScanSequence(param_data, stage_ip, stage_port, axis_num, pulse_count, scan_data_size,
+                                                      raster_lines, step_axis, raster_step, raster_path,
+                                                      payload_store=get_payload_store())
+                    else:
+                        sequence = LineScanSequence(param_data, stage_ip, stage_port, axis_num, pulse_count, scan_data_size,
+                                                    payload_store=get_payload_store())
+                    store = get_log_store()
+                    store.clear("ls")
+                    sequence.start()
+                    sequences["ls"] = sequence
+                    get_sequence_log_stores()["ls"] = store
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"スキャンの開始に失敗: {e}")
         with col2:
-            if st.button("リセット", disabled=(st.session_state.ls_server_socket is None), key="reset_linescan"):
-                # (リセットのロジックは前回と同じ)
-                # ...
-                pass
-                
+            if st.button("リセット", disabled=(ls_sequence is None), key="reset_linescan"):
+                if ls_sequence: ls_sequence.stop()
+                sequences["ls"] = None
+                tab_log_store("ls").clear("ls")
+                get_sequence_log_stores()["ls"] = None
+                st.rerun()
+
         st.divider()
-        status_placeholder = st.empty()
-        log_placeholder = st.container(height=400, border=True)
 
-        with status_placeholder.container():
+        def render_ls(sequence):
             st.subheader("現在のシーケンスフェーズ")
-            phase = st.session_state.ls_phase
+            phase = sequence.phase if sequence else "未開始"
             if phase == "未開始": st.info("パラメータを確認し、「スキャン開始」ボタンを押してください。")
-            elif phase == "完了": st.success("✅ ラインスキャンが正常に完了しました。")
+            elif phase == "完了":
+                st.success("✅ ラインスキャンが正常に完了しました。")
+                if getattr(sequence, "output_path", None):
+                    st.info(f"ラスタースキャンの結果を {sequence.output_path} に保存しました。(np.load(..., mmap_mode='r') で読み込めます)")
+            elif phase == "エラー": st.error("❌ エラーが発生しました。ログを確認してください。")
             else: st.warning(f"⏳ {phase}")
-        for log in st.session_state.ls_logs: log_placeholder.text(log)
-        if st.session_state.ls_scan_data:
-            st.download_button("スキャンデータをダウンロード", st.session_state.ls_scan_data, "scan_data.bin", "application/octet-stream", key="ls_download")
-
-        # --- サーバーが起動している場合の接続チェックとシーケンス実行 ---
-        if st.session_state.ls_server_socket:
-            server = st.session_state.ls_server_socket
-            server.setblocking(0)
-            try:
-                conn, addr = server.accept()
-                with conn:
-                    # (基板からのコマンド受信部分は変更なし)
-                    conn.recv(1); cmd_id = struct.unpack("!B", conn.recv(1))[0]; conn.recv(7); data = struct.unpack("!I", conn.recv(4))[0]; conn.recv(4)
-                    ls_log(f"基板からコマンド受信 - ID:{hex(cmd_id)}, Data:{hex(data)}")
-
-                    # 4. ステージ助走位置移動依頼を受信
-                    if cmd_id == 0x05:
-                        st.session_state.ls_phase = "ステージ助走位置へ移動中..."
-                        ls_log("ステージへ原点復帰命令を発行します。")
-                        # ▼▼▼【変更点】実際のステージコマンド送信に置き換え ▼▼▼
-                        success1 = send_stage_command(stage_ip, stage_port, f"H:{axis_num}")
-                        time.sleep(0.1) # コマンド間に短いウェイト
-                        success2 = send_stage_command(stage_ip, stage_port, "G")
-                        
-                        if success1 and success2:
-                            ls_log("ステージの原点復帰命令 成功。")
-                            # 5. 基板へステージ助走位置移動完了を返信
-                            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                                s.connect(('127.0.0.1', 60202))
-                                s.sendall(create_command_packet(0x3B, 0x09, 0, 4) + struct.pack('!I', 0))
-                                s.recv(4)
-                                ls_log("基板へ助走位置移動完了(ID:0x09)を送信しました。")
-                        else:
-                            ls_log("エラー: ステージの原点復帰に失敗しました。シーケンスを中断します。")
-                            st.session_state.ls_phase = "エラー"
-                        # ▲▲▲【変更点】▲▲▲
-
-                    # 6. ステージ測定移動依頼を受信
-                    elif cmd_id == 0x06:
-                        st.session_state.ls_phase = "ステージ測定位置へ移動中..."
-                        ls_log("ステージへ測定移動指令を発行します。")
-                        # ▼▼▼【変更点】実際のステージコマンド送信に置き換え ▼▼▼
-                        move_command = f"M:{axis_num}+P{pulse_count}"
-                        success1 = send_stage_command(stage_ip, stage_port, move_command)
-                        time.sleep(0.1)
-                        success2 = send_stage_command(stage_ip, stage_port, "G")
-
-                        if success1 and success2:
-                            ls_log("ステージの測定移動命令 成功。")
-                            # 7. 基板へステージ測定移動完了を返信
-                            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                                s.connect(('127.0.0.1', 60202))
-                                s.sendall(create_command_packet(0x3B, 0x0A, 0, 4) + struct.pack('!I', 0))
-                                s.recv(4)
-                                ls_log("基板へ測定移動完了(ID:0x0A)を送信しました。")
-                        else:
-                            ls_log("エラー: ステージの測定移動に失敗しました。シーケンスを中断します。")
-                            st.session_state.ls_phase = "エラー"
-                        # ▲▲▲【変更点】▲▲▲
-
-                    # (以降のロジックは前回と同じ)
-                    # ...
+        live_view("ls", render_ls)
+        if ls_sequence is not None and not ls_sequence.running and ls_sequence.scan_payload:
+            payload_download(ls_sequence.scan_payload.id, "スキャンデータをダウンロード", "scan_data.bin", key="ls_download")
+            # 表示条件の変更ではこの部分だけを再実行する
+            scan_data_view(ls_sequence.scan_payload.id)
 
-                st.rerun()
-
-            except BlockingIOError:
-                time.sleep(1)
-                st.rerun()
-            except Exception as e:
-                ls_log(f"エラー: {e}")
-                if st.session_state.ls_server_socket: st.session_state.ls_server_socket.close()
-                st.session_state.ls_server_socket = None
-                st.session_state.ls_phase = "エラー"
-                st.rerun()
     # ==============================================================================
     # --- ▼▼▼【変更点】タブ4: 神津 ARIES ステージ制御 (新規追加) ▼▼▼ ---
     # ==============================================================================
@@ -345,86 +482,17 @@ def main():
         st.caption("ARIESコントローラに対し、LAN経由で直接コマンドを送信します。")
 
         # --- ARIES専用のログ関数 ---
-        def aries_log(message):
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            st.session_state.aries_logs.insert(0, f"[{timestamp}] {message}")
-
-        def recv_until_cr(sock):
-            """ARIESの応答 (CRLF) を正しく受信するためのヘルパー関数"""
-            data = b""
-            while True:
-                chunk = sock.recv(1)
-                # 接続が切れたか、CR(復帰)が来たら終了
-                if not chunk or chunk == b'\r':
-                    break
-                data += chunk
-            sock.recv(1) # LF(改行)を読み飛ばす
-            return data.decode('ascii').strip()
-
-        def send_aries_command(ip, port, axis, setup_command, move_command=True):
-            """神津ARIESコントローラにコマンドを送信し、完了までポーリングする"""
-            try:
-                aries_log(f"ステージ ({ip}:{port}) へ接続します...")
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    sock.settimeout(5) # 5秒で接続タイムアウト
-                    sock.connect((ip, port))
-                    
-                    # --- 1. セットアップコマンド (ORG, MVRなど) を送信 ---
-                    full_command = (setup_command + '\r\n').encode('ascii')
-                    sock.sendall(full_command)
-                    aries_log(f"コマンド送信: {setup_command}")
-                    response = recv_until_cr(sock)
-                    aries_log(f"応答受信: {response}")
-                    if response != "OK":
-                        aries_log(f"エラー: コマンドが受理されませんでした。({response})")
-                        return False
-
-                    if not move_command:
-                        return True # Gコマンドが不要な場合 (例: ?S)
-
-                    # --- 2. 実行(G)コマンドを送信 ---
-                    sock.sendall(b'G\r\n')
-                    aries_log(f"コマンド送信: G")
-                    response = recv_until_cr(sock)
-                    aries_log(f"応答受信: {response}")
-                    if response != "OK":
-                        aries_log(f"エラー: Gコマンドが受理されませんでした。({response})")
-                        return False
-
-                    # --- 3. 完了ポーリング ---
-                    aries_log(f"ステージの動作完了を待機中... (?S:{axis}でポーリング)")
-                    sock.settimeout(30) # ポーリングのタイムアウトは長めに
-                    
-                    start_time = time.time()
-                    while True:
-                        if time.time() - start_time > 120: # 2分で強制タイムアウト
-                            aries_log("エラー: 動作完了の確認がタイムアウトしました。")
-                            return False
-                        
-                        time.sleep(0.5) # 0.5秒ごとに確認
-                        
-                        check_command = f"?S:{axis}\r\n".encode('ascii')
-                        sock.sendall(check_command)
-                        response = recv_until_cr(sock)
-                        
-                        if response == "0":
-                            aries_log(f"応答受信: {response} (READY)")
-                            aries_log("ステージの動作が完了しました。")
-                            return True
-                        elif response == "1":
-                            pass # ビジー (1) なのでループ継続
-                        else:
-                            aries_log(f"エラー: 不明なステータス応答です。({response})")
-                            return False
+        def aries_log(message, level="info"):
+            add_log("aries", level, message)
 
-            except socket.timeout:
-                aries_log(f"エラー: ステージへの接続/通信がタイムアウトしました。")
-                return False
-            except ConnectionRefusedError:
-                aries_log(f"エラー: ステージへの接続が拒否されました。IP/ポートを確認してください。")
-                return False
+        def send_aries_moves(ip, port, moves):
+            """複数軸の移動 [(軸, セットアップコマンド, パルス数 or None), ...] を同時に開始し、全軸の完了を1つのループで待つ"""
+            try:
+                engine.aries_moves(ip, port, moves, st.session_state.aries_estimator,
+                                   log=lambda level, message: aries_log(message, level), timeout=120) # 2分で強制タイムアウト
+                return True
             except Exception as e:
-                aries_log(f"エラー: ステージとの通信中に予期せぬエラーが発生しました。 {e}")
+                aries_log(engine.describe_stage_error(e), "error")
                 return False
 
         # --- ARIES用UI ---
@@ -435,7 +503,11 @@ def main():
             # ARIESのデフォルトポートは1000または2000が多いようです
             aries_port = st.number_input("ポート番号", 1, 65535, 2000, key="aries_port")
             aries_axis = st.number_input("対象軸番号", 1, 4, 1, key="aries_axis")
-            
+            # 移動時間の予測に使う速度設定 (コントローラ側の設定に合わせる)
+            estimator = st.session_state.aries_estimator
+            estimator.speed = st.number_input("速度 (pulse/s)", 1, 10000000, estimator.speed, key="aries_speed")
+            estimator.accel = st.number_input("加減速度 (pulse/s²)", 1, 100000000, estimator.accel, key="aries_accel")
+
         with col2:
             st.subheader("2. 操作コマンド")
             aries_pulse = st.number_input("相対移動パルス数 (MVR)", -1000000, 1000000, 10000, key="aries_pulse")
@@ -443,25 +515,124 @@ def main():
             c2_1, c2_2 = st.columns(2)
             with c2_1:
                 if st.button("原点復帰 (ORG)", type="primary"):
-                    st.session_state.aries_logs = []
-                    command = f"ORG:{aries_axis}"
-                    send_aries_command(aries_ip, aries_port, aries_axis, command, move_command=True)
+                    get_log_store().clear("aries")
+                    send_aries_moves(aries_ip, aries_port, [(aries_axis, f"ORG:{aries_axis}", None)])
                     st.rerun()
 
             with c2_2:
                 if st.button("相対移動 (MVR)"):
-                    st.session_state.aries_logs = []
-                    command = f"MVR:{aries_axis},P{aries_pulse}"
-                    send_aries_command(aries_ip, aries_port, aries_axis, command, move_command=True)
+                    get_log_store().clear("aries")
+                    send_aries_moves(aries_ip, aries_port, [(aries_axis, f"MVR:{aries_axis},P{aries_pulse}", aries_pulse)])
                     st.rerun()
 
+        # --- 複数軸の同時操作 (全軸の完了は1本の接続でまとめてポーリング) ---
+        st.subheader("3. 複数軸同時操作")
+        multi_axes = st.multiselect("対象軸", [1, 2, 3, 4], [1, 2, 3, 4], key="aries_multi_axes")
+        pulse_cols = st.columns(4)
+        multi_pulses = {}
+        for i, col in enumerate(pulse_cols):
+            with col:
+                multi_pulses[i + 1] = st.number_input(f"軸{i + 1} パルス数 (MVR)", -1000000, 1000000, 10000, key=f"aries_multi_pulse_{i + 1}")
+
+        c3_1, c3_2 = st.columns(2)
+        with c3_1:
+            if st.button("選択軸を原点復帰 (ORG)", disabled=not multi_axes, key="aries_multi_org"):
+                get_log_store().clear("aries")
+                send_aries_moves(aries_ip, aries_port, [(axis, f"ORG:{axis}", None) for axis in multi_axes])
+                st.rerun()
+        with c3_2:
+            if st.button("選択軸を同時に相対移動 (MVR)", disabled=not multi_axes, key="aries_multi_mvr"):
+                get_log_store().clear("aries")
+                send_aries_moves(aries_ip, aries_port, [(axis, f"MVR:{axis},P{multi_pulses[axis]}", multi_pulses[axis]) for axis in multi_axes])
+                st.rerun()
+
         st.divider()
         
         st.subheader("ログ")
-        log_placeholder_aries = st.container(height=400, border=True)
-        for log in st.session_state.aries_logs:
-            log_placeholder_aries.text(log)
+        st.fragment(log_panel, key="aries_logs")("aries")
+
+        # --- 移動記録 (予測と実測の比較。速度設定の調整に使う) ---
+        records = st.session_state.aries_estimator.records
+        if records:
+            st.subheader("移動記録")
+            st.caption(f"予測の補正係数: {st.session_state.aries_estimator.scale:.3f}")
+            st.dataframe([{"軸": r.axis, "コマンド": r.command, "予測 (秒)": r.estimated, "実測 (秒)": round(r.actual, 3),
+                           "ポーリング回数": r.polls, "最終ポーリング間隔 (秒)": r.poll_interval} for r in reversed(records)])
+
+
+    # ==============================================================================
+    # --- タブ5: ラック一斉実行 ---
+    # ==============================================================================
+    with tab5:
+        st.header("ラック一斉実行")
+        st.caption("基板リストの全基板に対し、コマンドやシーケンスを同時に実行します。所要時間は最も遅い基板で決まります。")
+        st.info("ℹ️ 1台のPCで試す場合は、基板ごとにポートを分けて模擬基板を起動してください (例: `python mock_board_init.py --app-port 60211 --board-port 60212`)。")
+        boards_text = st.text_area("基板リスト (1行に「名前, IP, ポート[, 報告ポート[, ステージIP:ポート]]」)", DEFAULT_RACK_BOARDS, height=150, key="rack_boards")
+        operation = st.radio("実行内容", RACK_OPERATIONS, horizontal=True, key="rack_operation")
+        is_command = "コマンド" in operation
+        c1, c2, c3 = st.columns(3)
+        if is_command:
+            with c1: rack_cmd_id = st.number_input("コマンドID", 0, 255, 0x54, key="rack_cmd_id")
+            with c2: rack_offset = st.number_input("オフセット", 0, MAX_24BIT, 0, key="rack_offset")
+            with c3: rack_size = st.number_input("データサイズ (bytes)", 0, MAX_24BIT, 1024, key="rack_size")
+            rack_file = st.file_uploader("送信するファイル (全基板に同じ内容を送信)", type=['csv', 'bin', 'dat'], key="rack_file") if operation == RACK_OPERATIONS[1] else None
+        elif operation == "ラインスキャン":
+            with c1: rack_param = st.number_input("スキャンパラメータ (ID:0x14のデータ)", value=0x12345678, format="%08X", key="rack_param")
+            with c2: rack_axis = st.number_input("軸番号", 1, 2, 1, key="rack_axis")
+            with c3: rack_pulse = st.number_input("測定移動パルス数", 0, 1000000, 50000, key="rack_pulse")
+            rack_size = st.number_input("スキャンデータサイズ (bytes)", 0, MAX_24BIT, 43400, key="rack_scan_size")
+            st.caption("ステージは基板リストの5列目で基板ごとに指定してください (同じステージを複数の基板で同時に動かすことはできません)。")
+        c1, c2 = st.columns(2)
+        with c1: rack_timeout = st.number_input("基板ごとの制限時間 (秒)", 1, 3600, 30 if is_command else 120, key="rack_timeout")
+        with c2: rack_workers = st.number_input("同時に実行する基板数の上限 (コマンドのみ)", 1, 256, rack.MAX_WORKERS, key="rack_workers", disabled=not is_command)
+
+        if st.button("全基板で実行", type="primary", key="rack_run"):
+            store = get_log_store()
+            store.clear("rack")
+            st.session_state.rack_results = None
+            try:
+                boards = rack.parse_boards(boards_text)
+                if not boards: raise ValueError("基板リストが空です。")
+                store.add("rack", "info", f"{len(boards)} 基板で「{operation}」を同時に実行します。")
+                # 完了した基板から順に結果表を更新する (on_result はこのスレッドで呼ばれる)
+                rows = {board.name: {"基板": board.name, "接続先": f"{board.ip}:{board.port}", "結果": "実行中"} for board in boards}
+                table = st.empty()
+                table.dataframe(list(rows.values()), hide_index=True)
+                def on_result(result):
+                    rows[result.board.name] = rack.result_rows([result])[0]
+                    table.dataframe(list(rows.values()), hide_index=True)
+                def board_log(board, level, message):
+                    store.add("rack", level, f"[{board.name}] {message}")
+                def on_event(board, kind, value):
+                    if kind == "log":
+                        timestamp, level, message = value
+                        store.add("rack", level, f"[{board.name}] {message}", timestamp)
+                with st.spinner("実行中..."):
+                    if is_command:
+                        op_code = OP_READ if operation == RACK_OPERATIONS[0] else OP_WRITE
+                        source = rack_file.getvalue() if rack_file is not None else None
+                        results = rack.run_command(boards, op_code, rack_cmd_id, rack_offset, rack_size, source, 1,
+                                                   rack_timeout, rack_workers, log=board_log, on_result=on_result)
+                    elif operation == "初期化シーケンス":
+                        results = rack.run_init(boards, rack_timeout, on_event=on_event, on_result=on_result)
+                    else:
+                        results = rack.run_line_scan(boards, rack_param, rack_axis, rack_pulse, rack_size, None, rack_timeout,
+                                                     on_event=on_event, on_result=on_result)
+                st.session_state.rack_results = results
+            except Exception as e:
+                store.add("rack", "error", f"エラー: {e}")
+            st.rerun()
+
+        results = st.session_state.rack_results
+        if results:
+            ok, total = rack.passed(results)
+            slowest = max(result.elapsed for result in results)
+            if ok == total: st.success(f"✅ 合格: {ok}/{total} 基板 (最も遅い基板 {slowest:.2f}秒)")
+            else: st.error(f"❌ 不合格: {total - ok}/{total} 基板が失敗しました。(最も遅い基板 {slowest:.2f}秒)")
+            st.dataframe(rack.result_rows(results), hide_index=True)
+        st.subheader("ログ")
+        st.fragment(log_panel, key="rack_logs")("rack")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
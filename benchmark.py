@@ -0,0 +1,363 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+import engine
+from board_client import BoardConnectionPool
+from mock_async import BoardServerThread, get_pattern
+from mock_stage import StageServerThread
+from protocol import FrameReader, MAX_24BIT, OP_READ, OP_WRITE, create_command_packet, encode_value_command
+from sequences import InitSequence, LineScanSequence
+from stage_client import AriesClient, MotionEstimator
+
+# --- 通信処理・シーケンスのベンチマーク ---
+# 模擬基板に対して以下を計測し、結果をJSONで保存する。基準値 (ベースライン) のJSONを指定すると
+# 指標ごとに比較し、許容範囲を超えて悪化した指標があれば終了コード1で終了する。
+#   * コマンド往復レイテンシの分布 (0x3B/0x3C, データサイズ別)
+#   * 大容量読み出し/書き込みのスループット (MB/s)
+#   * 接続数/秒 (コマンドごとに新規接続する場合と、プールした接続を使い回す場合)
+#   * 分割読み出し (engine.segmented_read) の同時接続数ごとのスループット
+#   * ステージの移動完了の確認方法ごとの、実際の停止からの遅れと問い合わせ回数 (mock_stage.py の模擬ARIES)
+#   * 初期化シーケンス・ラインスキャンシーケンスのE2E所要時間 (mock_board_init.py / mock_board_linescan.py / mock_stage.py)
+#
+#   python benchmark.py                              (results/benchmark.json に保存)
+#   python benchmark.py --out bench.json --baseline baseline.json --tolerance 0.25
+#   python benchmark.py --target 127.0.0.1:60200     (別プロセスの mock_async.py 等を計測する)
+
+DEFAULT_OUT = os.path.join("results", "benchmark.json")
+DEFAULT_SIZES = [4, 1024, 65536, 1024 * 1024, MAX_24BIT]
+SECTIONS = ["latency", "connections", "segmented", "stage", "init", "linescan"]
+# 指標名の末尾で良し悪しの向きを決める (先に一致したものを使う)
+HIGHER_IS_BETTER = ("_mb_s", "_per_s")
+# ベースラインとの比較に使う指標 (min/max/p99 は外れ値に左右されるため比較しない)
+COMPARED = (".p50_ms", ".p90_ms", "_mb_s", "_per_s")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def distribution(name, samples_ns):
+    """レイテンシのサンプル (ns) から分布の指標 (ms) を作る"""
+    values = sorted(ns / 1e6 for ns in samples_ns)
+    return {
+        f"{name}.min_ms": values[0],
+        f"{name}.p50_ms": percentile(values, 50),
+        f"{name}.p90_ms": percentile(values, 90),
+        f"{name}.p99_ms": percentile(values, 99),
+        f"{name}.max_ms": values[-1],
+        f"{name}.mean_ms": sum(values) / len(values),
+    }
+
+
+# --- コマンドのレイテンシ・スループット ---
+
+def bench_latency(address, sizes, iterations):
+    metrics = {}
+    pool = BoardConnectionPool()
+    buf = bytearray(max(sizes))
+    view = memoryview(buf)
+    payload = get_pattern("ramp")
+    with pool.connection(address) as conn:
+        for op_code, label in ((OP_WRITE, "write"), (OP_READ, "read")):
+            for size in sizes:
+                count = iterations if size < 1024 * 1024 else max(5, iterations // 20)
+                packet = create_command_packet(op_code, 0x01, 0, size)
+                samples = []
+                for _ in range(count):
+                    start = time.perf_counter_ns()
+                    conn.sendall(packet)
+                    if op_code == OP_WRITE:
+                        conn.sendall(payload[:size])
+                    else:
+                        conn.read_into(view[:size])
+                    conn.recv_exact(4)
+                    samples.append(time.perf_counter_ns() - start)
+                metrics.update(distribution(f"latency.{label}.{size}", samples))
+                if size >= 1024 * 1024:
+                    metrics[f"throughput.{label}.{size}_mb_s"] = size / (metrics[f"latency.{label}.{size}.p50_ms"] / 1e3) / 1e6
+    pool.close_all()
+    return metrics
+
+
+def bench_connections(address, duration):
+    """新規接続 + 4バイトコマンド1回 + 切断の繰り返しと、プール接続でのコマンド繰り返しの回数/秒"""
+    packet = encode_value_command(0x01, 0)
+    count = 0
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        with socket.create_connection(address, timeout=5) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(packet)
+            FrameReader(sock).read_exact(4)
+        count += 1
+    new_per_s = count / (time.perf_counter() - start)
+
+    pool = BoardConnectionPool()
+    count = 0
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        pool.request(address, packet)
+        count += 1
+    pooled_per_s = count / (time.perf_counter() - start)
+    pool.close_all()
+    return {"connections.new_per_s": new_per_s, "connections.pooled_cmd_per_s": pooled_per_s}
+
+
+def bench_segmented(address, size, segment_size, concurrencies, iterations):
+    """オフセット指定のセグメントに分けた読み出しを、同時接続数を変えて計測する"""
+    metrics = {}
+    for concurrency in concurrencies:
+        pool = BoardConnectionPool()
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter_ns()
+            engine.segmented_read(address, 0x54, size, segment_size=segment_size, concurrency=concurrency, pool=pool)
+            samples.append(time.perf_counter_ns() - start)
+        pool.close_all()
+        metrics.update(distribution(f"segmented.read.c{concurrency}", samples))
+        metrics[f"throughput.segmented.c{concurrency}_mb_s"] = size / (metrics[f"segmented.read.c{concurrency}.p50_ms"] / 1e3) / 1e6
+    return metrics
+
+
+STAGE_MOVES = (2000, 10000, 40000)
+
+
+def bench_stage(port, time_scale, iterations):
+    """模擬ARIESで移動完了を待ち、実際に停止した時刻からの遅れ (overshoot) と問い合わせ回数を比べる
+
+    backoff は予測なしで間隔を倍にしながら問い合わせる方法、estimated は MotionEstimator の予測時刻まで
+    眠ってから問い合わせる方法。予測モデルには模擬コントローラと同じ動作モデルを time_scale で換算して渡す。
+    """
+    server = StageServerThread({"aries": port}, time_scale=time_scale, quiet=True)
+    axis = server.stages["aries"].axes[1]
+    strategies = {"backoff": None,
+                  "estimated": MotionEstimator(axis.speed * time_scale, axis.accel * time_scale ** 2, axis.settle / time_scale)}
+    metrics = {}
+    try:
+        with AriesClient('127.0.0.1', port) as client:
+            for name, estimator in strategies.items():
+                overshoot = []
+                polls = 0
+                for _ in range(iterations):
+                    for pulses in STAGE_MOVES:
+                        record = client.move(1, f"MVR:1,P{pulses}", estimator, pulses)
+                        stopped = (axis.duration + axis.settle) / time_scale
+                        overshoot.append((record.actual - stopped) * 1e9)
+                        polls += record.polls
+                metrics.update(distribution(f"stage.{name}.overshoot", overshoot))
+                metrics[f"stage.{name}.polls_per_move"] = polls / (iterations * len(STAGE_MOVES))
+    finally:
+        server.stop()
+    return metrics
+
+
+# --- シーケンスのE2E計測 ---
+# 模擬基板は mock_board_init.py / mock_board_linescan.py を別プロセスで繰り返し実行させ (--time-scale で内部処理の
+# 待ち時間をほぼなくす)、ステージは mock_stage.py の模擬FC-511を同じ時間倍率で動かす。
+
+MOCK_START_TIMEOUT = 10
+
+
+def start_mock_board(script, board_address, app_address, *options):
+    """模擬基板スクリプトを起動し、基板側サーバーが接続を受け付けるまで待つ"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script),
+               "--board-port", str(board_address[1]), "--app-port", str(app_address[1]), *options]
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + MOCK_START_TIMEOUT
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{script} が起動できませんでした: {proc.stderr.read().decode(errors='replace').strip()}")
+        try:
+            socket.create_connection(board_address, timeout=1).close()
+            return proc
+        except OSError:
+            if time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError(f"{script} が {MOCK_START_TIMEOUT}秒以内に起動しませんでした")
+            time.sleep(0.05)
+
+
+def stop_mock_board(proc):
+    """繰り返し回数を終えた模擬基板の終了を待つ (終わらなければ強制終了する)"""
+    try:
+        proc.wait(timeout=MOCK_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def wait_finished(sequence, timeout=10):
+    """シーケンスの完了 (またはエラー) までイベントを読み進め、最終フェーズを返す"""
+    deadline = time.monotonic() + timeout
+    while True:
+        kind, value = sequence.events.get(timeout=max(deadline - time.monotonic(), 0.001))
+        if kind == "phase" and value in ("完了", "エラー"):
+            return value
+
+
+def bench_init(port_base, iterations, time_scale):
+    app_address, board_address = ('127.0.0.1', port_base + 1), ('127.0.0.1', port_base + 2)
+    board = start_mock_board("mock_board_init.py", board_address, app_address,
+                             "--loop", str(iterations), "--time-scale", str(time_scale))
+    samples = []
+    try:
+        for _ in range(iterations):
+            sequence = InitSequence(listen_address=app_address, board_address=board_address, pool=BoardConnectionPool())
+            start = time.perf_counter_ns()
+            sequence.start()
+            phase = wait_finished(sequence)
+            samples.append(time.perf_counter_ns() - start)
+            # 待ち受けを閉じると、模擬基板は報告用の接続が閉じられたことを確認して次の回へ進む
+            sequence.stop(); sequence.pool.close_all()
+            if phase != "完了":
+                raise RuntimeError("初期化シーケンスがエラーで終了しました")
+        stop_mock_board(board)
+    finally:
+        if board.poll() is None:
+            board.kill()
+    return distribution("init.e2e", samples)
+
+
+def bench_linescan(port_base, iterations, time_scale, scan_data_size=43400):
+    app_address, board_address = ('127.0.0.1', port_base + 1), ('127.0.0.1', port_base + 2)
+    stage_port = port_base + 3
+    board = start_mock_board("mock_board_linescan.py", board_address, app_address,
+                             "--lines", str(iterations), "--time-scale", str(time_scale))
+    stage = StageServerThread({"fc511": stage_port}, time_scale=time_scale, quiet=True)
+    samples = []
+    try:
+        for _ in range(iterations):
+            sequence = LineScanSequence(0x12345678, '127.0.0.1', stage_port, 1, 50000, scan_data_size,
+                                        listen_address=app_address, board_address=board_address, pool=BoardConnectionPool())
+            start = time.perf_counter_ns()
+            sequence.start()
+            phase = wait_finished(sequence)
+            samples.append(time.perf_counter_ns() - start)
+            sequence.stop(); sequence.pool.close_all()
+            if phase != "完了":
+                raise RuntimeError("ラインスキャンシーケンスがエラーで終了しました")
+        stop_mock_board(board)
+    finally:
+        if board.poll() is None:
+            board.kill()
+        stage.stop()
+    return distribution("linescan.e2e", samples)
+
+
+# --- 結果の保存・比較 ---
+
+def is_higher_better(name):
+    return name.endswith(HIGHER_IS_BETTER)
+
+
+def compare(metrics, baseline, tolerance):
+    """ベースラインと比較し、(指標名, 基準値, 今回値, 変化率, 悪化したか) のリストを返す"""
+    rows = []
+    for name, value in sorted(metrics.items()):
+        base = baseline.get(name)
+        if not base or not name.endswith(COMPARED):
+            continue
+        change = (value - base) / base
+        worse = change < -tolerance if is_higher_better(name) else change > tolerance
+        rows.append((name, base, value, change, worse))
+    return rows
+
+
+def run(args):
+    sections = args.only.split(",") if args.only else SECTIONS
+    metrics = {}
+    mock = None
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+        address = (host, int(port))
+    else:
+        address = ('127.0.0.1', args.port_base)
+        mock = BoardServerThread([args.port_base], quiet=True)
+    try:
+        if "latency" in sections:
+            print("コマンドのレイテンシ/スループットを計測中...")
+            metrics.update(bench_latency(address, args.sizes, args.iterations))
+        if "connections" in sections:
+            print("接続数/秒を計測中...")
+            metrics.update(bench_connections(address, args.duration))
+        if "segmented" in sections:
+            print("分割読み出しのスループットを計測中...")
+            metrics.update(bench_segmented(address, args.segmented_size, args.segment_kib * 1024, args.concurrency, 5))
+    finally:
+        if mock:
+            mock.stop()
+    if "stage" in sections:
+        print("ステージの移動完了待ちを計測中...")
+        metrics.update(bench_stage(args.port_base + 20, args.stage_time_scale, args.stage_iterations))
+    if "init" in sections:
+        print("初期化シーケンスのE2E時間を計測中...")
+        metrics.update(bench_init(args.port_base + 10, args.e2e_iterations, args.e2e_time_scale))
+    if "linescan" in sections:
+        print("ラインスキャンシーケンスのE2E時間を計測中...")
+        metrics.update(bench_linescan(args.port_base + 10, args.e2e_iterations, args.e2e_time_scale))
+    return metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="制御基板通信・シーケンスのベンチマーク")
+    parser.add_argument("--out", default=DEFAULT_OUT, help=f"結果を保存するJSONファイル (既定 {DEFAULT_OUT})")
+    parser.add_argument("--baseline", help="比較対象のJSONファイル (前回の --out の結果)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="悪化とみなす変化率 (0.25 = 25%%)")
+    parser.add_argument("--only", help=f"計測する項目 (カンマ区切り: {','.join(SECTIONS)})")
+    parser.add_argument("--target", help="計測対象の基板 (IP:ポート)。未指定時は内蔵の模擬基板を起動する")
+    parser.add_argument("--port-base", type=int, default=61200, help="内蔵の模擬基板・E2E計測で使うポートの先頭")
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES, help="レイテンシを計測するデータサイズ (bytes)")
+    parser.add_argument("--iterations", type=int, default=200, help="サイズごとの計測回数 (1MiB以上はこの1/20)")
+    parser.add_argument("--duration", type=float, default=2.0, help="接続数/秒の計測時間 (秒)")
+    parser.add_argument("--segmented-size", type=int, default=MAX_24BIT + 1, help="分割読み出しで読むデータサイズ (bytes)")
+    parser.add_argument("--segment-kib", type=int, default=1024, help="分割読み出しのセグメントサイズ (KiB)")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4], help="分割読み出しの同時接続数 (複数指定で比較)")
+    parser.add_argument("--stage-time-scale", type=float, default=10.0, help="模擬ステージの時間倍率 (移動時間が 1/倍率 になる)")
+    parser.add_argument("--stage-iterations", type=int, default=3, help="ステージの移動量ごとの計測回数")
+    parser.add_argument("--e2e-iterations", type=int, default=10, help="シーケンスE2Eの計測回数")
+    parser.add_argument("--e2e-time-scale", type=float, default=10000.0,
+                        help="E2E計測で模擬基板・模擬ステージに渡す時間倍率 (基板の内部処理とステージの移動時間が 1/倍率 になる)")
+    args = parser.parse_args(argv)
+
+    metrics = run(args)
+    result = {
+        "meta": {"timestamp": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0],
+                 "platform": platform.platform(), "target": args.target or "内蔵模擬基板 (mock_async)"},
+        "metrics": metrics,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を {args.out} に保存しました。")
+    for name, value in sorted(metrics.items()):
+        print(f"  {name:45s} {value:12.3f}")
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["metrics"]
+    rows = compare(metrics, baseline, args.tolerance)
+    print(f"\nベースライン {args.baseline} との比較 (許容 {args.tolerance:.0%}):")
+    for name, base, value, change, worse in rows:
+        print(f"  {'NG' if worse else 'OK'} {name:45s} {base:12.3f} -> {value:12.3f} ({change:+.1%})")
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print(f"\n{len(regressions)} 件の指標が悪化しました。")
+        return 1
+    print("\n悪化した指標はありません。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import io
+import socket
+import select
+import threading
+import time
+from contextlib import contextmanager
+import capture
+import metrics
+
+# --- 制御基板との接続を使い回すためのクライアント層 ---
+# 12バイトコマンドプロトコルでは、コマンドごとに接続/切断するとTCPハンドシェイクの
+# コストがコマンド本体より大きくなるため、エンドポイントごとに接続をプールして再利用する。
+
+DEFAULT_TIMEOUT = 5.0
+MAX_IDLE_PER_ENDPOINT = 4
+IDLE_TIMEOUT = 60.0
+# 一括受信時の1回あたりの最大受信サイズ (大きいほどシステムコール回数が減る)
+BULK_CHUNK_SIZE = 1024 * 1024
+
+
+def bulk_read(sock, data_size, chunk_size=BULK_CHUNK_SIZE):
+    """data_sizeバイトを事前確保したバッファへ直接受信し、(バッファ, 転送速度MB/s) を返す
+
+    bytes の連結を行わず memoryview + recv_into で埋めるため、16MiB級の受信でも
+    コピーが発生しない。
+    """
+    buf = bytearray(data_size)
+    return buf, bulk_read_into(sock, memoryview(buf), chunk_size)
+
+
+def bulk_read_into(sock, view, chunk_size=BULK_CHUNK_SIZE):
+    """呼び出し側が用意したバッファ (memoryview, メモリマップ等) を埋めるまで受信し、転送速度MB/sを返す"""
+    view = memoryview(view).cast('B')
+    data_size = len(view)
+    received = 0
+    start_time = time.perf_counter()
+    while received < data_size:
+        n = sock.recv_into(view[received:], min(chunk_size, data_size - received))
+        if n == 0:
+            raise ConnectionError(f"受信途中で接続が切断されました ({received}/{data_size} bytes)")
+        received += n
+    elapsed = time.perf_counter() - start_time
+    return data_size / elapsed / 1e6 if elapsed > 0 else float('inf')
+
+
+def recv_exact(sock, size):
+    """指定バイト数を受信しきるまで読み込む"""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError(f"受信途中で接続が切断されました ({len(buf)}/{size} bytes)")
+        buf += chunk
+    return bytes(buf)
+
+
+def _available_size(fileobj):
+    """ファイルオブジェクトの現在位置から末尾までのバイト数を返す"""
+    start = fileobj.tell()
+    end = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(start)
+    return end - start
+
+
+def _has_fileno(fileobj):
+    try:
+        fileobj.fileno()
+        return True
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
+
+def stream_write(sock, fileobj, data_size, chunk_size=BULK_CHUNK_SIZE, progress=None, packet=b''):
+    """fileobj の現在位置からちょうど data_size バイトをソケットへ送信し、(送信バイト数, MB/s) を返す
+
+    ディスク上のファイルは socket.sendfile でカーネル内コピーのまま送り、
+    メモリ上のファイル (BytesIO 等) はバッファを memoryview で切り出して送る。
+    packet を指定した場合は、データ量の確認後にデータの直前に送信する (コマンドパケット用)。
+    progress には progress(送信済みバイト数, data_size) が呼ばれる。
+    """
+    available = _available_size(fileobj)
+    if available < data_size:
+        raise ValueError(f"送信するファイルのサイズが不足しています ({available}/{data_size} bytes)")
+    if packet:
+        sock.sendall(packet)
+    start = fileobj.tell()
+    sent = 0
+    start_time = time.perf_counter()
+    if _has_fileno(fileobj):
+        while sent < data_size:
+            n = sock.sendfile(fileobj, start + sent, min(chunk_size, data_size - sent))
+            if n == 0:
+                raise ConnectionError(f"送信途中で接続が切断されました ({sent}/{data_size} bytes)")
+            sent += n
+            if progress: progress(sent, data_size)
+    elif hasattr(fileobj, 'getbuffer'):
+        with fileobj.getbuffer() as view:
+            while sent < data_size:
+                n = min(chunk_size, data_size - sent)
+                sock.sendall(view[start + sent:start + sent + n])
+                sent += n
+                if progress: progress(sent, data_size)
+        fileobj.seek(start + sent)
+    else:
+        buf = bytearray(min(chunk_size, data_size) or 1)
+        view = memoryview(buf)
+        while sent < data_size:
+            n = fileobj.readinto(view[:min(len(buf), data_size - sent)])
+            if not n:
+                raise ValueError(f"ファイルの読み込みが途中で終了しました ({sent}/{data_size} bytes)")
+            sock.sendall(view[:n])
+            sent += n
+            if progress: progress(sent, data_size)
+    elapsed = time.perf_counter() - start_time
+    mb_per_sec = sent / elapsed / 1e6 if elapsed > 0 else float('inf')
+    return sent, mb_per_sec
+
+
+class BoardConnection:
+    """制御基板1エンドポイントへの持続的なTCP接続"""
+
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT):
+        self.address = address
+        self.endpoint = f"{address[0]}:{address[1]}"
+        with metrics.timer("board_connect", endpoint=self.endpoint):
+            sock = socket.create_connection(address, timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock = capture.wrap(sock, "board", address)
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def is_alive(self):
+        """相手側から切断されていないかを確認する (ヘルスチェック)"""
+        if self.sock.fileno() < 0:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+            # 待機中に読み込み可能 = 切断(EOF)か、想定外の残データ。どちらも再利用しない
+            return False
+        except (OSError, ValueError):
+            return False
+
+    def sendall(self, data):
+        with metrics.timer("board_send", endpoint=self.endpoint):
+            self.sock.sendall(data)
+        self.last_used = time.monotonic()
+
+    def recv_exact(self, size):
+        with metrics.timer("board_recv", endpoint=self.endpoint):
+            data = recv_exact(self.sock, size)
+        self.last_used = time.monotonic()
+        return data
+
+    def read_bulk(self, data_size, chunk_size=BULK_CHUNK_SIZE):
+        """大容量データを一括受信する (bulk_read を参照)"""
+        with metrics.timer("board_bulk_read", endpoint=self.endpoint):
+            buf, mb_per_sec = bulk_read(self.sock, data_size, chunk_size)
+        self.last_used = time.monotonic()
+        return buf, mb_per_sec
+
+    def read_into(self, view, chunk_size=BULK_CHUNK_SIZE):
+        """用意済みのバッファへ直接受信し、転送速度MB/sを返す (bulk_read_into を参照)"""
+        with metrics.timer("board_bulk_read", endpoint=self.endpoint):
+            mb_per_sec = bulk_read_into(self.sock, view, chunk_size)
+        self.last_used = time.monotonic()
+        return mb_per_sec
+
+    def write_stream(self, fileobj, data_size, chunk_size=BULK_CHUNK_SIZE, progress=None, packet=b''):
+        """ファイルの内容をストリーミング送信する (stream_write を参照)"""
+        with metrics.timer("board_bulk_write", endpoint=self.endpoint):
+            result = stream_write(self.sock, fileobj, data_size, chunk_size, progress, packet)
+        self.last_used = time.monotonic()
+        return result
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class BoardConnectionPool:
+    """エンドポイント (IP, ポート) ごとに接続をプールし、健全な接続を再利用する"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_idle=MAX_IDLE_PER_ENDPOINT, idle_timeout=IDLE_TIMEOUT):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, address):
+        with self._lock:
+            idle = self._idle.get(address, [])
+            while idle:
+                conn = idle.pop()
+                fresh = time.monotonic() - conn.last_used < self.idle_timeout
+                if fresh and conn.is_alive():
+                    conn.reused = True
+                    return conn
+                conn.close()
+        return BoardConnection(address, self.timeout)
+
+    def _checkin(self, conn):
+        with self._lock:
+            idle = self._idle.setdefault(conn.address, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self, address):
+        """プールから接続を借りる。例外が発生した接続は破棄し、正常終了時のみ返却する"""
+        address = (address[0], int(address[1]))
+        conn = self._checkout(address)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        self._checkin(conn)
+
+    def request(self, address, packet, payload=b'', status_size=4):
+        """コマンド(+データ)を送信し、ステータスを受信して返す
+
+        再利用した接続が既に切れていた場合は、新しい接続で1度だけ再送する。
+        """
+        address = (address[0], int(address[1]))
+        for attempt in range(2):
+            conn = self._checkout(address)
+            try:
+                conn.sendall(packet + payload if payload else packet)
+                status = conn.recv_exact(status_size) if status_size else b''
+            except socket.timeout:
+                conn.close()
+                raise
+            except (ConnectionError, OSError):
+                conn.close()
+                if attempt == 0 and conn.reused:
+                    continue
+                raise
+            self._checkin(conn)
+            return status
+
+    def close_endpoint(self, address):
+        with self._lock:
+            for conn in self._idle.pop((address[0], int(address[1])), []):
+                conn.close()
+
+    def close_all(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """プロセス内で共有するデフォルトの接続プールを返す"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = BoardConnectionPool()
+        return _default_pool
@@ -0,0 +1,201 @@
+import json
+import struct
+import threading
+import time
+from collections import namedtuple
+
+# --- 通信の記録 (キャプチャ) ---
+# 基板プロトコル (60200/60201/60202) とステージのASCIIプロトコルで送受信したバイト列を、
+# 方向・接続先・単調増加のナノ秒タイムスタンプ付きで追記専用のバイナリファイルに記録する。
+# 記録中でなければ wrap() はソケットをそのまま返すため、通常時の通信には影響しない。
+# 記録したファイルは replay.py で再生 (アプリ側/基板側のどちらの役も可) できる。
+#
+# ファイル形式 (リトルエンディアン):
+#   ヘッダー  MAGIC(8) 記録開始時の時刻 time_ns(8) 記録開始時の monotonic_ns(8)
+#   レコード  monotonic_ns(8) ストリーム番号(4) 種別(1) 長さ(4) データ(長さ)
+# ストリームはソケット1本。OPEN のデータは接続情報のJSON
+#   {"protocol": "board"/"stage", "role": "client"/"server", "local": "IP:ポート", "peer": "IP:ポート"}
+# role はアプリ側が接続した (client) か、基板から接続を受けた (server) か。SEND/RECV はアプリから見た方向。
+
+MAGIC = b"JGCAP\x00\x01\n"
+FILE_HEADER = struct.Struct('<8sQQ')
+RECORD = struct.Struct('<QIBI')
+
+OPEN, SEND, RECV, CLOSE = range(4)
+EVENT_NAMES = {OPEN: "OPEN", SEND: "SEND", RECV: "RECV", CLOSE: "CLOSE"}
+
+Record = namedtuple('Record', 'timestamp stream event data')
+# 記録したソケット1本分の接続情報
+Stream = namedtuple('Stream', 'stream protocol role local peer')
+
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+
+def parse_address(value):
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
+
+
+class Recorder:
+    """キャプチャファイルへの書き込み (複数スレッドから呼ばれるためロックで直列化する)"""
+
+    def __init__(self, path):
+        self.path = path
+        # 異常終了しても記録が残るよう、バッファリングせずに追記する
+        self._file = open(path, 'wb', buffering=0)
+        self._lock = threading.Lock()
+        self._next_stream = 0
+        self.records = 0
+        self.bytes = 0
+        self._file.write(FILE_HEADER.pack(MAGIC, time.time_ns(), time.monotonic_ns()))
+
+    def open_stream(self, protocol, role, local, peer):
+        info = json.dumps({"protocol": protocol, "role": role, "local": format_address(local),
+                           "peer": format_address(peer)}).encode('utf-8')
+        with self._lock:
+            stream = self._next_stream
+            self._next_stream += 1
+        self.record(stream, OPEN, info)
+        return stream
+
+    def record(self, stream, event, data=b''):
+        with self._lock:
+            if self._file.closed:
+                return
+            # タイムスタンプはロック内で取り、ファイル上の順序と時刻の順序を一致させる
+            header = RECORD.pack(time.monotonic_ns(), stream, event, len(data))
+            if len(data) <= 65536:
+                self._file.write(header + bytes(data))
+            else:
+                self._file.write(header)
+                self._file.write(data)
+            self.records += 1
+            self.bytes += len(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class CapturedSocket:
+    """送受信したバイト列を Recorder に記録するソケットのラッパー (それ以外の操作はそのまま委譲する)"""
+
+    def __init__(self, sock, recorder, stream):
+        self._sock = sock
+        self._recorder = recorder
+        self._stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+        self._recorder.record(self._stream, SEND, data)
+
+    def send(self, data, *flags):
+        n = self._sock.send(data, *flags)
+        self._recorder.record(self._stream, SEND, memoryview(data)[:n])
+        return n
+
+    def sendfile(self, file, offset=0, count=None):
+        n = self._sock.sendfile(file, offset, count)
+        # カーネル内で送信された内容はファイルから読み直して記録する (os.pread は Windows に無いため seek で読む)
+        position = file.tell()
+        try:
+            file.seek(offset)
+            data = file.read(n)
+        finally:
+            file.seek(position)
+        self._recorder.record(self._stream, SEND, data)
+        return n
+
+    def recv(self, size, *flags):
+        data = self._sock.recv(size, *flags)
+        if data:
+            self._recorder.record(self._stream, RECV, data)
+        return data
+
+    def recv_into(self, buffer, nbytes=0, *flags):
+        n = self._sock.recv_into(buffer, nbytes, *flags)
+        if n:
+            self._recorder.record(self._stream, RECV, memoryview(buffer).cast('B')[:n])
+        return n
+
+    def close(self):
+        if self._sock.fileno() >= 0:
+            self._recorder.record(self._stream, CLOSE)
+        self._sock.close()
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def start(path):
+    """記録を開始する (記録中なら先に停止する)。開始前に作られた接続 (プール内の接続など) は記録されない"""
+    global _recorder
+    with _recorder_lock:
+        if _recorder:
+            _recorder.close()
+        _recorder = Recorder(path)
+        return _recorder
+
+
+def stop():
+    """記録を停止し、停止した Recorder (記録していなければ None) を返す"""
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder:
+        recorder.close()
+    return recorder
+
+
+def active():
+    return _recorder
+
+
+def wrap(sock, protocol, peer, accepted=False):
+    """記録中であれば sock を CapturedSocket で包む (accepted=True は基板から受けた接続)"""
+    recorder = _recorder
+    if recorder is None:
+        return sock
+    try:
+        local = sock.getsockname()
+    except OSError:
+        local = ("", 0)
+    stream = recorder.open_stream(protocol, "server" if accepted else "client", local, peer)
+    return CapturedSocket(sock, recorder, stream)
+
+
+def read_capture(path):
+    """キャプチャファイルを読み込み、(記録開始時刻 time_ns, 記録開始 monotonic_ns, {番号: Stream}, [Record, ...]) を返す
+
+    書き込み途中で終了したファイルは、最後の完全なレコードまでを返す。
+    """
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if len(buf) < FILE_HEADER.size:
+        raise ValueError(f"キャプチャファイルではありません: {path}")
+    magic, wall_ns, start_ns = FILE_HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError(f"キャプチャファイルではありません: {path}")
+    view = memoryview(buf)
+    streams = {}
+    records = []
+    pos = FILE_HEADER.size
+    while pos + RECORD.size <= len(buf):
+        timestamp, stream, event, length = RECORD.unpack_from(buf, pos)
+        end = pos + RECORD.size + length
+        if end > len(buf):
+            break
+        data = view[pos + RECORD.size:end]
+        if event == OPEN:
+            info = json.loads(bytes(data).decode('utf-8'))
+            streams[stream] = Stream(stream, info["protocol"], info["role"], parse_address(info["local"]),
+                                     parse_address(info["peer"]))
+        records.append(Record(timestamp, stream, event, data))
+        pos = end
+    return wall_ns, start_ns, streams, records
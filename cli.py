@@ -0,0 +1,453 @@
+import argparse
+import shlex
+import statistics
+import sys
+import os
+import time
+from collections import Counter
+from protocol import OP_READ, OP_WRITE, MAX_24BIT
+from log_store import LogStore, get_file_logger
+import capture
+import engine
+import metrics
+import rack
+
+# --- コマンドライン版 (画面なしで実行) ---
+# Streamlit を起動せずに手動コマンド・各シーケンス・ARIES制御を実行し、結果を終了コードで返す。
+# バッチファイルには1行に1コマンドを、このCLIのサブコマンドと同じ書式で記述する。
+#
+#   python cli.py read --id 0x54 --size 43400 --out scan.bin
+#   python cli.py write --id 0x20 --file image.bin --segment-kib 1024 --verify            # 分割書き込み + 読み返し照合
+#   python cli.py read --id 0x54 --size 0x4000000 --segment-kib 4096 --concurrency 8 --offset-unit 4   # 64MiB を分割読み出し
+#   python cli.py linescan --stage 192.168.0.200:8000 --out scan.bin
+#   python cli.py sequence linescan --set pulses=20000 --stage 192.168.0.200:8000 --out scan.bin
+#   python cli.py batch commands.txt
+#   python cli.py --capture init.jgcap init       # 送受信を記録する (replay.py で表示・再生)
+#   python cli.py --metrics scan.csv linescan     # 各段階の処理時間 (metrics.py) を保存する
+#   python cli.py init --boards rack.txt          # 基板リストの全基板で同時に実行 (rack.py)
+#   python cli.py -q init --repeat 200 --timeout 1  # 続けて200回実行し、結果の内訳と所要時間を表示 (mock_scenario.py)
+#
+# バッチファイルの例 (# 以降はコメント):
+#   write --id 1 --file params.bin
+#   init --timeout 60
+#   aries --target 192.168.0.100:2000 ORG:1 ORG:2
+#   sleep 0.5
+
+EXIT_OK = 0
+EXIT_FAILED = 1     # コマンド/シーケンスの失敗 (エラーステータスを含む)
+EXIT_USAGE = 2      # 引数・バッチファイルの書式エラー (argparse と同じ)
+EXIT_TIMEOUT = 3    # シーケンスが制限時間内に終了しなかった
+
+DEFAULT_TARGET = "127.0.0.1:60200"
+
+
+def int_auto(value):
+    """10進/16進 (0x...) どちらでも受け付ける"""
+    return int(value, 0)
+
+
+def address(value):
+    """"IP:ポート" を (IP, ポート) に変換する"""
+    host, sep, port = value.rpartition(":")
+    if not sep or not host:
+        raise argparse.ArgumentTypeError(f"IP:ポート の形式で指定してください: {value}")
+    return host, int(port)
+
+
+class Console:
+    """ログを標準エラー出力とログファイル (logs/jigu_tool.log) に書き出す"""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        # 画面表示はしないため、保管はファイル出力のためだけに使う
+        self.store = LogStore(max_entries=1, file_logger=get_file_logger())
+
+    def log(self, level, message, timestamp=None):
+        entry = self.store.add("cli", level, message, timestamp)
+        if self.quiet and level in ("info", "success"):
+            return
+        print(f"[{entry.timestamp:%H:%M:%S}] {level.upper():7} {message}", file=sys.stderr)
+
+    def on_event(self, kind, value):
+        if kind == "log":
+            timestamp, level, message = value
+            self.log(level, message, timestamp)
+        elif kind == "phase":
+            self.log("info", f"フェーズ: {value}")
+
+
+# --- サブコマンド ---
+
+def cmd_write(args, console):
+    chunked = args.segment_kib or args.resume_from or args.verify
+    with open(args.file, 'rb') as f:
+        file_size = f.seek(0, 2)
+    size = args.size if args.size is not None else (file_size if chunked else min(file_size, MAX_24BIT))
+    if args.boards:
+        return run_rack(args, console, lambda boards, **options: rack.run_command(
+            boards, OP_WRITE, args.id, args.offset, size, args.file, args.repeat, args.timeout, args.workers, **options))
+    if not (chunked or size > MAX_24BIT):
+        result = engine.manual_command(args.target, OP_WRITE, args.id, args.offset, size, args.repeat,
+                                       source=args.file, log=console.log)
+        return check_statuses(result, console)
+    try:
+        result = engine.chunked_write(args.target, args.id, args.file, size, args.offset,
+                                      (args.segment_kib or engine.DEFAULT_SEGMENT_SIZE // 1024) * 1024, args.retries,
+                                      args.offset_unit, args.resume_from, args.verify, args.read_id, log=console.log)
+    except engine.WriteInterrupted as e:
+        console.log("error", f"エラー: {e}")
+        console.log("info", f"--resume-from {e.written} を付けて実行すると、続きから書き込めます。")
+        return EXIT_FAILED
+    if result.verified is False:
+        return EXIT_FAILED
+    return check_statuses(result, console)
+
+
+def cmd_read(args, console):
+    if args.boards:
+        return run_rack(args, console, lambda boards, **options: rack.run_command(
+            boards, OP_READ, args.id, args.offset, args.size, None, args.repeat, args.timeout, args.workers, **options))
+    if args.segment_kib or args.size > MAX_24BIT:
+        result = engine.segmented_read(args.target, args.id, args.size, args.offset,
+                                       (args.segment_kib or engine.DEFAULT_SEGMENT_SIZE // 1024) * 1024,
+                                       args.concurrency, args.retries, args.offset_unit, log=console.log)
+    else:
+        result = engine.manual_command(args.target, OP_READ, args.id, args.offset, args.size, args.repeat,
+                                       chunk_size=args.chunk_kib * 1024, log=console.log)
+    if args.out:
+        with open(args.out, 'wb') as f:
+            f.write(result.data)
+        console.log("info", f"受信データを {args.out} に保存しました。")
+    return check_statuses(result, console)
+
+
+def check_statuses(result, console):
+    failed = [status for status in result.statuses if status != 0]
+    if failed:
+        console.log("error", f"エラーステータスを受信しました ({len(failed)}/{len(result.statuses)}回): {failed[0]:#010x}")
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def run_sequence(sequence, args, console):
+    try:
+        phase = engine.run_sequence(sequence, args.timeout, console.on_event)
+    except TimeoutError as e:
+        console.log("error", str(e))
+        return EXIT_TIMEOUT
+    return EXIT_OK if phase == "完了" else EXIT_FAILED
+
+
+def run_repeated(make_sequence, args, console):
+    """シーケンスを --repeat 回続けて実行し、結果の内訳と所要時間をまとめて表示する
+
+    模擬基板の繰り返し実行 (mock_scenario.py) と組み合わせた回帰試験用。
+    (終了コード, 最後のシーケンス) を返す。終了コードは最初に失敗した回のもの。
+    """
+    if args.repeat <= 1:
+        sequence = make_sequence()
+        return run_sequence(sequence, args, console), sequence
+    code, results, elapsed = EXIT_OK, Counter(), []
+    for run in range(1, args.repeat + 1):
+        sequence = make_sequence()
+        started, result = time.perf_counter(), None
+        try:
+            run_code = run_sequence(sequence, args, console)
+        except Exception as e:
+            console.log("error", f"エラー: {e}")
+            run_code, result = EXIT_FAILED, "エラー"
+        elapsed.append(time.perf_counter() - started)
+        result = result or ("タイムアウト" if run_code == EXIT_TIMEOUT else sequence.phase)
+        results[result] += 1
+        console.log("info" if run_code == EXIT_OK else "warning", f"[{run}/{args.repeat}] {result} ({elapsed[-1]:.3f}秒)")
+        code = code or run_code
+    elapsed.sort()
+    print("  ".join(f"{result}: {count}" for result, count in results.most_common()))
+    print(f"所要時間: 最小 {elapsed[0]:.3f}秒 / 中央値 {statistics.median(elapsed):.3f}秒 / 最大 {elapsed[-1]:.3f}秒 "
+          f"(合計 {sum(elapsed):.2f}秒, {args.repeat} 回)")
+    return code, sequence
+
+
+def cmd_init(args, console):
+    if args.boards:
+        return run_rack(args, console, lambda boards, **options: rack.run_init(boards, args.timeout, **options))
+    from sequences import InitSequence
+    return run_repeated(InitSequence, args, console)[0]
+
+
+def cmd_linescan(args, console):
+    if args.boards:
+        return run_rack(args, console, lambda boards, **options: rack.run_line_scan(
+            boards, args.param, args.axis, args.pulses, args.size, args.stage, args.timeout, **options))
+    from sequences import LineScanSequence
+    stage_ip, stage_port = args.stage
+    code, sequence = run_repeated(
+        lambda: LineScanSequence(args.param, stage_ip, stage_port, args.axis, args.pulses, args.size), args, console)
+    if code == EXIT_OK and args.out and sequence.scan_data is not None:
+        with open(args.out, 'wb') as f:
+            f.write(sequence.scan_data)
+        console.log("info", f"スキャンデータを {args.out} に保存しました。")
+    return code
+
+
+def cmd_sequence(args, console):
+    from sequence_def import load_definition, parse_params
+    definition = load_definition(args.definition)
+    params = parse_params(args.set)
+    if args.boards:
+        return run_rack(args, console, lambda boards, **options: rack.run_defined(
+            boards, definition, params, args.stage, args.timeout, **options))
+    from sequences import DefinedSequence
+    code, sequence = run_repeated(lambda: DefinedSequence(definition, params, stage=args.stage), args, console)
+    if code == EXIT_OK and args.out and sequence.scan_data is not None:
+        with open(args.out, 'wb') as f:
+            f.write(sequence.scan_data)
+        console.log("info", f"読み出しデータを {args.out} に保存しました。")
+    return code
+
+
+def run_rack(args, console, run):
+    """基板リストの全基板で同時に実行し、基板ごとの結果表と全体の合否を出力する
+
+    --out は保存先ディレクトリとして扱い、基板ごとのデータを <基板名>.bin に保存する。
+    """
+    boards = rack.load_boards(args.boards)
+    console.log("info", f"{len(boards)} 基板で同時に実行します。({args.boards})")
+
+    def log(board, level, message):
+        console.log(level, f"[{board.name}] {message}")
+
+    def on_event(board, kind, value):
+        if kind == "log":
+            timestamp, level, message = value
+            console.log(level, f"[{board.name}] {message}", timestamp)
+
+    def on_result(result):
+        console.log("success" if result.ok else "error", f"[{result.board.name}] {result.phase} ({result.elapsed:.2f}秒) {result.detail}")
+
+    options = {"on_result": on_result}
+    options.update({"log": log} if args.command in ("read", "write") else {"on_event": on_event})
+    results = run(boards, **options)
+    if getattr(args, "out", None):
+        os.makedirs(args.out, exist_ok=True)
+        for result in results:
+            if result.data is not None:
+                with open(os.path.join(args.out, f"{result.board.name}.bin"), 'wb') as f:
+                    f.write(result.data)
+        console.log("info", f"受信データを {args.out} に保存しました。")
+    print_results(results)
+    ok, total = rack.passed(results)
+    return EXIT_OK if ok == total else EXIT_FAILED
+
+
+def print_results(results):
+    rows = rack.result_rows(results)
+    columns = list(rows[0]) if rows else []
+    widths = {c: max(len(str(c)), *(len(str(row[c])) for row in rows)) for c in columns}
+    for line in [{c: c for c in columns}] + rows:
+        print("  ".join(str(line[c]).ljust(widths[c]) for c in columns).rstrip())
+    ok, total = rack.passed(results)
+    print(f"{'合格' if ok == total else '不合格'}: {ok}/{total} 基板")
+
+
+def cmd_raster(args, console):
+    from sequences import RasterScanSequence
+    stage_ip, stage_port = args.stage
+    step_axis = 3 - args.axis  # 走査軸ではないもう一方の軸を送る
+    sequence = RasterScanSequence(args.param, stage_ip, stage_port, args.axis, args.pulses, args.size,
+                                  args.lines, step_axis, args.step, args.out)
+    return run_sequence(sequence, args, console)
+
+
+def cmd_aries(args, console):
+    from stage_client import MotionEstimator
+    moves = [engine.parse_aries_move(command) for command in args.commands]
+    ip, port = args.target
+    estimator = MotionEstimator(args.speed, args.accel)
+    try:
+        engine.aries_moves(ip, port, moves, estimator, log=console.log, timeout=args.timeout)
+    except Exception as e:
+        console.log("error", engine.describe_stage_error(e))
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def cmd_sleep(args, console):
+    time.sleep(args.seconds)
+    return EXIT_OK
+
+
+def cmd_batch(args, console):
+    try:
+        steps = load_batch(args.file)
+    except ValueError as e:
+        console.log("error", str(e))
+        return EXIT_USAGE
+    result = EXIT_OK
+    for lineno, line, step in steps:
+        console.log("info", f"[{args.file}:{lineno}] {line}")
+        code = run_command(step, console)
+        if code != EXIT_OK:
+            console.log("error", f"[{args.file}:{lineno}] 失敗しました (終了コード {code})")
+            if not args.keep_going:
+                return code
+            result = result or code
+    return result
+
+
+def load_batch(path):
+    """バッチファイルを読み込み、実行前に全行の書式を確認して [(行番号, 行, 引数), ...] を返す"""
+    parser = build_parser(batch=True)
+    steps = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            try:
+                steps.append((lineno, line.strip(), parser.parse_args(argv)))
+            except SystemExit:
+                # argparse はエラー内容を表示済み
+                raise ValueError(f"{path}:{lineno}: コマンドを解釈できません: {line.strip()}") from None
+    return steps
+
+
+def build_parser(batch=False):
+    parser = argparse.ArgumentParser(prog="cli.py", description="JIGUツール (コマンドライン版)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="警告・エラー以外のログを表示しない")
+    if not batch:
+        parser.add_argument("--capture", metavar="FILE", help="基板・ステージとの送受信を記録する (replay.py で再生できる)")
+        parser.add_argument("--metrics", metavar="FILE", help="処理時間の計測結果を保存する (.csv は CSV、それ以外は Prometheus テキスト形式)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_target(p, default=DEFAULT_TARGET):
+        p.add_argument("--target", type=address, default=address(default), help=f"接続先 IP:ポート (既定 {default})")
+
+    def add_repeat(p):
+        p.add_argument("--repeat", type=int, default=1, help="続けて実行する回数 (結果の内訳と所要時間をまとめて表示する。"
+                                                              "--boards 指定時は無視)")
+
+    def add_rack(p, command=False):
+        p.add_argument("--boards", metavar="FILE", help="基板リスト。指定すると全基板で同時に実行する (--out はディレクトリ)")
+        if command:
+            p.add_argument("--workers", type=int, default=rack.MAX_WORKERS, help="同時に実行する基板数の上限 (--boards 指定時)")
+            p.add_argument("--timeout", type=float, default=rack.DEFAULT_TIMEOUT, help="基板ごとの制限時間 (秒, --boards 指定時)")
+
+    p = sub.add_parser("write", help="書き込みコマンド (0x3B) を送信する")
+    add_target(p)
+    p.add_argument("--id", type=int_auto, required=True, help="コマンドID")
+    p.add_argument("--offset", type=int_auto, default=0)
+    p.add_argument("--size", type=int_auto, help="データサイズ (省略時はファイルサイズ)")
+    p.add_argument("--file", required=True, help="送信するファイル")
+    p.add_argument("--repeat", type=int, default=1, help="同一接続での連続送信回数")
+    p.add_argument("--segment-kib", type=int, help="分割書き込みのセグメントサイズ (KiB)。指定するか --size が16MiBを超えると、"
+                                                   "オフセット指定のセグメントに分けて順に書き込み、セグメントごとにステータスを確認する")
+    p.add_argument("--retries", type=int, default=engine.DEFAULT_SEGMENT_RETRIES, help="分割書き込みで失敗したセグメントの再試行回数")
+    p.add_argument("--offset-unit", type=int, default=1, help="オフセット欄の1単位のバイト数 (基板の仕様に合わせる)")
+    p.add_argument("--resume-from", type=int_auto, default=0, help="分割書き込みを再開する位置 (bytes, 中断時に表示される値)")
+    p.add_argument("--verify", action="store_true", help="書き込み後に読み返し、セグメントごとの CRC32 を照合する")
+    p.add_argument("--read-id", type=int_auto, help="読み返しに使うコマンドID (省略時は --id と同じ)")
+    add_rack(p, command=True)
+    p.set_defaults(func=cmd_write)
+
+    p = sub.add_parser("read", help="読み出しコマンド (0x3C) を送信する")
+    add_target(p)
+    p.add_argument("--id", type=int_auto, required=True, help="コマンドID")
+    p.add_argument("--offset", type=int_auto, default=0)
+    p.add_argument("--size", type=int_auto, required=True, help="データサイズ")
+    p.add_argument("--out", help="受信データの保存先")
+    p.add_argument("--repeat", type=int, default=1, help="同一接続での連続送信回数")
+    p.add_argument("--chunk-kib", type=int, default=engine.BULK_CHUNK_SIZE // 1024, help="受信チャンクサイズ (KiB)")
+    p.add_argument("--segment-kib", type=int, help="分割読み出しのセグメントサイズ (KiB)。指定するか --size が16MiBを超えると、"
+                                                   "オフセット指定のセグメントを複数の接続で並列に読み出す")
+    p.add_argument("--concurrency", type=int, default=engine.DEFAULT_CONCURRENCY, help="分割読み出しの同時接続数")
+    p.add_argument("--retries", type=int, default=engine.DEFAULT_SEGMENT_RETRIES, help="分割読み出しで失敗したセグメントの再試行回数")
+    p.add_argument("--offset-unit", type=int, default=1, help="オフセット欄の1単位のバイト数 (基板の仕様に合わせる)")
+    add_rack(p, command=True)
+    p.set_defaults(func=cmd_read)
+
+    p = sub.add_parser("init", help="初期化シーケンスを実行する (基板からの接続を待つ)")
+    p.add_argument("--timeout", type=float, default=300, help="シーケンス全体の制限時間 (秒, --boards 指定時は基板ごと)")
+    add_repeat(p)
+    add_rack(p)
+    p.set_defaults(func=cmd_init)
+
+    scan = argparse.ArgumentParser(add_help=False)
+    scan.add_argument("--param", type=int_auto, default=0x12345678, help="スキャンパラメータ (ID:0x14のデータ)")
+    scan.add_argument("--stage", type=address, default=address("192.168.0.200:8000"), help="FC-511 の IP:ポート")
+    scan.add_argument("--axis", type=int, choices=[1, 2], default=1, help="走査軸")
+    scan.add_argument("--pulses", type=int, default=50000, help="測定移動パルス数")
+    scan.add_argument("--size", type=int_auto, default=43400, help="スキャンデータサイズ (ID:0x54 読み出し)")
+    scan.add_argument("--timeout", type=float, default=600, help="シーケンス全体の制限時間 (秒)")
+
+    p = sub.add_parser("linescan", parents=[scan], help="ラインスキャンを実行する")
+    p.add_argument("--out", help="スキャンデータの保存先")
+    add_repeat(p)
+    add_rack(p)
+    p.set_defaults(func=cmd_linescan)
+
+    p = sub.add_parser("raster", parents=[scan], help="ラスタースキャンを実行する")
+    p.add_argument("--lines", type=int, required=True, help="ライン数")
+    p.add_argument("--step", type=int, required=True, help="ライン間の送り (もう一方の軸, パルス)")
+    p.add_argument("--out", default="raster_scan.npy", help="出力ファイル (.npy)")
+    p.set_defaults(func=cmd_raster)
+
+    p = sub.add_parser("sequence", help="シーケンス定義 (sequence_defs/*.json) を実行する")
+    p.add_argument("definition", help="定義の名前 (sequence_defs/<名前>.json) か定義ファイルのパス")
+    p.add_argument("--set", action="append", metavar="名前=値", help="定義のパラメータを上書きする (複数指定可)")
+    p.add_argument("--stage", type=address, help="FC-511 の IP:ポート (定義でステージを使う場合)")
+    p.add_argument("--out", help="読み出しデータの保存先")
+    p.add_argument("--timeout", type=float, default=600, help="シーケンス全体の制限時間 (秒, --boards 指定時は基板ごと)")
+    add_repeat(p)
+    add_rack(p)
+    p.set_defaults(func=cmd_sequence)
+
+    p = sub.add_parser("aries", help="ARIESステージを移動し、全軸の完了を待つ")
+    add_target(p, "192.168.0.100:2000")
+    p.add_argument("commands", nargs="+", metavar="COMMAND", help="ORG:軸 / MVR:軸,P<パルス数> (複数指定で同時移動)")
+    p.add_argument("--speed", type=int, default=10000, help="移動時間の予測に使う速度 (pulse/s)")
+    p.add_argument("--accel", type=int, default=50000, help="移動時間の予測に使う加減速度 (pulse/s²)")
+    p.add_argument("--timeout", type=float, default=120, help="移動完了の制限時間 (秒)")
+    p.set_defaults(func=cmd_aries)
+
+    p = sub.add_parser("sleep", help="指定秒数待つ (バッチファイル用)")
+    p.add_argument("seconds", type=float)
+    p.set_defaults(func=cmd_sleep)
+
+    if not batch:
+        p = sub.add_parser("batch", help="バッチファイルのコマンドを順に実行する")
+        p.add_argument("file")
+        p.add_argument("--keep-going", action="store_true", help="失敗しても残りのコマンドを続けて実行する")
+        p.set_defaults(func=cmd_batch)
+    return parser
+
+
+def run_command(args, console):
+    try:
+        return args.func(args, console)
+    except Exception as e:
+        console.log("error", f"エラー: {e}")
+        return EXIT_FAILED
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    console = Console(args.quiet)
+    if args.capture:
+        capture.start(args.capture)
+    try:
+        return run_command(args, console)
+    except KeyboardInterrupt:
+        console.log("warning", "中断しました。")
+        return EXIT_FAILED
+    finally:
+        recorder = capture.stop()
+        if recorder:
+            console.log("info", f"送受信を {recorder.path} に記録しました。({recorder.records} レコード, {recorder.bytes:,} bytes)")
+        if args.metrics:
+            metrics.registry.export(args.metrics)
+            console.log("info", f"処理時間の計測結果を {args.metrics} に保存しました。")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+import io
+import os
+import queue
+import socket
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from board_client import get_pool, BULK_CHUNK_SIZE
+from protocol import create_command_packet, decode_status, MAX_24BIT, OP_READ, OP_WRITE
+from stage_client import AriesClient, StageError
+
+# --- 画面に依存しない実行エンジン ---
+# 手動コマンド / 初期化シーケンス / ラインスキャン / ARIESステージ制御を関数として提供し、
+# Streamlit画面 (app.py) とコマンドライン (cli.py) の両方から同じ処理を呼び出す。
+# ログは log(level, message) で通知する (level は log_store.LEVELS のいずれか)。
+# このモジュールからは streamlit / pandas を import しないこと (CLIの起動時間を保つため)。
+
+ManualResult = namedtuple('ManualResult', 'statuses data elapsed')
+# 分割読み出しの結果。statuses はセグメント順、retries は再試行した回数の合計
+SegmentedResult = namedtuple('SegmentedResult', 'statuses data elapsed retries')
+# 分割書き込みの結果。written は基板が受け付けたバイト数 (次に再開する位置)、crc は受け付けた範囲の CRC32、
+# verified は読み返しの照合結果 (照合しなかった場合は None)
+ChunkedWriteResult = namedtuple('ChunkedWriteResult', 'statuses crc elapsed retries written verified')
+
+# シーケンス完了待ちでイベントキューを確認する間隔 (秒)
+SEQUENCE_POLL_INTERVAL = 0.25
+# 分割読み出しの既定値 (セグメントサイズ, 同時接続数, セグメントごとの再試行回数)
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+DEFAULT_SEGMENT_RETRIES = 2
+
+
+def _no_log(level, message):
+    pass
+
+
+class WriteInterrupted(ConnectionError):
+    """分割書き込みが再試行しても続けられなかった (written バイト目から再開できる)"""
+
+    def __init__(self, message, written):
+        super().__init__(message)
+        self.written = written
+
+
+def _send_source(conn, source, data_size, packet, chunk_size, progress):
+    """書き込みデータ (ファイルパス / bytes / バイナリファイルオブジェクト) を先頭から data_size バイト送信する"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return conn.write_stream(f, data_size, chunk_size, progress, packet)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    source.seek(0)
+    return conn.write_stream(source, data_size, chunk_size, progress, packet)
+
+
+def manual_command(address, op_code, command_id, offset, data_size, repeat=1, source=None,
+                   chunk_size=BULK_CHUNK_SIZE, log=_no_log, progress=None, pool=None, out=None):
+    """手動コマンドを同一接続で repeat 回送信し、ManualResult(各回のステータス, 最後の読み出しデータ, 所要秒) を返す
+
+    書き込み (0x3B) は source の先頭から data_size バイトを送信する。
+    読み出しで out (data_size バイトの書き込み可能なバッファ) を指定した場合はそこへ直接受信し、data は out になる。
+    progress には progress(送信済みバイト数, data_size) が呼ばれる (書き込み時のみ)。
+    """
+    packet = create_command_packet(op_code, command_id, offset, data_size)
+    if packet is None:
+        raise ValueError("コマンドパケットを生成できません。ID/オフセット/データサイズを確認してください。")
+    is_write = op_code == OP_WRITE
+    if is_write and source is None:
+        raise ValueError("送信するファイルが選択されていません。")
+    statuses = []
+    data = None
+    start_time = time.perf_counter()
+    # プールした接続を使い回し、連続送信時も1本の接続で完結させる
+    with (pool or get_pool()).connection(address) as conn:
+        if conn.reused: log("info", "既存の接続を再利用します。")
+        for i in range(repeat):
+            if is_write:
+                sent, mb_per_sec = _send_source(conn, source, data_size, packet, chunk_size, progress)
+                log("info", f"{sent} バイトを送信しました。({mb_per_sec:.1f} MB/s)")
+            else:
+                conn.sendall(packet)
+                if out is None:
+                    data, mb_per_sec = conn.read_bulk(data_size, chunk_size)
+                else:
+                    data, mb_per_sec = out, conn.read_into(memoryview(out)[:data_size], chunk_size)
+                log("info", f"{data_size} バイトを受信しました。({mb_per_sec:.1f} MB/s)")
+            status = conn.recv_exact(4)
+            statuses.append(decode_status(status))
+            log("success", f"コマンド成功 ({i + 1}/{repeat})。ステータス: {status.hex()}")
+    elapsed = time.perf_counter() - start_time
+    if repeat > 1:
+        log("info", f"{repeat}回送信完了。平均 {elapsed / repeat * 1000:.2f} ms/コマンド")
+    return ManualResult(statuses, data, elapsed)
+
+
+def plan_segments(data_size, segment_size, offset=0, offset_unit=1):
+    """転送範囲をセグメント [(バッファ内の位置, オフセット欄の値, サイズ), ...] に分割する
+
+    offset と戻り値のオフセット欄の値は offset_unit バイト単位 (基板の仕様に合わせる)。
+    オフセット欄 (24bit) で表せる範囲であれば、合計サイズは1コマンドの上限 (16MiB) を超えてもよい。
+    """
+    if not 0 < segment_size <= MAX_24BIT:
+        raise ValueError(f"セグメントサイズは 1〜{MAX_24BIT} バイトで指定してください: {segment_size}")
+    if offset_unit < 1 or segment_size % offset_unit:
+        raise ValueError(f"セグメントサイズ ({segment_size}) はオフセット単位 ({offset_unit} バイト) の倍数にしてください。")
+    segments = []
+    for start in range(0, data_size, segment_size):
+        field = offset + start // offset_unit
+        if field > MAX_24BIT:
+            raise ValueError(f"オフセットが24bitの範囲を超えます ({field})。データサイズかオフセット単位を確認してください。")
+        segments.append((start, field, min(segment_size, data_size - start)))
+    return segments
+
+
+def segmented_read(address, command_id, data_size, offset=0, segment_size=DEFAULT_SEGMENT_SIZE,
+                   concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_SEGMENT_RETRIES, offset_unit=1,
+                   log=_no_log, progress=None, pool=None, out=None):
+    """大容量の読み出しをオフセット指定のセグメントに分け、複数の接続で並列に読み出して1つのバッファに組み立てる
+
+    各セグメントは事前確保したバッファの該当位置へ直接受信する。通信に失敗したセグメントだけを
+    retries 回まで読み直す (0以外のステータスは基板の応答としてそのまま返す)。
+    progress には progress(受信済みバイト数, data_size) が呼び出し元のスレッドで呼ばれる。
+    out (data_size バイトの書き込み可能なバッファ) を指定した場合はそこへ受信する。
+    """
+    segments = plan_segments(data_size, segment_size, offset, offset_unit)
+    pool = pool or get_pool()
+    buf = bytearray(data_size) if out is None else out
+    view = memoryview(buf)
+
+    def fetch(segment):
+        start, field, size = segment
+        for attempt in range(retries + 1):
+            try:
+                with pool.connection(address) as conn:
+                    conn.sendall(create_command_packet(OP_READ, command_id, field, size))
+                    conn.read_into(view[start:start + size])
+                    return decode_status(conn.recv_exact(4)), attempt
+            except OSError as e:
+                if attempt == retries:
+                    raise ConnectionError(f"セグメント (オフセット {field}, {size} バイト) の読み出しに失敗しました: {e}") from e
+                log("warning", f"セグメント (オフセット {field}) の読み出しに失敗したため再試行します ({attempt + 1}/{retries}): {e}")
+
+    workers = max(1, min(concurrency, len(segments)))
+    log("info", f"{data_size} バイトを {len(segments)} セグメントに分け、{workers} 本の接続で読み出します。")
+    statuses = [None] * len(segments)
+    received = retried = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="SegmentedRead") as executor:
+        futures = {executor.submit(fetch, segment): i for i, segment in enumerate(segments)}
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                statuses[i], attempts = future.result()
+                retried += attempts
+                received += segments[i][2]
+                if progress: progress(received, data_size)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    elapsed = time.perf_counter() - start_time
+    mb_per_sec = data_size / elapsed / 1e6 if elapsed > 0 else float('inf')
+    log("info", f"{data_size} バイトを受信しました。({mb_per_sec:.1f} MB/s, 再試行 {retried} 回)")
+    return SegmentedResult(statuses, buf, elapsed, retried)
+
+
+def _open_source(source):
+    """書き込みデータ (ファイルパス / bytes / バイナリファイルオブジェクト) をシークできるファイルとして返す"""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+def _read_segment(f, start, view):
+    f.seek(start)
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            raise ValueError(f"送信するファイルのサイズが不足しています ({start + filled} bytes で終了)")
+        filled += n
+
+
+def chunked_write(address, command_id, source, data_size, offset=0, segment_size=DEFAULT_SEGMENT_SIZE,
+                  retries=DEFAULT_SEGMENT_RETRIES, offset_unit=1, resume_from=0, verify=False, read_id=None,
+                  log=_no_log, progress=None, pool=None):
+    """大容量の書き込みをオフセット指定のセグメントに分けて先頭から順に送信し、ChunkedWriteResult を返す
+
+    セグメントごとにステータスを確認し、通信に失敗した場合は接続し直して失敗したセグメントから
+    retries 回まで送り直す (1回成功するごとに回数は戻る)。0以外のステータスを受信した時点で中断する。
+    再試行しても続けられない場合は WriteInterrupted (written = 再開位置) を送出するため、
+    resume_from に渡せば送信済みの範囲を送り直さずに再開できる。
+    CRC32 は送信しながら計算し、verify=True の場合は read_id (省略時は command_id) で読み返して照合する。
+    """
+    segments = plan_segments(data_size, segment_size, offset, offset_unit)
+    if resume_from % segment_size or not 0 <= resume_from <= data_size:
+        raise ValueError(f"再開位置 ({resume_from}) はセグメントサイズ ({segment_size}) の倍数で、データサイズ以下にしてください。")
+    pool = pool or get_pool()
+    buf = bytearray(min(segment_size, data_size) or 1)
+    view = memoryview(buf)
+    statuses = []
+    crcs = []
+    crc = 0
+    written = resume_from
+    retried = failures = 0
+    f = _open_source(source)
+    try:
+        # 送信済みの範囲は送らず、照合用の CRC だけを計算しておく
+        for start, field, size in segments:
+            if start >= resume_from:
+                break
+            _read_segment(f, start, view[:size])
+            crcs.append(zlib.crc32(view[:size]))
+            crc = zlib.crc32(view[:size], crc)
+        first = len(crcs)
+        if resume_from:
+            log("info", f"{resume_from} バイト目 (セグメント {first + 1}/{len(segments)}) から再開します。")
+        log("info", f"{data_size} バイトを {len(segments)} セグメントに分けて書き込みます。")
+        start_time = time.perf_counter()
+        i = first
+        loaded = None
+        while i < len(segments):
+            try:
+                with pool.connection(address) as conn:
+                    while i < len(segments):
+                        start, field, size = segments[i]
+                        chunk = view[:size]
+                        if loaded != i:
+                            _read_segment(f, start, chunk)
+                            loaded = i
+                        conn.sendall(create_command_packet(OP_WRITE, command_id, field, size))
+                        conn.sendall(chunk)
+                        status = decode_status(conn.recv_exact(4))
+                        statuses.append(status)
+                        if status != 0:
+                            log("error", f"セグメント (オフセット {field}) でエラーステータス {status:#010x} を受信したため中断します。")
+                            return ChunkedWriteResult(statuses, crc, time.perf_counter() - start_time, retried, written, None)
+                        crcs.append(zlib.crc32(chunk))
+                        crc = zlib.crc32(chunk, crc)
+                        written = start + size
+                        failures = 0
+                        i += 1
+                        if progress: progress(written, data_size)
+            except OSError as e:
+                failures += 1
+                if failures > retries:
+                    raise WriteInterrupted(f"{written} バイト目以降の書き込みに失敗しました (再開位置 {written}): {e}", written) from e
+                retried += 1
+                log("warning", f"セグメント (オフセット {segments[i][1]}) の書き込みに失敗したため再試行します ({failures}/{retries}): {e}")
+    finally:
+        if f is not source:
+            f.close()
+    elapsed = time.perf_counter() - start_time
+    mb_per_sec = (data_size - resume_from) / elapsed / 1e6 if elapsed > 0 else float('inf')
+    log("info", f"{data_size - resume_from} バイトを送信しました。({mb_per_sec:.1f} MB/s, 再試行 {retried} 回, CRC32 {crc:08x})")
+    verified = None
+    if verify:
+        result = segmented_read(address, command_id if read_id is None else read_id, data_size, offset, segment_size,
+                                retries=retries, offset_unit=offset_unit, log=log, pool=pool)
+        readback = memoryview(result.data)
+        mismatched = [field for (start, field, size), expected, status in zip(segments, crcs, result.statuses)
+                      if status != 0 or zlib.crc32(readback[start:start + size]) != expected]
+        verified = not mismatched
+        if verified:
+            log("success", f"読み返したデータの CRC32 が一致しました。({crc:08x})")
+        else:
+            log("error", f"読み返したデータが一致しないセグメントがあります ({len(mismatched)}/{len(segments)}): オフセット {mismatched[0]} など")
+    return ChunkedWriteResult(statuses, crc, elapsed, retried, written, verified)
+
+
+def run_sequence(sequence, timeout=None, on_event=None, listener=None):
+    """シーケンスを開始し、終了するまでイベントを on_event(kind, value) に渡しながら待つ
+
+    最終フェーズ ("完了" / "エラー" など) を返す。timeout 秒を過ぎた場合は停止して TimeoutError。
+    listener は複数基板で共有するリスナー (rack.py から使う)。
+    """
+    sequence.start(listener)
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        while True:
+            # イベントが続けて届いている間も制限時間を確認する
+            if deadline and sequence.running and time.monotonic() > deadline:
+                raise TimeoutError(f"シーケンスが {timeout} 秒以内に終了しませんでした (フェーズ: {sequence.phase})")
+            try:
+                # 終了後は残りのイベントだけを取り出す (次のイベントを待たない)
+                event = sequence.events.get(timeout=SEQUENCE_POLL_INTERVAL if sequence.running else 0)
+            except queue.Empty:
+                if not sequence.running:
+                    break
+                continue
+            if on_event:
+                on_event(*event)
+    finally:
+        sequence.stop()
+    return sequence.phase
+
+
+def parse_aries_move(command):
+    """"ORG:1" / "MVR:2,P1000" を (軸, コマンド, パルス数 or None) に変換する"""
+    try:
+        name, args = command.split(":", 1)
+        axis, *rest = args.split(",")
+        pulses = int(rest[0].lstrip("Pp")) if name.upper() == "MVR" and rest else None
+        return int(axis), command, pulses
+    except ValueError:
+        raise ValueError(f"ARIESのコマンドを解釈できません: {command}") from None
+
+
+def aries_moves(ip, port, moves, estimator=None, log=_no_log, timeout=120):
+    """ARIESで複数軸の移動 [(軸, セットアップコマンド, パルス数 or None), ...] を同時に開始し、全軸の完了を待つ
+
+    移動記録 (MoveRecord) のリストを返す。失敗時は例外 (describe_stage_error で文言に変換できる)。
+    """
+    log("info", f"ステージ ({ip}:{port}) へ接続します...")
+    with AriesClient(ip, port, timeout=5) as aries: # 5秒で接続タイムアウト
+        for axis, setup_command, pulses in moves:
+            estimated = estimator.estimate(axis, pulses) if estimator else None
+            estimate_text = f"予測 {estimated:.2f}秒" if estimated is not None else "予測なし"
+            log("info", f"コマンド送信: {setup_command} / G ({estimate_text}、?S:{axis}でポーリング)")
+        aries.settimeout(30) # ポーリングのタイムアウトは長めに
+        records = aries.move_axes(moves, estimator, timeout=timeout)
+        for record in records:
+            log("info", f"軸{record.axis}の動作が完了しました。(実測 {record.actual:.2f}秒, ポーリング {record.polls}回)")
+        if len(records) > 1:
+            log("info", f"全{len(records)}軸の動作が完了しました。")
+        return records
+
+
+def describe_stage_error(e):
+    """ステージ通信の例外を画面/CLI向けのメッセージに変換する"""
+    if isinstance(e, StageError):
+        return f"エラー: {e}"
+    if isinstance(e, socket.timeout):
+        return "エラー: ステージへの接続/通信がタイムアウトしました。"
+    if isinstance(e, ConnectionRefusedError):
+        return "エラー: ステージへの接続が拒否されました。IP/ポートを確認してください。"
+    return f"エラー: ステージとの通信中に予期せぬエラーが発生しました。 {e}"
@@ -0,0 +1,100 @@
+import socket
+import threading
+from protocol import FrameReader
+import capture
+
+# --- 基板からの接続を受け付けるバックグラウンドサービス ---
+# Streamlitの再実行サイクルとは独立したスレッドで accept し、届いたフレームを
+# その場でハンドラ (シーケンス処理) に渡す。1つの接続で複数のフレームを受け付ける。
+
+APP_SERVER_ADDRESS = ('127.0.0.1', 60201)
+
+class BoardListener:
+    """基板からの接続を待ち受け、受信したフレームごとに handler(frame) を呼び出す
+
+    route を指定した場合は接続ごとに route(addr) を呼び、返された (handler, on_error) でその接続を処理する
+    (複数の基板が同じポートへ報告するラック運用向け。未登録の接続元は route が例外を送出して閉じる)。
+    """
+
+    def __init__(self, handler, address=APP_SERVER_ADDRESS, on_error=None, on_connect=None, route=None):
+        self.handler = handler
+        self.address = address
+        self.on_error = on_error
+        self.on_connect = on_connect
+        self.route = route
+        self._server = None
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stopped.is_set()
+
+    def start(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind(self.address); server.listen(5)
+        except OSError:
+            server.close()
+            raise
+        self._server = server
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._accept_loop, name=f"BoardListener-{self.address[1]}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """待ち受けを終了し、受付中の接続もすべて閉じる (ハンドラ内から呼んでもよい)"""
+        self._stopped.set()
+        if self._server:
+            # accept() で待機中のスレッドを起こしてから閉じる (close だけでは待ち受けが残り、ポートを再利用できない)
+            try:
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+        with self._lock:
+            for conn in list(self._connections):
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                conn.close()
+            self._connections.clear()
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                conn, addr = self._server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                if self._stopped.is_set():
+                    conn.close()
+                    break
+                self._connections.add(conn)
+            threading.Thread(target=self._serve, args=(conn, addr), daemon=True).start()
+
+    def _serve(self, conn, addr):
+        sock = capture.wrap(conn, "board", addr, accepted=True)
+        if self.on_connect:
+            self.on_connect(addr)
+        handler, on_error = self.handler, self.on_error
+        try:
+            if self.route:
+                handler, on_error = self.route(addr)
+            # 1回の受信で複数フレームをまとめて取り込み、バッファから切り出して処理する
+            for frame in FrameReader(sock).frames():
+                if self._stopped.is_set():
+                    break
+                handler(frame)
+        except Exception as e:
+            if not self._stopped.is_set() and on_error:
+                on_error(e)
+        finally:
+            with self._lock:
+                self._connections.discard(conn)
+            sock.close()
@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+from collections import deque, namedtuple
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+# --- 各タブ共通のログ保管 ---
+# ログは上限付きの deque に構造化して保持し (古いものから捨てる)、同時にローテーションする
+# ログファイルへ書き出す。画面には絞り込み後の1ページ分だけを表示する。
+
+MAX_ENTRIES = 5000
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+LOG_FILE = "jigu_tool.log"
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+LEVELS = ("info", "success", "warning", "error")
+_FILE_LEVELS = {"info": logging.INFO, "success": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+LogEntry = namedtuple('LogEntry', 'timestamp tab level message')
+
+_file_logger = None
+_file_logger_lock = threading.Lock()
+
+
+def get_file_logger(log_dir=LOG_DIR, filename=LOG_FILE, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """ログファイル出力用の logger を返す (再実行のたびにハンドラが増えないよう、プロセス内で1つだけ作る)
+
+    ログディレクトリを作成できない場合は None (メモリ上のみで保持する)。
+    """
+    global _file_logger
+    with _file_logger_lock:
+        if _file_logger is None:
+            try:
+                os.makedirs(log_dir, exist_ok=True)
+                handler = RotatingFileHandler(os.path.join(log_dir, filename), maxBytes=max_bytes,
+                                              backupCount=backup_count, encoding="utf-8")
+            except OSError:
+                return None
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("jigu_tool")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _file_logger = logger
+        return _file_logger
+
+
+class LogStore:
+    """(時刻, タブ, レベル, メッセージ) を上限付きで保持するログ置き場 (スレッドセーフ)"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, file_logger=None):
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        self.file_logger = file_logger
+
+    def add(self, tab, level, message, timestamp=None):
+        entry = LogEntry(timestamp or datetime.now(), tab, level, message)
+        with self._lock:
+            self._entries.append(entry)
+        if self.file_logger:
+            self.file_logger.log(_FILE_LEVELS.get(level, logging.INFO),
+                                 f"{entry.timestamp:%Y-%m-%d %H:%M:%S.%f} [{tab}] {level.upper()} {message}")
+        return entry
+
+    def clear(self, tab=None):
+        """指定タブのログを画面表示用の保管分から消す (ファイルには残る)"""
+        with self._lock:
+            if tab is None:
+                self._entries.clear()
+            else:
+                kept = [e for e in self._entries if e.tab != tab]
+                self._entries.clear()
+                self._entries.extend(kept)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def page(self, tab=None, levels=None, text="", page=0, page_size=50):
+        """条件に合うログを新しい順に数え、page 番目 (0始まり) の1ページ分と総件数を返す"""
+        with self._lock:
+            entries = list(self._entries)
+        start = page * page_size
+        matched = []
+        total = 0
+        for entry in reversed(entries):
+            if tab is not None and entry.tab != tab: continue
+            if levels is not None and entry.level not in levels: continue
+            if text and text not in entry.message: continue
+            if start <= total < start + page_size:
+                matched.append(entry)
+            total += 1
+        return matched, total
+
+
+def format_entry(entry):
+    return f"[{entry.timestamp:%H:%M:%S}] {entry.message}"
@@ -0,0 +1,170 @@
+import bisect
+import csv
+import io
+import threading
+import time
+
+# --- 処理時間の計測 (タイマー / ヒストグラム) ---
+# 通信・シーケンス・ステージの各段階の所要時間を名前とラベルごとのヒストグラムに集計する。
+# 1回の記録はバケットの加算だけで済むため、通信処理の中で常時計測しても負荷はほとんど無い。
+# 集計結果は画面 (サイドバーの「計測」) やCLIの --metrics から CSV / Prometheus テキスト形式で出力する。
+#
+#   with metrics.timer("board_send", endpoint="127.0.0.1:60202"):
+#       sock.sendall(packet)
+#   metrics.observe("stage_wait", record.actual, controller="fc511", axis=1)
+
+# バケットの上限 (秒)。1回の送受信 (0.1ms〜) からステージ移動 (数十秒) までを1種類で扱う
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = "jigu_"
+
+# 計測項目の説明 (Prometheus の HELP と画面の表示に使う)
+DESCRIPTIONS = {
+    "board_connect": "基板への接続 (TCPハンドシェイク)",
+    "board_send": "基板へのコマンド送信",
+    "board_recv": "基板からのステータス等の受信 (基板の応答待ちを含む)",
+    "board_bulk_read": "基板からの大容量データ受信",
+    "board_bulk_write": "基板への大容量データ送信",
+    "sequence_wait": "状態ごとの基板からの報告待ち (基板の処理時間)",
+    "sequence_reaction": "基板からの報告を受けてからアプリの処理 (指令送信等) を終えるまで",
+    "stage_command": "ステージへのセットアップコマンド + G の送信と応答",
+    "stage_poll": "ステージへの状態問い合わせ1回 (!: / ?S)",
+    "stage_wait": "ステージの移動完了待ち (G から停止確認まで)",
+}
+
+
+class Histogram:
+    """1つの計測項目 (名前 + ラベル) の件数・合計・最小/最大・バケットごとの件数"""
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min: self.min = seconds
+        if seconds > self.max: self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q):
+        """バケットから分位点を推定する (バケット内は線形補間し、最小/最大値の範囲に収める)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                value = lower + (upper - lower) * (rank - seen) / n
+                return min(max(value, self.min), self.max)
+            seen += n
+        return self.max
+
+
+class Registry:
+    """計測項目の集まり (スレッドセーフ)"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def items(self):
+        """[(名前, ラベルのタプル, Histogram), ...] を名前・ラベル順に返す"""
+        with self._lock:
+            return sorted((name, labels, histogram) for (name, labels), histogram in self._histograms.items())
+
+    def rows(self):
+        """表示・CSV用の行 (dict) のリスト。時間はミリ秒"""
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+        return [{"項目": name, "ラベル": ", ".join(f"{k}={v}" for k, v in labels), "件数": h.count,
+                 "合計 (ms)": ms(h.total), "平均 (ms)": ms(h.total / h.count), "最小 (ms)": ms(h.min),
+                 "p50 (ms)": ms(h.quantile(0.5)), "p90 (ms)": ms(h.quantile(0.9)), "p99 (ms)": ms(h.quantile(0.99)),
+                 "最大 (ms)": ms(h.max)} for name, labels, h in self.items()]
+
+    def to_csv(self):
+        rows = self.rows()
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=list(rows[0]) if rows else ["項目"])
+        writer.writeheader()
+        writer.writerows(rows)
+        return out.getvalue()
+
+    def to_prometheus(self):
+        """Prometheus テキスト形式 (histogram, 単位は秒)"""
+        lines = []
+        last_name = None
+        for name, labels, h in self.items():
+            metric = f"{PREFIX}{name}_seconds"
+            if name != last_name:
+                lines.append(f"# HELP {metric} {DESCRIPTIONS.get(name, name)}")
+                lines.append(f"# TYPE {metric} histogram")
+                last_name = name
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (float("inf"),), h.buckets):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{{label_text + "," if label_text else ""}le="{le}"}} {cumulative}')
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{metric}_sum{suffix} {h.total!r}")
+            lines.append(f"{metric}_count{suffix} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """拡張子が .csv なら CSV、それ以外は Prometheus テキスト形式で保存する"""
+        text = self.to_csv() if path.lower().endswith(".csv") else self.to_prometheus()
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Timer:
+    """with ブロックの所要時間を記録する"""
+
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 失敗した処理は所要時間の分布に含めない
+        if exc_type is None:
+            self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+# プロセス内で共有する集計先
+registry = Registry()
+observe = registry.observe
+timer = registry.timer
+reset = registry.reset
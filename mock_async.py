@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import functools
+import os
+import threading
+import time
+from protocol import HEADER_SIZE, MAX_24BIT, OP_READ, OP_WRITE, decode_header, encode_status
+
+# --- 負荷試験用の模擬制御基板 (asyncio版) ---
+# 1プロセスで複数ポート (複数基板) を待ち受け、各ポートで多数の接続を同時に処理する。
+# 読み出しデータは事前に作ったパターンバッファを memoryview で切り出して返すため、
+# 16MiB の読み出しでもデータ生成のコストがかからない。
+# 書き込まれたデータはコマンドIDごとに保持し、同じIDの読み出しではそれを返す (書き込みの読み返し照合用)。
+#
+#   python mock_async.py --ports 60200 60202 --quiet
+#   python mock_async.py --boards 8 --latency 0.001 --command-latency 0x54=0.2
+
+HOST = '127.0.0.1'
+DEFAULT_PORTS = [60200]
+# 書き込みデータを受信する単位
+RECEIVE_CHUNK = 1024 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def get_pattern(name="ramp"):
+    """読み出し用のパターンバッファ (24bit最大サイズ + 256 バイト) を返す
+
+    ramp はオフセット o のバイトが o % 256 となるパターン (mock_server.py のダミーデータと同じ)。
+    オフセット付きの読み出しにも同じ値が返るよう、先頭 (オフセットのバイト位置) % 256 バイトずらして切り出す。
+    """
+    size = MAX_24BIT + 1 + 256
+    if name == "ramp":
+        return memoryview(bytes(range(256)) * (size // 256))
+    if name == "zeros":
+        return memoryview(bytes(size))
+    if name == "random":
+        return memoryview(os.urandom(size))
+    raise ValueError(f"不明なパターンです: {name}")
+
+
+class BoardMemory:
+    """書き込まれたデータをコマンドIDごとに保持し、同じIDの読み出しで返す (スレッドセーフ)
+
+    位置はバイト単位 (オフセット欄の値 × オフセット単位)。書き込まれていない範囲は
+    読み出しパターンのまま返すため、分割書き込みの読み返し照合 (--verify) にそのまま使える。
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._data = {}  # コマンドID -> 先頭から書き込み済みの末尾までのデータ
+        self._lock = threading.Lock()
+
+    def _pattern_at(self, start, size):
+        """バイト位置 start から size バイト分のパターン (パターンバッファより長い場合はつなげる)"""
+        if size <= len(self.pattern) - 256:
+            return self.pattern[start % 256:start % 256 + size]
+        out = bytearray()
+        while len(out) < size:
+            pos = (start + len(out)) % 256
+            out += self.pattern[pos:pos + min(size - len(out), len(self.pattern) - 256)]
+        return out
+
+    def write(self, command_id, start, data):
+        with self._lock:
+            buf = self._data.setdefault(command_id, bytearray())
+            end = start + len(data)
+            if len(buf) < end:
+                buf += self._pattern_at(len(buf), end - len(buf))
+            buf[start:end] = data
+
+    def read(self, command_id, start, size):
+        with self._lock:
+            buf = self._data.get(command_id)
+            if buf is None or start >= len(buf):
+                return self._pattern_at(start, size)
+            data = bytes(buf[start:start + size])
+        if len(data) < size:
+            data += self._pattern_at(start + len(data), size - len(data))
+        return data
+
+
+class BoardStats:
+    def __init__(self):
+        self.connections = 0
+        self.active = 0
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def summary(self):
+        return (f"接続 {self.connections} (同時 {self.active}), フレーム {self.frames}, "
+                f"受信 {self.bytes_in / 1e6:.1f} MB, 送信 {self.bytes_out / 1e6:.1f} MB")
+
+
+class MockBoard:
+    """1ポート分の模擬基板。コマンドごとに (指定があれば待ってから) ステータスを返す"""
+
+    def __init__(self, port, host=HOST, pattern="ramp", latency=0.0, command_latency=None, status=0, quiet=False,
+                 offset_unit=1):
+        self.host = host
+        self.port = port
+        self.pattern = get_pattern(pattern)
+        self.memory = BoardMemory(self.pattern)
+        self.offset_unit = offset_unit  # オフセット欄の1単位のバイト数 (分割読み出しの --offset-unit に合わせる)
+        self.latency = latency
+        self.command_latency = command_latency or {}
+        self.status = encode_status(status)
+        self.quiet = quiet
+        self.stats = BoardStats()
+        self.server = None
+        self._tasks = set()
+
+    def log(self, message):
+        if not self.quiet:
+            print(f"[{time.strftime('%H:%M:%S')}] [:{self.port}] {message}")
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True)
+        self.log("待機中...")
+        return self
+
+    async def close(self):
+        """待ち受けを終了し、処理中の接続もすべて閉じる"""
+        if self.server:
+            self.server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        stats = self.stats
+        stats.connections += 1; stats.active += 1
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        addr = writer.get_extra_info('peername')
+        self.log(f"接続: {addr}")
+        try:
+            while True:
+                try:
+                    header = decode_header(await reader.readexactly(HEADER_SIZE))
+                except asyncio.IncompleteReadError:
+                    break
+                stats.frames += 1
+                stats.bytes_in += HEADER_SIZE
+                delay = self.command_latency.get(header.command_id, self.latency)
+                if header.op_code == OP_WRITE and header.data_size:
+                    await self._receive(reader, header)
+                if delay:
+                    await asyncio.sleep(delay)
+                if header.op_code == OP_READ:
+                    writer.write(self.memory.read(header.command_id, header.offset * self.offset_unit, header.data_size))
+                    stats.bytes_out += header.data_size
+                writer.write(self.status)
+                stats.bytes_out += len(self.status)
+                await writer.drain()
+                self.log(f"OP:{header.op_code:#04x} ID:{header.command_id:#04x} オフセット:{header.offset} サイズ:{header.data_size}")
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self.log(f"切断: {addr} ({e})")
+        except asyncio.CancelledError:
+            pass  # close() による終了
+        finally:
+            stats.active -= 1
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _receive(self, reader, header):
+        """書き込みデータを受信し、同じIDの読み出しで返せるように memory に保持する"""
+        start = header.offset * self.offset_unit
+        received = 0
+        while received < header.data_size:
+            chunk = await reader.read(min(RECEIVE_CHUNK, header.data_size - received))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', header.data_size - received)
+            self.memory.write(header.command_id, start + received, chunk)
+            received += len(chunk)
+        self.stats.bytes_in += header.data_size
+
+
+async def start_boards(ports, **options):
+    return [await MockBoard(port, **options).start() for port in ports]
+
+
+class BoardServerThread:
+    """別スレッドのイベントループで模擬基板群を動かす (ベンチマーク等から使う)"""
+
+    def __init__(self, ports, **options):
+        self.loop = asyncio.new_event_loop()
+        self.boards = []
+        self._thread = threading.Thread(target=self.loop.run_forever, name="MockAsyncBoards", daemon=True)
+        self._thread.start()
+        self.boards = asyncio.run_coroutine_threadsafe(start_boards(ports, **options), self.loop).result()
+
+    def stop(self):
+        async def close_all():
+            for board in self.boards:
+                await board.close()
+        asyncio.run_coroutine_threadsafe(close_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+def parse_command_latency(values):
+    """["0x54=0.2", "1=0.01"] を {コマンドID: 秒} に変換する"""
+    latency = {}
+    for value in values or []:
+        command_id, seconds = value.split("=", 1)
+        latency[int(command_id, 0)] = float(seconds)
+    return latency
+
+
+async def main(args):
+    ports = args.ports or [args.base_port + i for i in range(args.boards)]
+    options = dict(host=args.host, pattern=args.pattern, latency=args.latency,
+                   command_latency=parse_command_latency(args.command_latency), status=args.status, quiet=args.quiet,
+                   offset_unit=args.offset_unit)
+    boards = await start_boards(ports, **options)
+    print(f"模擬制御基板 (asyncio) を起動しました: {args.host} ポート {', '.join(map(str, ports))}")
+    try:
+        while True:
+            await asyncio.sleep(args.stats_interval or 3600)
+            if args.stats_interval:
+                for board in boards:
+                    print(f"[:{board.port}] {board.stats.summary()}")
+    finally:
+        for board in boards:
+            print(f"[:{board.port}] {board.stats.summary()}")
+            await board.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="負荷試験用の模擬制御基板 (asyncio版)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--ports", type=int, nargs="*", help="待ち受けるポート (複数指定可)")
+    parser.add_argument("--boards", type=int, default=1, help="--ports 未指定時に起動する基板数 (--base-port から連番)")
+    parser.add_argument("--base-port", type=int, default=DEFAULT_PORTS[0])
+    parser.add_argument("--pattern", choices=["ramp", "zeros", "random"], default="ramp", help="読み出しデータのパターン")
+    parser.add_argument("--latency", type=float, default=0.0, help="全コマンド共通の応答遅延 (秒)")
+    parser.add_argument("--command-latency", nargs="*", metavar="ID=SEC", help="コマンドIDごとの応答遅延 (例: 0x54=0.2)")
+    parser.add_argument("--status", type=lambda v: int(v, 0), default=0, help="返すステータス値")
+    parser.add_argument("--offset-unit", type=int, default=1, help="オフセット欄の1単位のバイト数 (読み書きするデータの位置の計算に使う)")
+    parser.add_argument("--stats-interval", type=float, default=0.0, help="統計を表示する間隔 (秒, 0 で終了時のみ)")
+    parser.add_argument("--quiet", action="store_true", help="フレームごとのログを出さない")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        print("\nCtrl+C が押されました。サーバーを終了します。")
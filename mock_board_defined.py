@@ -0,0 +1,111 @@
+import argparse
+import socket
+import time
+import threading
+import queue
+from board_client import BoardConnectionPool
+from protocol import FrameReader, OP_READ, encode_report, encode_status
+from mock_async import get_pattern
+from sequence_def import load_definition, board_script, parse_params
+
+# --- シーケンス定義で動く模擬制御基板 ---
+# sequence_defs/*.json の正常系 (各状態の最初の遷移) をたどり、アプリからのコマンドを待っては報告を返す。
+# 報告の前の待ち時間は定義の "delay" (基板の内部処理の模擬) だけで、--delay-scale 0 なら待ち時間なしで動く。
+#
+#   python mock_board_defined.py init
+#   python mock_board_defined.py linescan --delay-scale 0 --loop 0
+#   python mock_board_defined.py my_sequence.json --set size=1024
+
+HOST_APP_IP = '127.0.0.1'
+HOST_APP_PORT = 60201  # アプリのサーバーポート
+BOARD_SERVER_PORT = 60202 # 基板自身のサーバーポート
+
+# アプリへの報告用接続 (報告ごとに接続し直さず使い回す)
+app_pool = BoardConnectionPool()
+received_commands = queue.Queue()
+
+
+def handle_host(conn, addr):
+    """ホストアプリからの1接続を処理する。読み出しにはランプパターンを返し、全コマンドにステータス0を返す"""
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            for frame in FrameReader(conn).frames(with_status=False):
+                if frame.op_code == OP_READ:
+                    print(f"[基板サーバー] 読み出しコマンド(ID:{hex(frame.command_id)}, {frame.data_size} bytes)を受信しました。")
+                    conn.sendall(get_pattern("ramp")[:frame.data_size])
+                else:
+                    print(f"[基板サーバー] コマンド(ID:{hex(frame.command_id)}, Data:{hex(frame.data_value or 0)})を受信しました。")
+                conn.sendall(encode_status(0))
+                received_commands.put(frame.command_id)
+        except ConnectionError:
+            pass
+
+
+def board_server(s):
+    while True:
+        try:
+            conn, addr = s.accept()
+        except OSError:
+            return
+        threading.Thread(target=handle_host, args=(conn, addr), daemon=True).start()
+
+
+def send_to_app(command_id, data_value):
+    with app_pool.connection((HOST_APP_IP, HOST_APP_PORT)) as conn:
+        conn.sendall(encode_report(command_id, data_value))
+    print(f"[基板クライアント] -> アプリへ ID:{hex(command_id)}, Data:{hex(data_value)} を送信しました。")
+
+
+def run_script(steps, delay_scale, timeout):
+    for step in steps:
+        if step[0] == "expect":
+            expected_id = step[1]
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    cmd_id = received_commands.get(timeout=max(remaining, 0))
+                except queue.Empty:
+                    raise TimeoutError(f"アプリからのコマンド(ID:{hex(expected_id)})が {timeout}秒以内に届きませんでした。") from None
+                if cmd_id == expected_id:
+                    break
+                print(f"[基板サーバー] 想定外のコマンド(ID:{hex(cmd_id)})を受信しました。無視します。")
+        else:
+            _, command_id, data_value, delay = step
+            if delay and delay_scale:
+                time.sleep(delay * delay_scale) # 基板の内部処理を模擬
+            send_to_app(command_id, data_value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模擬制御基板 (シーケンス定義で動作)")
+    parser.add_argument("definition", help="定義の名前 (sequence_defs/<名前>.json) か定義ファイルのパス")
+    parser.add_argument("--set", action="append", metavar="名前=値", help="定義のパラメータを上書きする (複数指定可)")
+    parser.add_argument("--delay-scale", type=float, default=1.0, help="定義の delay に掛ける倍率 (0 で待ち時間なし)")
+    parser.add_argument("--loop", type=int, default=1, help="シーケンスの繰り返し回数 (0 で無制限)")
+    parser.add_argument("--timeout", type=float, default=60, help="アプリからのコマンドを待つ制限時間 (秒)")
+    parser.add_argument("--app-port", type=int, default=HOST_APP_PORT, help="報告先のアプリのポート (ラック試験で基板ごとに分ける)")
+    parser.add_argument("--board-port", type=int, default=BOARD_SERVER_PORT, help="基板自身のサーバーポート")
+    args = parser.parse_args()
+    HOST_APP_PORT, BOARD_SERVER_PORT = args.app_port, args.board_port
+
+    definition = load_definition(args.definition)
+    steps = board_script(definition, parse_params(args.set))
+    print(f"===== 模擬制御基板 ({definition.get('name', args.definition)}) 起動 =====")
+    print(f"[基板サーバー] IP: 127.0.0.1, Port: {BOARD_SERVER_PORT} で待機中...")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('127.0.0.1', BOARD_SERVER_PORT))
+        s.listen()
+        threading.Thread(target=board_server, args=(s,), daemon=True).start()
+
+        count = 0
+        while args.loop == 0 or count < args.loop:
+            count += 1
+            print(f"\n===== {count} 回目 =====")
+            run_script(steps, args.delay_scale, args.timeout)
+
+    app_pool.close_all()
+    print(f"\n===== 模擬制御基板 ({definition.get('name', args.definition)}) 処理完了 =====")
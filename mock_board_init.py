@@ -1,88 +1,140 @@
+import argparse
 import socket
-import struct
 import time
 import threading
+from board_client import BoardConnectionPool
+from protocol import FrameReader, encode_report, encode_status
+import mock_scenario
+from mock_scenario import RunAborted
 
 # --- 共通の関数と定数 ---
 HOST_APP_IP = '127.0.0.1'
 HOST_APP_PORT = 60201 # アプリのサーバーポート
 BOARD_SERVER_PORT = 60202 # 基板自身のサーバーポート
 
-def create_command_packet(op_code, command_id, offset, data_size):
-    # (app.pyと同じ関数)
-    try:
-        offset_b2 = (offset >> 16) & 0xFF; offset_b1 = (offset >> 8) & 0xFF; offset_b0 = offset & 0xFF
-        size_b2 = (data_size >> 16) & 0xFF; size_b1 = (data_size >> 8) & 0xFF; size_b0 = data_size & 0xFF
-        packet_values = (op_code, 0x00, command_id, offset_b2, offset_b1, offset_b0, size_b2, size_b1, size_b0, 0x00, 0x00, 0x00)
-        return struct.pack('!BBBBBBBBBBBB', *packet_values)
-    except: return None
+# ホストアプリへの報告用接続 (報告ごとに接続し直さず使い回す)
+# 繰り返し実行では接続が閉じられたことで回の終わりを知るため、待ち時間が長くても接続を破棄しない
+app_pool = BoardConnectionPool(idle_timeout=float("inf"))
+# 待ち時間と応答の崩し方 (mock_scenario.py)
+scenario = mock_scenario.Scenario()
 
 # --- 基板のサーバー機能 ---
 # (ホストアプリからの状態遷移指令を受信するために別スレッドで動作)
 command_received = threading.Event()
+command_failed = threading.Event() # 指令にエラーステータスを返した (その回を打ち切る)
+
+def handle_host(conn, addr):
+    """ホストアプリからの1接続を処理する。接続が閉じられるまで複数の指令を受け付ける"""
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"[基板サーバー] ホストアプリ {addr} から接続あり。")
+        try:
+            for frame in FrameReader(conn).frames(with_status=False):
+                data_val = frame.data_value or 0
+                print(f"[基板サーバー] 状態遷移指令(->{hex(data_val)})を受信しました。")
+                # ステータスを返信 (シナリオが error-status ならエラーステータス)
+                status = scenario.status(frame.command_id)
+                conn.sendall(encode_status(status))
+                if status != 0:
+                    command_failed.set()
+                    command_received.set()
+                elif data_val == 0x2E:
+                    command_received.set() # メインスレッドに通知
+        except ConnectionError:
+            pass
+        print(f"[基板サーバー] ホストアプリ {addr} との接続を閉じました。")
 
 def board_server():
-    print("[基板サーバー] 起動します。IP: 127.0.0.1, Port: 60202")
+    print(f"[基板サーバー] 起動します。IP: 127.0.0.1, Port: {BOARD_SERVER_PORT}")
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(('127.0.0.1', BOARD_SERVER_PORT))
         s.listen()
-        conn, addr = s.accept()
-        with conn:
-            print(f"[基板サーバー] ホストアプリ {addr} から接続あり。")
-            cmd = conn.recv(12)
-            data = conn.recv(4)
-            data_val = struct.unpack('!I', data)[0]
-            print(f"[基板サーバー] 状態遷移指令(->{hex(data_val)})を受信しました。")
-            # ステータス(0)を返信
-            conn.sendall(struct.pack('!I', 0))
-            command_received.set() # メインスレッドに通知
+        while True:
+            conn, addr = s.accept()
+            threading.Thread(target=handle_host, args=(conn, addr), daemon=True).start()
 
 # --- メイン処理 (基板のクライアント機能) ---
 def send_report(phase_data):
-    """ホストアプリに状態遷移報告を送信するクライアント関数"""
+    """ホストアプリに状態遷移報告を送信するクライアント関数 (接続はプールして再利用する)"""
     phase_name = {0:'INITIALIZE', 8:'STANDBY', 0x2E:'RECONSTRUCT', 0x10:'IDLE'}.get(phase_data, 'UNKNOWN')
-    print(f"\n[基板クライアント] ホストアプリ({HOST_APP_IP}:{HOST_APP_PORT})に接続します...")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((HOST_APP_IP, HOST_APP_PORT))
-        print(f"[基板クライアント] 接続成功。状態遷移報告({phase_name})を送信します。")
-        
-        # コマンド、データ、ステータスをまとめて送信
-        cmd_packet = create_command_packet(0x3B, 3, 0, 4)
-        data_packet = struct.pack('!I', phase_data)
-        status_packet = struct.pack('!I', 0)
-        
-        s.sendall(cmd_packet)
-        s.sendall(data_packet)
-        s.sendall(status_packet)
-        print("[基板クライアント] 送信完了。接続を切断します。")
+    print(f"\n[基板クライアント] ホストアプリ({HOST_APP_IP}:{HOST_APP_PORT})へ状態遷移報告({phase_name})を送信します...")
+
+    # コマンド、データ、ステータスをまとめて送信
+    report = encode_report(3, phase_data)
+
+    with app_pool.connection((HOST_APP_IP, HOST_APP_PORT)) as conn:
+        if conn.reused: print("[基板クライアント] 既存の接続を再利用します。")
+        conn.sendall(report)
+    print("[基板クライアント] 送信完了。")
+
+def run_init(command_timeout=None):
+    """1回分の初期化シーケンス (電源ON から IDLE 報告まで)。シナリオで打ち切った場合・指令が届かない場合は RunAborted"""
+    scenario.begin_run(reports=4, commands=[0x01])
+    command_received.clear()
+    command_failed.clear()
 
-# --- 初期化シーケンス実行 ---
-if __name__ == "__main__":
-    # 1. 基板のサーバーを別スレッドで起動
-    server_thread = threading.Thread(target=board_server)
-    server_thread.start()
-    
-    print("===== 模擬制御基板 起動 (電源ON) =====")
-    
     # 2. INITIALIZE -> STANDBY
     print("\n--- イニシャライズフェーズ実行 ---")
-    time.sleep(2)
-    send_report(0x00000000) # INITIALIZE報告
+    scenario.wait(2)
+    scenario.report(send_report, 0x00000000) # INITIALIZE報告
     print("...基板内部処理中...")
-    time.sleep(3)
-    send_report(0x00000008) # STANDBY報告
-    
+    scenario.wait(3)
+    scenario.report(send_report, 0x00000008) # STANDBY報告
+
     # 3. ホストアプリからの指令を待つ
     print("\n--- ホストアプリからの指令待機中 ---")
-    command_received.wait() # サーバーが指令を受信するまで待機
-    
+    # サーバーが指令を受信するまで待機 (アプリ側がタイムアウトした場合などに待ち続けないよう制限時間を設ける)
+    if not command_received.wait(command_timeout):
+        raise RunAborted(f"アプリからの指令が {command_timeout}秒以内に届きませんでした。")
+    if command_failed.is_set():
+        raise RunAborted("指令にエラーステータスを返しました。")
+
     # 4. RECONSTRUCT -> IDLE
     print("\n--- リコンストラクトフェーズ実行 ---")
-    time.sleep(2)
-    send_report(0x0000002E) # RECONSTRUCT報告
+    scenario.wait(2)
+    scenario.report(send_report, 0x0000002E) # RECONSTRUCT報告
     print("...基板内部処理中...")
-    time.sleep(4)
-    send_report(0x00000010) # IDLE報告
+    scenario.wait(4)
+    scenario.report(send_report, 0x00000010) # IDLE報告
+
+# --- 初期化シーケンス実行 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模擬制御基板 (初期化シーケンス)")
+    parser.add_argument("--app-port", type=int, default=HOST_APP_PORT, help="報告先のアプリのポート (ラック試験で基板ごとに分ける)")
+    parser.add_argument("--board-port", type=int, default=BOARD_SERVER_PORT, help="基板自身のサーバーポート")
+    parser.add_argument("--loop", type=int, default=1, help="シーケンスの繰り返し回数 (0 で無制限)。アプリが接続を閉じるたびに次の回を始める")
+    parser.add_argument("--timeout", type=float, default=60, help="アプリからの指令を待つ制限時間 (秒, 0 で無制限)")
+    mock_scenario.add_arguments(parser)
+    args = parser.parse_args()
+    HOST_APP_PORT, BOARD_SERVER_PORT = args.app_port, args.board_port
+    scenario = mock_scenario.from_args(args)
+    app_address = (HOST_APP_IP, HOST_APP_PORT)
+
+    # 1. 基板のサーバーを別スレッドで起動
+    server_thread = threading.Thread(target=board_server, daemon=True)
+    server_thread.start()
     
-    print("\n===== 模擬制御基板 処理完了 =====")
-    server_thread.join()
\ No newline at end of file
+    print("===== 模擬制御基板 起動 (電源ON) =====")
+
+    count = 0
+    while args.loop == 0 or count < args.loop:
+        count += 1
+        if args.loop != 1:
+            print(f"\n===== {count} 回目 =====")
+        mock_scenario.wait_app(app_pool, app_address)
+        started = time.perf_counter()
+        try:
+            run_init(args.timeout or None)
+            result = "完了"
+        except RunAborted as e:
+            result = f"打ち切り ({e})"
+        except OSError as e:
+            result = f"アプリとの接続が切れました ({e})"
+        print(f"[基板] {count} 回目: {result} ({time.perf_counter() - started:.3f}秒)")
+        if args.loop != 1:
+            # アプリがシーケンスを終えて接続を閉じてから次の回へ進む
+            mock_scenario.wait_app_closed(app_pool, app_address)
+
+    app_pool.close_all()
+    print("\n===== 模擬制御基板 処理完了 =====")
\ No newline at end of file
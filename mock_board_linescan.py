@@ -1,115 +1,161 @@
+import argparse
 import socket
-import struct
 import time
 import threading
+import queue
+from board_client import BoardConnectionPool
+from protocol import FrameReader, OP_READ, encode_report, encode_status
+from mock_async import get_pattern
+import mock_scenario
+from mock_scenario import RunAborted
 
 # --- 共通の関数と定数 ---
 HOST_APP_IP = '127.0.0.1'
 HOST_APP_PORT = 60201  # アプリのサーバーポート
 BOARD_SERVER_PORT = 60202 # 基板自身のサーバーポート
 
-def create_command_packet(op_code, command_id, offset, data_size):
-    try:
-        offset_b2 = (offset >> 16) & 0xFF; offset_b1 = (offset >> 8) & 0xFF; offset_b0 = offset & 0xFF
-        size_b2 = (data_size >> 16) & 0xFF; size_b1 = (data_size >> 8) & 0xFF; size_b0 = data_size & 0xFF
-        packet_values = (op_code, 0x00, command_id, offset_b2, offset_b1, offset_b0, size_b2, size_b1, size_b0, 0x00, 0x00, 0x00)
-        return struct.pack('!BBBBBBBBBBBB', *packet_values)
-    except: return None
+# アプリへの送信用接続 (送信ごとに接続し直さず使い回す)
+app_pool = BoardConnectionPool()
+# 待ち時間と応答の崩し方 (mock_scenario.py)
+scenario = mock_scenario.Scenario()
 
 def send_to_app(command_id, data_value):
     """ホストアプリにコマンドを送信するクライアント関数"""
-    print(f"\n[基板クライアント] -> アプリ({HOST_APP_IP}:{HOST_APP_PORT})に接続します。")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((HOST_APP_IP, HOST_APP_PORT))
-        cmd_packet = create_command_packet(0x3B, command_id, 0, 4)
-        data_packet = struct.pack('!I', data_value)
-        status_packet = struct.pack('!I', 0)
-        
-        s.sendall(cmd_packet)
-        s.sendall(data_packet)
-        s.sendall(status_packet)
-        print(f"[基板クライアント] ID:{hex(command_id)}, Data:{hex(data_value)} を送信完了。")
+    print(f"\n[基板クライアント] -> アプリ({HOST_APP_IP}:{HOST_APP_PORT})へ送信します。")
+    report = encode_report(command_id, data_value)
+
+    with app_pool.connection((HOST_APP_IP, HOST_APP_PORT)) as conn:
+        if conn.reused: print("[基板クライアント] 既存の接続を再利用します。")
+        conn.sendall(report)
+    print(f"[基板クライアント] ID:{hex(command_id)}, Data:{hex(data_value)} を送信完了。")
+
+# --- 基板のサーバー機能 ---
+# (アプリからのコマンドを別スレッドで受信し、受信したコマンドIDをメイン処理へ通知する)
+received_commands = queue.Queue()
+
+def handle_host(conn, addr):
+    """ホストアプリからの1接続を処理する。接続が閉じられるまで複数のコマンドを受け付ける"""
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            for frame in FrameReader(conn).frames(with_status=False):
+                if frame.op_code == OP_READ:
+                    # データ読み出しコマンド (ID:0x54)
+                    print("[基板サーバー] データ読み出しコマンドを受信しました。")
+                    # 要求されたサイズだけ返す (過不足があると、使い回す接続の次のフレームがずれる)
+                    dummy_data = get_pattern("ramp")[:frame.data_size]
+                    print(f"[基板サーバー] {frame.data_size}バイトのダミーデータを送信します。")
+                    conn.sendall(dummy_data)
+                    conn.sendall(encode_status(0))
+                    print("[基板サーバー] データ送信完了。")
+                    status = 0
+                else:
+                    # 受信後、すぐにステータスを返信 (シナリオが error-status ならエラーステータス)
+                    status = scenario.status(frame.command_id)
+                    conn.sendall(encode_status(status))
+                received_commands.put((frame.command_id, frame.data_value, status))
+        except ConnectionError:
+            pass
+
+def board_server(s):
+    while True:
+        conn, addr = s.accept()
+        threading.Thread(target=handle_host, args=(conn, addr), daemon=True).start()
+
+class ScanRestarted(RunAborted):
+    """スキャンの途中で次のスキャン開始コマンド(ID:0x14)を受信した"""
+
+def wait_command(expected_id):
+    """指定したコマンドIDをアプリから受信するまで待機する (エラーステータスを返した場合は RunAborted)"""
+    while True:
+        cmd_id, data_value, status = received_commands.get()
+        if status != 0:
+            raise RunAborted(f"コマンド(ID:{hex(cmd_id)})にエラーステータスを返しました。")
+        if cmd_id == expected_id:
+            return data_value
+        if cmd_id == 0x14:
+            # 前の回の途中 (アプリ側の失敗・タイムアウト) でアプリが次のスキャンを始めた
+            raise ScanRestarted("アプリが次のスキャンを開始しました。")
+        print(f"[基板サーバー] 想定外のコマンド(ID:{hex(cmd_id)})を受信しました。無視します。")
+
+def run_scan(started=False):
+    """アプリとの1ライン分のスキャンシーケンスを実行する。シナリオで打ち切った場合は RunAborted
+
+    started=True は、ID:0x14 を前の回の途中で受信済みの場合。
+    """
+    scenario.begin_run(reports=4, commands=[0x14, 0x01, 0x09, 0x0A])
+    # 1 & 2. アプリからのスキャン開始コマンド2つを受信
+    print("\n--- アプリからのスキャン開始コマンド待機中 ---")
+    if not started:
+        wait_command(0x14)
+    print("[基板サーバー] 1つ目のコマンド(ID:0x14)を受信しました。")
+    wait_command(0x01)
+    print("[基板サーバー] 2つ目のコマンド(ID:0x01, Data:0x54)を受信しました。")
+
+    # 3 & 4. 状態遷移報告とステージ移動依頼をアプリへ送信
+    scenario.wait(1)
+    scenario.report(send_to_app, 0x03, 0x54) # Phase:ラインスキャン報告
+    scenario.wait(1)
+    scenario.report(send_to_app, 0x05, 0x00) # ステージ助走位置移動依頼
+
+    # 5. アプリからの助走位置移動完了コマンドを受信
+    print("\n--- アプリからの助走位置移動完了(ID:0x09)コマンド待機中 ---")
+    wait_command(0x09)
+    print("[基板サーバー] 助走位置移動完了コマンドを受信しました。")
+
+    # 6. ステージ測定移動依頼をアプリへ送信
+    scenario.wait(2) # 基板の内部処理を模擬
+    scenario.report(send_to_app, 0x06, 0x00) # ステージ測定移動依頼
+
+    # 7. アプリからの測定移動完了コマンドを受信
+    print("\n--- アプリからの測定移動完了(ID:0x0A)コマンド待機中 ---")
+    wait_command(0x0A)
+    print("[基板サーバー] 測定移動完了コマンドを受信しました。")
+
+    # 8. Phase:アイドル報告をアプリへ送信
+    scenario.wait(2) # 基板の内部処理を模擬
+    scenario.report(send_to_app, 0x03, 0x10)
+
+    # 9. アプリからのデータ読み出しコマンドを受信
+    print("\n--- アプリからのデータ読み出し(ID:0x54)コマンド待機中 ---")
+    wait_command(0x54)
 
 # --- メイン処理 (基板のサーバー) ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模擬制御基板 (ラインスキャンモード)")
+    parser.add_argument("--lines", type=int, default=1, help="続けて受け付けるライン数 (ラスタースキャン・繰り返し実行用, 0 で無制限)")
+    parser.add_argument("--app-port", type=int, default=HOST_APP_PORT, help="報告先のアプリのポート (ラック試験で基板ごとに分ける)")
+    parser.add_argument("--board-port", type=int, default=BOARD_SERVER_PORT, help="基板自身のサーバーポート")
+    mock_scenario.add_arguments(parser)
+    args = parser.parse_args()
+    HOST_APP_PORT, BOARD_SERVER_PORT = args.app_port, args.board_port
+    scenario = mock_scenario.from_args(args)
+
     print("===== 模擬制御基板 (ラインスキャンモード) 起動 =====")
     print(f"[基板サーバー] IP: 127.0.0.1, Port: {BOARD_SERVER_PORT} で待機中...")
-    
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(('127.0.0.1', BOARD_SERVER_PORT))
         s.listen()
+        threading.Thread(target=board_server, args=(s,), daemon=True).start()
 
-        # 1 & 2. アプリからのスキャン開始コマンド2つを受信
-        print("\n--- アプリからのスキャン開始コマンド待機中 ---")
-        conn, addr = s.accept()
-        with conn:
-            # ▼▼▼【変更点】▼▼▼
-            # コマンドとデータをまとめて受信
-            cmd1 = conn.recv(12 + 4) 
-            # status1 = conn.recv(4) # ← この不要な受信待機を削除
-            print("[基板サーバー] 1つ目のコマンド(ID:0x14)を受信しました。")
-            # 受信後、すぐにステータスを返信
-            conn.sendall(struct.pack('!I', 0))
-            # ▲▲▲【変更点】▲▲▲
+        line = 0
+        restarted = False
+        while args.lines == 0 or line < args.lines:
+            line += 1
+            print(f"\n===== ライン {line} =====")
+            started = time.perf_counter()
+            try:
+                run_scan(restarted)
+                restarted = False
+                result = "完了"
+            except RunAborted as e:
+                restarted = isinstance(e, ScanRestarted)
+                result = f"打ち切り ({e})"
+            except OSError as e:
+                result = f"アプリとの接続が切れました ({e})"
+            print(f"[基板] ライン {line}: {result} ({time.perf_counter() - started:.3f}秒)")
 
-        conn, addr = s.accept()
-        with conn:
-            # ▼▼▼【変更点】▼▼▼
-            cmd2 = conn.recv(12 + 4)
-            # status2 = conn.recv(4) # ← この不要な受信待機を削除
-            print("[基板サーバー] 2つ目のコマンド(ID:0x01, Data:0x54)を受信しました。")
-            # 受信後、すぐにステータスを返信
-            conn.sendall(struct.pack('!I', 0))
-            # ▲▲▲【変更点】▲▲▲
-
-        # 3 & 4. 状態遷移報告とステージ移動依頼をアプリへ送信
-        time.sleep(1)
-        send_to_app(command_id=0x03, data_value=0x54) # Phase:ラインスキャン報告
-        time.sleep(1)
-        send_to_app(command_id=0x05, data_value=0x00) # ステージ助走位置移動依頼
-        
-        # 5. アプリからの助走位置移動完了コマンドを受信
-        print("\n--- アプリからの助走位置移動完了(ID:0x09)コマンド待機中 ---")
-        conn, addr = s.accept()
-        with conn:
-            # ▼▼▼【変更点】▼▼▼
-            cmd3 = conn.recv(12 + 4)
-            print("[基板サーバー] 助走位置移動完了コマンドを受信しました。")
-            conn.sendall(struct.pack('!I', 0)) # すぐに返信
-            # ▲▲▲【変更点】▲▲▲
-
-        # 6. ステージ測定移動依頼をアプリへ送信
-        time.sleep(2) # 基板の内部処理を模擬
-        send_to_app(command_id=0x06, data_value=0x00) # ステージ測定移動依頼
-        
-        # 7. アプリからの測定移動完了コマンドを受信
-        print("\n--- アプリからの測定移動完了(ID:0x0A)コマンド待機中 ---")
-        conn, addr = s.accept()
-        with conn:
-            # ▼▼▼【変更点】▼▼▼
-            cmd4 = conn.recv(12 + 4)
-            print("[基板サーバー] 測定移動完了コマンドを受信しました。")
-            conn.sendall(struct.pack('!I', 0)) # すぐに返信
-            # ▲▲▲【変更点】▲▲▲
-
-        # 8. Phase:アイドル報告をアプリへ送信
-        time.sleep(2) # 基板の内部処理を模擬
-        send_to_app(command_id=0x03, data_value=0x10)
-        
-        # 9. アプリからのデータ読み出しコマンドを受信
-        print("\n--- アプリからのデータ読み出し(ID:0x54)コマンド待機中 ---")
-        conn, addr = s.accept()
-        with conn:
-            read_cmd = conn.recv(12)
-            print("[基板サーバー] データ読み出しコマンドを受信しました。")
-            
-            data_size = 43400
-            dummy_data = bytes([i % 256 for i in range(data_size)])
-            print(f"[基板サーバー] {data_size}バイトのダミーデータを送信します。")
-            conn.sendall(dummy_data)
-            
-            conn.sendall(struct.pack('!I', 0))
-            print("[基板サーバー] データ送信完了。")
-
-    print("\n===== 模擬制御基板 (ラインスキャンモード) 処理完了 =====")
\ No newline at end of file
+    app_pool.close_all()
+    print("\n===== 模擬制御基板 (ラインスキャンモード) 処理完了 =====")
@@ -0,0 +1,140 @@
+import random
+import select
+import time
+
+# --- 模擬基板の動作シナリオ (回帰試験用) ---
+# mock_board_init.py / mock_board_linescan.py の待ち時間と応答の崩し方をまとめて切り替える。
+# --time-scale で待ち時間を縮め、--loop (ラインスキャンは --lines) で繰り返し受け付けると、
+# cli.py の --repeat と組み合わせて数百回分のシーケンスとその所要時間を数秒で確認できる。
+#
+#   normal        既定の待ち時間で正常に応答する
+#   jitter        待ち時間を1つずつ JITTER_RANGE 倍の範囲でばらつかせる
+#   slow-report   1回につき報告1つを --slow-delay 秒 (時間倍率を掛ける前) 遅らせる
+#   drop-report   1回につき報告1つを送らず、その回を打ち切る (アプリ側はタイムアウトになる)
+#   error-status  1回につき指令1つにエラーステータスを返し、その回を打ち切る
+#   mixed         回ごとに上のどれかを選ぶ
+#
+#   python mock_board_init.py --time-scale 1000 --scenario mixed --seed 1 --loop 0
+#   python cli.py -q init --repeat 200 --timeout 1
+
+SCENARIOS = ("normal", "jitter", "slow-report", "drop-report", "error-status", "mixed")
+JITTER_RANGE = (0.2, 3.0)
+DEFAULT_SLOW_DELAY = 10.0
+DEFAULT_ERROR_STATUS = 0x00000001
+CONNECT_RETRY_INTERVAL = 0.001
+
+
+class RunAborted(Exception):
+    """シナリオによりその回のシーケンスを打ち切った"""
+
+
+class Scenario:
+    """待ち時間の倍率と、回ごとに崩す報告・指令を決める
+
+    begin_run() で回ごとの動作を決め、wait() / report() / status() を基板の処理から呼ぶ。
+    seed を指定すると、同じ引数なら毎回同じ順序で同じ崩し方になる。
+    """
+
+    def __init__(self, name="normal", time_scale=1.0, seed=None, slow_delay=DEFAULT_SLOW_DELAY,
+                 error_status=DEFAULT_ERROR_STATUS):
+        if name not in SCENARIOS:
+            raise ValueError(f"不明なシナリオです: {name} ({' / '.join(SCENARIOS)})")
+        if time_scale <= 0:
+            raise ValueError("時間倍率は正の値で指定してください。")
+        self.name = name
+        self.time_scale = time_scale
+        self.slow_delay = slow_delay
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.current = name
+        self.run = 0
+        self._target_report = None
+        self._target_command = None
+        self._reports = 0
+
+    def begin_run(self, reports, commands=()):
+        """1回分の動作を決める。reports はその回の報告数、commands はエラーにしうる指令のID"""
+        self.run += 1
+        self.current = self.random.choice(SCENARIOS[:-1]) if self.name == "mixed" else self.name
+        self._reports = 0
+        self._target_report = self.random.randrange(reports) if reports else None
+        self._target_command = self.random.choice(list(commands)) if commands else None
+        print(f"[シナリオ] {self.run} 回目: {self.describe()}")
+
+    def describe(self):
+        if self.current in ("slow-report", "drop-report"):
+            return f"{self.current} ({self._target_report + 1} 番目の報告)"
+        if self.current == "error-status":
+            return f"{self.current} (ID:{hex(self._target_command)} に {self.error_status:#010x})"
+        return self.current
+
+    def wait(self, seconds):
+        """基板の内部処理を模擬して待つ (時間倍率で割り、jitter ではばらつかせる)"""
+        if self.current == "jitter":
+            seconds *= self.random.uniform(*JITTER_RANGE)
+        time.sleep(seconds / self.time_scale)
+
+    def report(self, send, *args):
+        """報告を送る。シナリオに応じて遅らせる・送らずに RunAborted を送出する"""
+        index, self._reports = self._reports, self._reports + 1
+        if index == self._target_report:
+            if self.current == "slow-report":
+                print(f"[シナリオ] 報告を {self.slow_delay / self.time_scale:.3f}秒 遅らせます。")
+                time.sleep(self.slow_delay / self.time_scale)
+            elif self.current == "drop-report":
+                print("[シナリオ] 報告を送らずにこの回を打ち切ります。")
+                raise RunAborted("報告を送りませんでした。")
+        send(*args)
+
+    def status(self, command_id):
+        """指令 command_id に返すステータス (error-status の対象なら error_status)"""
+        if self.current == "error-status" and command_id == self._target_command:
+            print(f"[シナリオ] ID:{hex(command_id)} にエラーステータス {self.error_status:#010x} を返します。")
+            return self.error_status
+        return 0
+
+
+def add_arguments(parser):
+    """模擬基板の argparse にシナリオ関係のオプションを追加する"""
+    parser.add_argument("--scenario", choices=SCENARIOS, default="normal", help="応答の崩し方 (mock_scenario.py を参照)")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="時間の進み方の倍率 (100 で待ち時間が 1/100)")
+    parser.add_argument("--seed", type=int, help="シナリオの乱数シード (同じ値なら同じ順序で崩す)")
+    parser.add_argument("--slow-delay", type=float, default=DEFAULT_SLOW_DELAY, help="slow-report で報告を遅らせる秒数 (時間倍率を掛ける前)")
+    parser.add_argument("--error-status", type=lambda value: int(value, 0), default=DEFAULT_ERROR_STATUS,
+                        help="error-status で返すステータス")
+
+
+def from_args(args):
+    return Scenario(args.scenario, args.time_scale, args.seed, args.slow_delay, args.error_status)
+
+
+def wait_app(pool, address, timeout=None):
+    """アプリのサーバーが接続を受け付けるまで接続を試みる (接続はプールに残し、最初の報告で使う)"""
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            with pool.connection(address):
+                return
+        except OSError:
+            if deadline and time.monotonic() > deadline:
+                raise
+            time.sleep(CONNECT_RETRY_INTERVAL)
+
+
+def wait_app_closed(pool, address, timeout=None):
+    """アプリが報告用の接続を閉じる (= シーケンスが終了してサーバーを止める) まで待つ
+
+    繰り返し実行で、次の回の報告を前の回のサーバーへ送らないようにするため。閉じられたら True。
+    """
+    try:
+        with pool.connection(address) as conn:
+            if not conn.reused:
+                # 前の接続は既に閉じられていた (新しい接続は次の回のサーバーへのものなので、そのまま残す)
+                return True
+            readable, _, _ = select.select([conn.sock], [], [], timeout)
+            if not readable:
+                return False
+            conn.close()
+            return True
+    except OSError:
+        return True
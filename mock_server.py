@@ -1,84 +1,96 @@
+import argparse
 import socket
-import struct
 import time
+import threading
+from protocol import FrameReader, encode_status
+from mock_async import BoardMemory, get_pattern
 
 HOST = '127.0.0.1'
 PORT = 60200
+OFFSET_UNIT = 1 # オフセット欄の1単位のバイト数 (アプリの「オフセット単位」に合わせる)
+# 書き込まれたデータ (コマンドIDごと)。読み出しでは書き込まれた範囲はそのデータを、それ以外はダミーデータを返す
+MEMORY = BoardMemory(get_pattern("ramp"))
 
-def parse_command_packet(packet: bytes):
-    """12バイトのコマンドパケットを解析して内容を表示する"""
-    if len(packet) != 12:
-        print(f"  [エラー] 受信したパケット長が12バイトではありません ({len(packet)} bytes)")
-        return None
-
-    values = struct.unpack('!BBBBBBBBBBBB', packet)
-    
-    op_code = values[0]
-    command_id = values[2]
-    offset = (values[3] << 16) + (values[4] << 8) + values[5]
-    data_size = (values[6] << 16) + (values[7] << 8) + values[8]
-
+def log_command(header):
+    """解析済みのコマンドパケット (protocol.CommandHeader) の内容を表示する"""
     print("--- 受信コマンドパケット解析結果 ---")
-    print(f"  オペレーションコード: {hex(op_code)}")
-    print(f"  コマンドID: {command_id}")
-    print(f"  オフセット: {offset}")
-    print(f"  データサイズ: {data_size}")
+    print(f"  オペレーションコード: {hex(header.op_code)}")
+    print(f"  コマンドID: {header.command_id}")
+    print(f"  オフセット: {header.offset}")
+    print(f"  データサイズ: {header.data_size}")
     print("------------------------------------")
-    
-    return op_code, data_size
 
-print(f"模擬制御基板サーバーを起動します...")
-print(f"IPアドレス {HOST}:{PORT} で待機中...")
+def handle_client(conn, addr):
+    """1つの接続を処理する。接続が閉じられるまで複数のコマンドを順に受け付ける"""
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] クライアント {addr} から接続がありました。")
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((HOST, PORT))
-    s.listen()
-
-    try:
+        # 1つの接続で複数のコマンドを受け付ける (アプリ側は接続をプールして再利用する)
+        reader = FrameReader(conn)
         while True:
-            conn, addr = s.accept()
-            with conn:
-                print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] クライアント {addr} から接続がありました。")
-
-                command_packet = conn.recv(12)
-                if not command_packet:
-                    continue
-                
-                print(f"1. 12バイトのコマンドパケットを受信しました。")
-                parsed_info = parse_command_packet(command_packet)
-
-                if parsed_info:
-                    op_code, data_size = parsed_info
-                    
-                    if op_code == 0x3B and data_size > 0: # 書き込み処理
-                        print(f"2. 書き込みコマンドのため、{data_size} バイトのデータパケットを受信します。")
-                        
-                        received_data = b''
-                        while len(received_data) < data_size:
-                            remaining = data_size - len(received_data)
-                            chunk = conn.recv(min(remaining, 4096))
-                            if not chunk: break
-                            received_data += chunk
-                        
-                        print(f"   -> {len(received_data)} バイトのデータを受信完了。")
-                        print(f"   -> 受信データ(先頭64バイト): {received_data[:64]}")
-
-                    # ▼▼▼【変更点】▼▼▼
-                    elif op_code == 0x3C: # 読み出し処理
-                        print(f"2. 読み出しコマンドのため、{data_size} バイトのダミーデータを生成して送信します。")
-                        
-                        # テスト用の簡単なデータを作成 (0x00, 0x01, 0x02, ..., 0xFF, 0x00, ...)
-                        dummy_data = bytes([i % 256 for i in range(data_size)])
-                        conn.sendall(dummy_data)
-                        print(f"   -> {len(dummy_data)} バイトのデータパケットを送信完了。")
-                    # ▲▲▲【変更点】▲▲▲
-
-                    print("3. 4バイトのステータスパケット (0x00000000) をクライアントに返信します。")
-                    status_packet = struct.pack('!I', 0)
-                    conn.sendall(status_packet)
-                    print("   -> 返信完了。")
-
-                print("クライアントとの通信を終了し、接続を閉じました。")
-
-    except KeyboardInterrupt:
-        print("\nCtrl+C が押されました。サーバーを終了します。")
\ No newline at end of file
+            try:
+                header = reader.read_header()
+            except ConnectionError as e:
+                print(f"  [エラー] {e}")
+                break
+            if header is None:
+                break
+
+            print(f"1. 12バイトのコマンドパケットを受信しました。")
+            log_command(header)
+            op_code, data_size = header.op_code, header.data_size
+
+            if op_code == 0x3B and data_size > 0: # 書き込み処理
+                print(f"2. 書き込みコマンドのため、{data_size} バイトのデータパケットを受信します。")
+
+                start_time = time.perf_counter()
+                try:
+                    received_data = reader.read_bulk(data_size)
+                except ConnectionError as e:
+                    print(f"  [エラー] {e}")
+                    break
+                mb_per_sec = data_size / max(time.perf_counter() - start_time, 1e-9) / 1e6
+
+                print(f"   -> {len(received_data)} バイトのデータを受信完了。({mb_per_sec:.1f} MB/s)")
+                print(f"   -> 受信データ(先頭64バイト): {bytes(received_data[:64])}")
+                MEMORY.write(header.command_id, header.offset * OFFSET_UNIT, received_data)
+
+            # ▼▼▼【変更点】▼▼▼
+            elif op_code == 0x3C: # 読み出し処理
+                print(f"2. 読み出しコマンドのため、{data_size} バイトのデータを送信します。")
+
+                # 同じIDに書き込まれたデータを返す。書き込まれていない範囲はテスト用の簡単なデータ
+                # (0x00, 0x01, 0x02, ..., 0xFF, 0x00, ...) で、オフセット付きの分割読み出しでもつなげると同じパターンになる
+                read_data = MEMORY.read(header.command_id, header.offset * OFFSET_UNIT, data_size)
+                conn.sendall(read_data)
+                print(f"   -> {len(read_data)} バイトのデータパケットを送信完了。")
+            # ▲▲▲【変更点】▲▲▲
+
+            print("3. 4バイトのステータスパケット (0x00000000) をクライアントに返信します。")
+            status_packet = encode_status(0)
+            conn.sendall(status_packet)
+            print("   -> 返信完了。")
+
+        print("クライアントとの通信を終了し、接続を閉じました。")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="「手動コマンド」タブ用の模擬サーバー")
+    parser.add_argument("--offset-unit", type=int, default=OFFSET_UNIT, help="オフセット欄の1単位のバイト数 (分割読み出しのオフセット単位に合わせる)")
+    OFFSET_UNIT = parser.parse_args().offset_unit
+
+    print(f"模擬制御基板サーバーを起動します...")
+    print(f"IPアドレス {HOST}:{PORT} で待機中...")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, PORT))
+        s.listen()
+
+        try:
+            while True:
+                conn, addr = s.accept()
+                # アプリ側は接続を保持し続けるため、接続ごとにスレッドで処理する
+                threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+
+        except KeyboardInterrupt:
+            print("\nCtrl+C が押されました。サーバーを終了します。")
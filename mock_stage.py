@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import math
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+
+# --- ステージコントローラの模擬 (FC-511 / ARIES) ---
+# 実機なしでラインスキャン (FC-511) と ARIES タブを動かすための模擬コントローラ。
+# 軸ごとに速度・加減速度から台形速度プロファイルで移動時間を求め、移動中は BUSY を返す。
+# --time-scale で時間の進み方を速めると、実機どおりの移動時間の比率のまま短時間で試験できる。
+#
+#   python mock_stage.py                                 # FC-511 (8000) と ARIES (2000) を両方起動
+#   python mock_stage.py --fc511 8000 --speed 20000 --accel 100000
+#   python mock_stage.py --aries 2000 --axes 4 --time-scale 10 --quiet
+#
+# FC-511 (CR 終端):   H:軸 (原点復帰) / M:軸+P<パルス> / M:軸-P<パルス> (相対移動) を設定し、G で実行する。
+#                     !: は全軸が停止していれば R、移動中の軸があれば B。Q: は全軸の現在位置。
+# ARIES (CRLF 終端):  ORG:軸 / MVR:軸,P<パルス> を設定し、G で実行する (G の前に複数軸を設定すると同時に動く)。
+#                     ?S:軸 は 0 (READY) / 1 (BUSY)、?P:軸 は現在位置。
+# 受理したコマンドには OK、解釈できないコマンドや移動中の軸への指令には NG を返す。
+
+HOST = '127.0.0.1'
+FC511_MOVE = re.compile(r'(\d+)([+-])P(\d+)$', re.IGNORECASE)
+DEFAULT_FC511_PORT = 8000
+DEFAULT_ARIES_PORT = 2000
+
+
+class Axis:
+    """1軸の動作モデル (台形速度プロファイル + 停止判定までの固定時間)
+
+    時刻はコントローラの模擬時間 (--time-scale を掛けた秒) で扱う。
+    """
+
+    def __init__(self, number, speed=10000, accel=50000, settle=0.05, home_speed=None):
+        self.number = number
+        self.speed = speed              # 最高速度 [pulse/s]
+        self.accel = accel              # 加減速度 [pulse/s^2]
+        self.settle = settle            # 停止判定までの固定時間 [s]
+        self.home_speed = home_speed or speed
+        self.origin = 0                 # 移動開始位置
+        self.target = 0
+        self.started = -math.inf        # 起動直後は停止中
+        self.duration = 0.0             # 移動 (加減速 + 定速) の時間
+        self.moving_speed = speed       # 実行中の移動の最高速度 (原点復帰は home_speed)
+        self.moves = 0
+
+    def profile(self, distance, speed):
+        """(加速時間, 最高到達速度, 合計時間)。距離が短い場合は三角形のプロファイルになる"""
+        ramp = min(speed / self.accel, math.sqrt(distance / self.accel))
+        peak = self.accel * ramp
+        cruise = (distance - self.accel * ramp ** 2) / peak if peak else 0.0
+        return ramp, peak, 2 * ramp + cruise
+
+    def busy(self, now):
+        return now < self.started + self.duration + self.settle
+
+    def position(self, now):
+        """現在位置 [pulse] (移動中はプロファイル上の位置)"""
+        distance = abs(self.target - self.origin)
+        elapsed = now - self.started
+        if distance == 0 or elapsed >= self.duration:
+            return self.target
+        ramp, peak, total = self.profile(distance, self.moving_speed)
+        if elapsed < ramp:
+            travelled = 0.5 * self.accel * elapsed ** 2
+        elif elapsed < total - ramp:
+            travelled = 0.5 * self.accel * ramp ** 2 + peak * (elapsed - ramp)
+        else:
+            travelled = distance - 0.5 * self.accel * (total - elapsed) ** 2
+        return self.origin + round(math.copysign(travelled, self.target - self.origin))
+
+    def move_to(self, target, now, homing=False):
+        self.origin = self.position(now)
+        self.target = target
+        self.moving_speed = self.home_speed if homing else self.speed
+        self.started = now
+        self.duration = self.profile(abs(target - self.origin), self.moving_speed)[2]
+        self.moves += 1
+
+
+class StageSimulator(ABC):
+    """ASCII行プロトコルのステージコントローラの共通部分 (コマンドの解釈はサブクラス)"""
+
+    name = "stage"
+    terminator = "\r\n"
+
+    def __init__(self, port, host=HOST, axes=2, speed=(10000,), accel=(50000,), settle=0.05, home_speed=None,
+                 time_scale=1.0, latency=0.0, quiet=False):
+        self.host = host
+        self.port = port
+        self.time_scale = time_scale
+        self.latency = latency
+        self.quiet = quiet
+        # 速度・加減速度は軸ごとに指定でき、足りない分は最後の値を使う
+        self.axes = {n: Axis(n, speed[min(n, len(speed)) - 1], accel[min(n, len(accel)) - 1], settle, home_speed)
+                     for n in range(1, axes + 1)}
+        self.pending = {}   # G で実行する設定済みの移動 {軸: (目標位置, 原点復帰か)}
+        self.queries = 0
+        self.server = None
+        self._t0 = time.monotonic()
+        self._tasks = set()
+
+    def now(self):
+        """模擬時間 [s] (実時間に time_scale を掛けたもの)"""
+        return (time.monotonic() - self._t0) * self.time_scale
+
+    def log(self, message):
+        if not self.quiet:
+            print(f"[{time.strftime('%H:%M:%S')}] [{self.name}:{self.port}] {message}")
+
+    def summary(self):
+        moves = ", ".join(f"軸{n} {axis.moves}回" for n, axis in self.axes.items())
+        return f"移動 {moves}, 状態問い合わせ {self.queries}回"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True)
+        self.log(f"待機中... (軸数 {len(self.axes)}, 時間倍率 x{self.time_scale:g})")
+        return self
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        buf = b''
+        try:
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                buf += chunk.replace(b'\n', b'\r')
+                *lines, buf = buf.split(b'\r')
+                responses = [self.respond(line.decode('ascii', 'replace').strip()) for line in lines if line.strip()]
+                if not responses:
+                    continue
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                # パイプラインで届いたコマンドの応答はまとめて返す
+                writer.write(''.join(response + self.terminator for response in responses).encode('ascii'))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    def respond(self, line):
+        try:
+            response = self.command(line)
+        except (ValueError, KeyError):
+            response = "NG"
+        if response == "NG" or not line.startswith(("!", "?", "Q")):
+            self.log(f"{line} -> {response}")
+        return response
+
+    @abstractmethod
+    def command(self, line):
+        """1行のコマンドを解釈して応答を返す (不正なコマンドは "NG")"""
+
+    def setup(self, axis, relative=None):
+        """移動を設定する (relative=None は原点復帰)。移動中の軸は受け付けない"""
+        axis = self.axes[axis]
+        if axis.busy(self.now()):
+            return "NG"
+        if relative is None:
+            self.pending[axis.number] = (0, True)
+        else:
+            self.pending[axis.number] = (axis.target + relative, False)
+        return "OK"
+
+    def go(self):
+        """設定済みの移動をすべて同時に開始する"""
+        if not self.pending:
+            return "NG"
+        now = self.now()
+        for number, (target, homing) in self.pending.items():
+            self.axes[number].move_to(target, now, homing)
+        self.pending.clear()
+        return "OK"
+
+
+class Fc511Simulator(StageSimulator):
+    name = "FC-511"
+    terminator = "\r"
+
+    def command(self, line):
+        if line == "G":
+            return self.go()
+        if line == "!:":
+            self.queries += 1
+            now = self.now()
+            return "B" if any(axis.busy(now) for axis in self.axes.values()) else "R"
+        if line == "Q:":
+            now = self.now()
+            return ",".join(str(axis.position(now)) for axis in self.axes.values())
+        name, _, arg = line.partition(":")
+        if name == "H":
+            return self.setup(int(arg))
+        if name == "M":
+            # M:1+P1000 / M:2-P500
+            match = FC511_MOVE.match(arg)
+            if not match:
+                return "NG"
+            axis, sign, pulses = match.groups()
+            return self.setup(int(axis), relative=int(pulses) if sign == "+" else -int(pulses))
+        return "NG"
+
+
+class AriesSimulator(StageSimulator):
+    name = "ARIES"
+    terminator = "\r\n"
+
+    def command(self, line):
+        if line == "G":
+            return self.go()
+        name, _, arg = line.partition(":")
+        name = name.upper()
+        if name == "?S":
+            self.queries += 1
+            return "1" if self.axes[int(arg)].busy(self.now()) else "0"
+        if name == "?P":
+            return str(self.axes[int(arg)].position(self.now()))
+        if name == "ORG":
+            return self.setup(int(arg))
+        if name == "MVR":
+            # MVR:2,P1000 / MVR:2,P-1000
+            axis, _, pulses = arg.partition(",")
+            return self.setup(int(axis), relative=int(pulses.lstrip("Pp")))
+        return "NG"
+
+
+SIMULATORS = {"fc511": Fc511Simulator, "aries": AriesSimulator}
+
+
+class StageServerThread:
+    """別スレッドのイベントループで模擬コントローラを動かす (ベンチマーク等から使う)
+
+    StageServerThread({"aries": 2000}, time_scale=10, quiet=True)
+    """
+
+    def __init__(self, ports, **options):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="MockStages", daemon=True)
+        self._thread.start()
+
+        async def start_all():
+            return {kind: await SIMULATORS[kind](port, **options).start() for kind, port in ports.items()}
+        self.stages = asyncio.run_coroutine_threadsafe(start_all(), self.loop).result()
+
+    def stop(self):
+        async def close_all():
+            for stage in self.stages.values():
+                await stage.close()
+        asyncio.run_coroutine_threadsafe(close_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+async def main(args):
+    ports = {}
+    if args.fc511:
+        ports["fc511"] = args.fc511
+    if args.aries:
+        ports["aries"] = args.aries
+    if not ports:
+        ports = {"fc511": DEFAULT_FC511_PORT, "aries": DEFAULT_ARIES_PORT}
+    options = dict(host=args.host, axes=args.axes, speed=args.speed, accel=args.accel, settle=args.settle,
+                   home_speed=args.home_speed, time_scale=args.time_scale, latency=args.latency, quiet=args.quiet)
+    stages = [await SIMULATORS[kind](port, **options).start() for kind, port in ports.items()]
+    print("模擬ステージコントローラを起動しました: " + ", ".join(f"{stage.name} {args.host}:{stage.port}" for stage in stages))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for stage in stages:
+            print(f"[{stage.name}:{stage.port}] {stage.summary()}")
+            await stage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模擬ステージコントローラ (FC-511 / ARIES)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--fc511", type=int, metavar="PORT", help="FC-511 を起動するポート")
+    parser.add_argument("--aries", type=int, metavar="PORT", help="ARIES を起動するポート (どちらも省略時は 8000 / 2000 で両方)")
+    parser.add_argument("--axes", type=int, default=4, help="軸数")
+    parser.add_argument("--speed", type=float, nargs="+", default=[10000], help="最高速度 [pulse/s] (軸ごとに複数指定可)")
+    parser.add_argument("--accel", type=float, nargs="+", default=[50000], help="加減速度 [pulse/s^2] (軸ごとに複数指定可)")
+    parser.add_argument("--settle", type=float, default=0.05, help="停止判定までの時間 [s]")
+    parser.add_argument("--home-speed", type=float, help="原点復帰の速度 [pulse/s] (省略時は --speed)")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="時間の進み方の倍率 (10 で移動時間が 1/10)")
+    parser.add_argument("--latency", type=float, default=0.0, help="応答を返すまでの遅延 [s] (実時間)")
+    parser.add_argument("--quiet", action="store_true", help="コマンドごとのログを出さない")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        print("\nCtrl+C が押されました。模擬コントローラを終了します。")
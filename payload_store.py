@@ -0,0 +1,194 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# --- 受信データの一時ファイル置き場 ---
+# 手動コマンドの読み出しやスキャンデータを bytes としてセッションに持たず、一時ファイルへ直接受信して
+# セッションにはID (と表示用の情報) だけを持たせる。ダウンロードや解析はファイルを mmap して読むため、
+# 同じデータがプロセスのメモリに何重にも載ることはない。
+# 保持する合計サイズが上限 (budget) を超えると、最後に使ってから時間が経ったものから破棄する。
+#
+#   store = PayloadStore(budget=256 * 1024 * 1024)
+#   with store.writing(size, "scan.bin") as (payload, out):
+#       conn.read_into(out)                     # out は一時ファイルを mmap した書き込み用のビュー
+#   with payload.view() as data:                # 読み取り専用のビュー (np.frombuffer 等にそのまま渡せる)
+#       ...
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+
+class Payload:
+    """一時ファイルに保存した受信データ1件"""
+
+    def __init__(self, store, payload_id, name, size, path):
+        self._store = weakref.ref(store)
+        self.id = payload_id
+        self.name = name
+        self.size = size
+        self.path = path
+        self.created = time.time()
+
+    @property
+    def exists(self):
+        """破棄されていなければ True"""
+        store = self._store()
+        return store is not None and store.get(self.id, touch=False) is self
+
+    @contextmanager
+    def view(self):
+        """データ全体を mmap した読み取り専用の memoryview"""
+        self._touch()
+        if self.size == 0:
+            yield memoryview(b'')
+            return
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            yield view
+        finally:
+            _close_mapping(view, mapped)
+
+    def read(self):
+        """データを bytes として読み込む (ダウンロードボタンが押されたときなど、必要な時だけ呼ぶ)"""
+        self._touch()
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def _touch(self):
+        store = self._store()
+        if store is not None:
+            store.get(self.id)
+
+
+def _close_mapping(view, mapped):
+    view.release()
+    try:
+        mapped.close()
+    except BufferError:
+        # 呼び出し側がまだビュー (numpy 配列など) を持っている場合は、参照が無くなった時点で解放される
+        pass
+
+
+class PayloadStore:
+    """受信データを一時ファイルで保持し、合計サイズが budget を超えたら古いものから破棄する (スレッドセーフ)"""
+
+    def __init__(self, budget=DEFAULT_BUDGET, directory=None):
+        self.budget = budget
+        self.directory = tempfile.mkdtemp(prefix="jigu_payload_", dir=directory)
+        self._payloads = OrderedDict()  # 最後に使った順 (末尾が最新)
+        self._lock = threading.Lock()
+        self._orphans = []  # 破棄したが削除できなかったファイル (Windows で mmap 中など)
+        self.evicted = 0
+        # プロセス終了時に一時ディレクトリごと削除する
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(payload.size for payload in self._payloads.values())
+
+    def items(self):
+        """保持している Payload の一覧 (最後に使った順)"""
+        with self._lock:
+            return list(self._payloads.values())
+
+    @contextmanager
+    def writing(self, size, name=""):
+        """size バイトの一時ファイルを用意し、(Payload, 書き込み用の memoryview) を渡す
+
+        with ブロックが正常に終わった時点で登録する。例外の場合はファイルを削除する。
+        """
+        payload = Payload(self, uuid.uuid4().hex, name, size, None)
+        payload.path = os.path.join(self.directory, payload.id + ".bin")
+        try:
+            with open(payload.path, 'w+b') as f:
+                if size == 0:
+                    yield payload, memoryview(bytearray(0))
+                else:
+                    f.truncate(size)
+                    mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE)
+                    view = memoryview(mapped)
+                    try:
+                        yield payload, view
+                        mapped.flush()
+                    finally:
+                        _close_mapping(view, mapped)
+        except BaseException:
+            self._remove(payload.path)
+            raise
+        self._add(payload)
+
+    def put(self, data, name=""):
+        """受信済みのデータ (bytes 等) を保存する"""
+        with self.writing(len(data), name) as (payload, out):
+            out[:] = data
+        return payload
+
+    def get(self, payload_id, touch=True):
+        """ID の Payload (破棄済み・不明なら None)。touch=True は最後に使った時刻を更新する"""
+        with self._lock:
+            payload = self._payloads.get(payload_id)
+            if payload is not None and touch:
+                self._payloads.move_to_end(payload_id)
+            return payload
+
+    def discard(self, payload_id):
+        with self._lock:
+            payload = self._payloads.pop(payload_id, None)
+        if payload is not None:
+            self._remove(payload.path)
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def clear(self):
+        with self._lock:
+            payloads = list(self._payloads.values())
+            self._payloads.clear()
+        for payload in payloads:
+            self._remove(payload.path)
+
+    def close(self):
+        self.clear()
+        self._finalizer()
+
+    def _add(self, payload):
+        with self._lock:
+            self._payloads[payload.id] = payload
+        self._evict(keep=payload.id)
+
+    def _evict(self, keep=None):
+        """合計サイズが上限以下になるまで、最後に使ってから時間が経ったものから破棄する"""
+        removed = []
+        with self._lock:
+            total = sum(payload.size for payload in self._payloads.values())
+            for payload_id in list(self._payloads):
+                if total <= self.budget:
+                    break
+                if payload_id == keep:
+                    continue
+                payload = self._payloads.pop(payload_id)
+                total -= payload.size
+                removed.append(payload.path)
+                self.evicted += 1
+            orphans, self._orphans = self._orphans, []
+        for path in orphans + removed:
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            with self._lock:
+                self._orphans.append(path)
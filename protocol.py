@@ -0,0 +1,178 @@
+import struct
+from collections import namedtuple
+
+# --- 制御基板 12バイトコマンドプロトコルのエンコード/デコード ---
+# コマンドパケット: OP(1) 予約(1) ID(1) オフセット(3) データサイズ(3) 予約(3)  (ビッグエンディアン)
+# 24bitフィールドは struct に型が無いため、上位16bit(H) + 下位8bit(B) に分けて1つの Struct で扱う。
+
+OP_WRITE = 0x3B
+OP_READ = 0x3C
+MAX_24BIT = (2**24) - 1
+
+HEADER = struct.Struct('!BxBHBHB3x')       # コマンドパケット (12バイト)
+VALUE = struct.Struct('!I')                # 4バイトのデータ/ステータス
+VALUE_COMMAND = struct.Struct('!BxBHBHB3xI')        # コマンド + 4バイトデータ (アプリ -> 基板)
+REPORT = struct.Struct('!BxBHBHB3xII')              # コマンド + 4バイトデータ + ステータス (基板 -> アプリ)
+
+HEADER_SIZE = HEADER.size
+STATUS_SIZE = VALUE.size
+
+CommandHeader = namedtuple('CommandHeader', 'op_code command_id offset data_size')
+# 基板とのフレーム (コマンド + データ + ステータス)。data_value はデータが4バイトのときの値
+BoardFrame = namedtuple('BoardFrame', 'op_code command_id offset data_size data data_value status')
+
+
+def _check_24bit(name, value):
+    if not 0 <= value <= MAX_24BIT:
+        raise ValueError(f"{name}は24bit (0〜{MAX_24BIT}) の範囲で指定してください: {value}")
+
+
+def encode_header(op_code, command_id, offset, data_size):
+    """12バイトのコマンドパケットを生成する"""
+    _check_24bit("オフセット", offset)
+    _check_24bit("データサイズ", data_size)
+    return HEADER.pack(op_code, command_id, offset >> 8, offset & 0xFF, data_size >> 8, data_size & 0xFF)
+
+
+def create_command_packet(op_code, command_id, offset, data_size):
+    """12バイトのコマンドパケットを生成する (不正な値の場合は None)"""
+    try:
+        return encode_header(op_code, command_id, offset, data_size)
+    except (ValueError, struct.error):
+        return None
+
+
+def decode_header(buf, pos=0):
+    """buf[pos:pos+12] のコマンドパケットを解析する"""
+    op_code, command_id, offset_hi, offset_lo, size_hi, size_lo = HEADER.unpack_from(buf, pos)
+    return CommandHeader(op_code, command_id, (offset_hi << 8) | offset_lo, (size_hi << 8) | size_lo)
+
+
+def encode_value_command(command_id, value, op_code=OP_WRITE):
+    """4バイトデータ付きのコマンド (コマンド + データの16バイト) を生成する"""
+    return VALUE_COMMAND.pack(op_code, command_id, 0, 0, 0, 4, value)
+
+
+def encode_report(command_id, value, status=0):
+    """基板からアプリへの報告フレーム (コマンド + データ + ステータスの20バイト) を生成する"""
+    return REPORT.pack(OP_WRITE, command_id, 0, 0, 0, 4, value, status)
+
+
+def encode_status(status=0):
+    return VALUE.pack(status)
+
+
+def decode_status(buf, pos=0):
+    return VALUE.unpack_from(buf, pos)[0]
+
+
+# --- 複数フレームの一括エンコード/デコード ---
+
+def encode_headers(commands):
+    """(op_code, command_id, offset, data_size) の並びを連続したコマンドパケット列にまとめる"""
+    commands = list(commands)
+    buf = bytearray(HEADER_SIZE * len(commands))
+    for i, (op_code, command_id, offset, data_size) in enumerate(commands):
+        _check_24bit("オフセット", offset)
+        _check_24bit("データサイズ", data_size)
+        HEADER.pack_into(buf, i * HEADER_SIZE, op_code, command_id, offset >> 8, offset & 0xFF, data_size >> 8, data_size & 0xFF)
+    return bytes(buf)
+
+
+def decode_headers(buf):
+    """連続したコマンドパケット列をまとめて解析する"""
+    return [CommandHeader(op, cid, (oh << 8) | ol, (sh << 8) | sl) for op, cid, oh, ol, sh, sl in HEADER.iter_unpack(buf)]
+
+
+def encode_reports(reports):
+    """(command_id, value) の並びを連続した報告フレーム列にまとめる"""
+    reports = list(reports)
+    buf = bytearray(REPORT.size * len(reports))
+    for i, (command_id, value) in enumerate(reports):
+        REPORT.pack_into(buf, i * REPORT.size, OP_WRITE, command_id, 0, 0, 0, 4, value, 0)
+    return bytes(buf)
+
+
+# --- バッファ付きフレームリーダー ---
+
+class FrameReader:
+    """ソケットから大きな単位でまとめて受信し、バッファから完全なフレームを切り出す
+
+    recv の回数をフレーム単位ではなく受信量単位に抑え、受信が分割されても
+    フレーム境界がずれないようにする。
+    """
+
+    def __init__(self, sock, recv_size=65536):
+        self.sock = sock
+        self.recv_size = recv_size
+        self._buf = bytearray()
+        self._pos = 0
+
+    def _available(self):
+        return len(self._buf) - self._pos
+
+    def _fill(self, size):
+        """バッファに size バイト以上溜まるまで受信する。EOFなら False"""
+        while self._available() < size:
+            if self._pos and self._pos >= len(self._buf) // 2:
+                del self._buf[:self._pos]
+                self._pos = 0
+            chunk = self.sock.recv(max(self.recv_size, size - self._available()))
+            if not chunk:
+                return False
+            self._buf += chunk
+        return True
+
+    def read_exact(self, size):
+        if not self._fill(size):
+            raise ConnectionError(f"受信途中で接続が切断されました ({self._available()}/{size} bytes)")
+        data = bytes(self._buf[self._pos:self._pos + size])
+        self._pos += size
+        return data
+
+    def read_bulk(self, size):
+        """大容量データを事前確保したバッファへ受信する (バッファ済みの分を先に使う)"""
+        buf = bytearray(size)
+        view = memoryview(buf)
+        buffered = min(self._available(), size)
+        view[:buffered] = self._buf[self._pos:self._pos + buffered]
+        self._pos += buffered
+        received = buffered
+        while received < size:
+            n = self.sock.recv_into(view[received:], min(1024 * 1024, size - received))
+            if n == 0:
+                raise ConnectionError(f"受信途中で接続が切断されました ({received}/{size} bytes)")
+            received += n
+        return buf
+
+    def read_header(self):
+        """コマンドパケットを1つ読む。フレーム境界で接続が閉じられた場合は None"""
+        if not self._fill(HEADER_SIZE):
+            if self._available():
+                raise ConnectionError(f"受信途中で接続が切断されました ({self._available()}/{HEADER_SIZE} bytes)")
+            return None
+        header = decode_header(self._buf, self._pos)
+        self._pos += HEADER_SIZE
+        return header
+
+    def read_frame(self, with_status=True):
+        """コマンド + データ (+ ステータス) を1フレーム読む。接続が閉じられた場合は None
+
+        読み出しコマンド (0x3C) はデータを伴わないため、データは空になる。
+        """
+        header = self.read_header()
+        if header is None:
+            return None
+        data_size = header.data_size if header.op_code != OP_READ else 0
+        data = self.read_exact(data_size) if data_size else b''
+        status = decode_status(self.read_exact(STATUS_SIZE)) if with_status else None
+        data_value = VALUE.unpack(data)[0] if data_size == 4 else None
+        return BoardFrame(header.op_code, header.command_id, header.offset, header.data_size, data, data_value, status)
+
+    def frames(self, with_status=True):
+        """接続が閉じられるまでフレームを順に返す"""
+        while True:
+            frame = self.read_frame(with_status)
+            if frame is None:
+                return
+            yield frame
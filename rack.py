@@ -0,0 +1,263 @@
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from board_client import BoardConnectionPool
+from listener import BoardListener, APP_SERVER_ADDRESS
+import engine
+
+# --- テストラック (同一仕様の複数基板) への一斉実行 ---
+# 1つのコマンドやシーケンスを全基板に対してスレッドプールで同時に実行し、基板ごとの結果と全体の合否をまとめる。
+# 所要時間は基板数の合計ではなく、最も遅い基板で決まる。
+#
+# 基板リストは1行に1基板 (# 以降はコメント):
+#   名前, IP, ポート[, 報告ポート[, ステージIP:ポート]]
+#   board1, 192.168.0.11, 60202
+#   board2, 192.168.0.12, 60202, 60201, 192.168.0.201:8000
+# 報告ポートはアプリ側で基板からの報告を受けるポート (省略時 60201)。同じポートへ報告する基板は
+# 接続元IPで振り分けるため、同一IPの基板 (1台のPCで動かす模擬基板など) は報告ポートを分けること。
+
+Board = namedtuple('Board', 'name ip port listen_port stage')
+# ok: 合否, phase: 最終フェーズ, detail: 結果の説明, data: 読み出し/スキャンデータ (無ければ None)
+BoardResult = namedtuple('BoardResult', 'board ok phase elapsed detail data')
+
+DEFAULT_TIMEOUT = 30.0
+MAX_WORKERS = 32
+# タイムアウト監視の間隔 (秒)
+WATCH_INTERVAL = 0.1
+
+
+def _parse_address(value):
+    host, port = value.rsplit(":", 1)
+    return host.strip(), int(port)
+
+
+def parse_boards(text, default_listen_port=APP_SERVER_ADDRESS[1]):
+    """基板リストの文字列を [Board, ...] に変換する"""
+    boards = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        fields = [field.strip() for field in line.split(",")]
+        try:
+            name, ip, port = fields[:3]
+            listen_port = int(fields[3]) if len(fields) > 3 and fields[3] else default_listen_port
+            stage = _parse_address(fields[4]) if len(fields) > 4 and fields[4] else None
+            boards.append(Board(name, ip, int(port), listen_port, stage))
+        except ValueError:
+            raise ValueError(f"基板リストの{lineno}行目を解釈できません: {line}") from None
+    names = [board.name for board in boards]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"基板名が重複しています: {', '.join(duplicated)}")
+    return boards
+
+
+def load_boards(path):
+    with open(path, encoding="utf-8") as f:
+        return parse_boards(f.read())
+
+
+def fan_out(boards, func, timeout=DEFAULT_TIMEOUT, max_workers=MAX_WORKERS, on_result=None):
+    """func(board) -> (合否, フェーズ, 詳細, データ) を全基板に対して並列に実行し、基板の順に BoardResult を返す
+
+    開始から timeout 秒以内に終わらない基板はタイムアウトとして扱う (実行中の処理はソケットや
+    シーケンスのタイムアウトで終了する)。on_result(BoardResult) は呼び出し元のスレッドで完了順に呼ばれる。
+    """
+    if not boards:
+        return []
+    started = {}
+
+    def run(board):
+        started[board.name] = time.monotonic()
+        try:
+            ok, phase, detail, data = func(board)
+        except Exception as e:
+            ok, phase, detail, data = False, "エラー", str(e), None
+        return BoardResult(board, ok, phase, time.monotonic() - started[board.name], detail, data)
+
+    results = {}
+
+    def finish(result):
+        results[result.board.name] = result
+        if on_result:
+            on_result(result)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(boards)), thread_name_prefix="Rack")
+    try:
+        pending = {executor.submit(run, board): board for board in boards}
+        while pending:
+            done, _ = wait(pending, timeout=WATCH_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                finish(future.result())
+            now = time.monotonic()
+            for future, board in list(pending.items()):
+                start = started.get(board.name)
+                if start is not None and now - start > timeout:
+                    pending.pop(future)
+                    finish(BoardResult(board, False, "タイムアウト", now - start, f"{timeout:g}秒以内に終了しませんでした", None))
+    finally:
+        # タイムアウトした基板の処理は待たずに戻る
+        executor.shutdown(wait=False)
+    return [results[board.name] for board in boards]
+
+
+def run_command(boards, op_code, command_id, offset, data_size, source=None, repeat=1,
+                timeout=DEFAULT_TIMEOUT, max_workers=MAX_WORKERS, log=None, on_result=None):
+    """手動コマンドを全基板へ同時に送信する (source はファイルパスか bytes。基板ごとに先頭から送る)
+
+    log(board, level, message) に基板ごとのログが通知される。全回のステータスが 0 の基板を合格とする。
+    """
+    if hasattr(source, "read"):
+        source = source.read()
+    # 基板ごとの接続を並列に張るため、ソケットのタイムアウトもラックの制限時間に合わせた専用プールを使う
+    pool = BoardConnectionPool(timeout=timeout)
+
+    def command(board):
+        board_log = (lambda level, message: log(board, level, message)) if log else (lambda level, message: None)
+        result = engine.manual_command((board.ip, board.port), op_code, command_id, offset, data_size, repeat,
+                                       source=source, log=board_log, pool=pool)
+        failed = [status for status in result.statuses if status != 0]
+        if failed:
+            return False, "エラー", f"エラーステータス {failed[0]:#010x} ({len(failed)}/{repeat}回)", result.data
+        return True, "完了", f"ステータス {result.statuses[-1]:#010x} ({result.elapsed * 1000:.1f} ms)", result.data
+
+    try:
+        return fan_out(boards, command, timeout, max_workers, on_result)
+    finally:
+        pool.close_all()
+
+
+class _Router:
+    """報告ポートごとに1つのリスナーを立て、接続元IPで各基板のシーケンスへ振り分ける"""
+
+    def __init__(self, listen_host=APP_SERVER_ADDRESS[0]):
+        self.listen_host = listen_host
+        self.routes = {}        # 報告ポート -> {IP: (基板, シーケンス)}
+        self.listeners = {}
+
+    def add(self, board, sequence):
+        by_ip = self.routes.setdefault(board.listen_port, {})
+        if board.ip in by_ip:
+            other = by_ip[board.ip][0]
+            raise ValueError(f"{board.name} と {other.name} は同じIP ({board.ip}) で報告ポート {board.listen_port} も同じです。"
+                             "報告ポートを分けてください。")
+        by_ip[board.ip] = (board, sequence)
+
+    def listener(self, board):
+        return self.listeners[board.listen_port]
+
+    def start(self):
+        try:
+            for port, by_ip in self.routes.items():
+                def route(addr, by_ip=by_ip):
+                    if addr[0] not in by_ip:
+                        raise ConnectionError(f"基板リストに無い接続元です: {addr}")
+                    return by_ip[addr[0]][1].attach(addr)
+                listener = BoardListener(None, (self.listen_host, port), route=route)
+                listener.start()
+                self.listeners[port] = listener
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        for listener in self.listeners.values():
+            listener.stop()
+        self.listeners.clear()
+
+
+def run_sequences(boards, make_sequence, timeout=DEFAULT_TIMEOUT, on_event=None, on_result=None, result_data=None):
+    """make_sequence(board) で作ったシーケンスを全基板で同時に実行し、最終フェーズが "完了" の基板を合格とする
+
+    基板はそれぞれ独立に報告してくるため、全基板分のスレッドで同時に待ち受ける。
+
+    on_event(board, kind, value) にシーケンスのイベントが通知される (実行スレッドから呼ばれる)。
+    result_data(sequence) を指定した場合、その戻り値を BoardResult.data に入れる。
+    """
+    sequences = {board.name: make_sequence(board) for board in boards}
+    router = _Router()
+    for board in boards:
+        router.add(board, sequences[board.name])
+    router.start()
+    last_error = {}
+
+    def sequence_run(board):
+        sequence = sequences[board.name]
+
+        def event(kind, value):
+            if kind == "log" and value[1] == "error":
+                last_error[board.name] = value[2]
+            if on_event:
+                on_event(board, kind, value)
+
+        try:
+            phase = engine.run_sequence(sequence, timeout, event, listener=router.listener(board))
+        except TimeoutError as e:
+            return False, "タイムアウト", str(e), None
+        data = result_data(sequence) if result_data else None
+        return phase == "完了", phase, last_error.get(board.name, ""), data
+
+    try:
+        return fan_out(boards, sequence_run, timeout, len(boards), on_result)
+    finally:
+        for sequence in sequences.values():
+            sequence.stop()
+        router.stop()
+
+
+def run_init(boards, timeout=DEFAULT_TIMEOUT, **options):
+    """初期化シーケンスを全基板で同時に実行する"""
+    from sequences import InitSequence
+    return run_sequences(boards, lambda board: InitSequence(board_address=(board.ip, board.port)), timeout, **options)
+
+
+def _check_stages(boards, stage):
+    """全基板にステージが割り当てられ、基板ごとに別の装置であることを確認する"""
+    stages = {}
+    for board in boards:
+        board_stage = board.stage or stage
+        if board_stage is None:
+            raise ValueError(f"{board.name}: ステージのIP:ポートが指定されていません。")
+        if board_stage in stages:
+            raise ValueError(f"{board.name} と {stages[board_stage]} が同じステージ {board_stage[0]}:{board_stage[1]} を使っています。")
+        stages[board_stage] = board.name
+
+
+def run_line_scan(boards, param_data, axis_num, pulse_count, scan_data_size, stage=None, timeout=DEFAULT_TIMEOUT, **options):
+    """ラインスキャンを全基板で同時に実行する (ステージは基板リストの指定、無ければ stage を使う)
+
+    ステージは基板ごとに別の装置である必要がある (同じステージを複数の基板で同時に動かすことはできない)。
+    """
+    from sequences import LineScanSequence
+    _check_stages(boards, stage)
+
+    def make_sequence(board):
+        stage_ip, stage_port = board.stage or stage
+        return LineScanSequence(param_data, stage_ip, stage_port, axis_num, pulse_count, scan_data_size,
+                                board_address=(board.ip, board.port))
+
+    return run_sequences(boards, make_sequence, timeout, result_data=lambda sequence: sequence.scan_data, **options)
+
+
+def run_defined(boards, definition, params=None, stage=None, timeout=DEFAULT_TIMEOUT, **options):
+    """シーケンス定義 (sequence_def.py) を全基板で同時に実行する (ステージの扱いは run_line_scan と同じ)"""
+    from sequences import DefinedSequence
+    from sequence_def import uses_stage
+    if uses_stage(definition):
+        _check_stages(boards, stage)
+    return run_sequences(boards, lambda board: DefinedSequence(definition, params, stage=board.stage or stage,
+                                                               board_address=(board.ip, board.port)),
+                         timeout, result_data=lambda sequence: sequence.scan_data, **options)
+
+
+def passed(results):
+    """(合格数, 基板数) を返す"""
+    return sum(result.ok for result in results), len(results)
+
+
+def result_rows(results):
+    """基板ごとの結果を表示用の行 (dict) のリストにする"""
+    return [{"基板": r.board.name, "接続先": f"{r.board.ip}:{r.board.port}", "結果": "合格" if r.ok else "不合格",
+             "フェーズ": r.phase, "時間 (秒)": round(r.elapsed, 2), "詳細": r.detail} for r in results]
@@ -0,0 +1,238 @@
+import argparse
+import socket
+import sys
+import time
+from datetime import datetime
+import capture
+from capture import OPEN, SEND, RECV, CLOSE, EVENT_NAMES
+from protocol import HEADER_SIZE, STATUS_SIZE, decode_header, decode_status
+
+# --- キャプチャの表示と再生 ---
+# capture.py で記録したファイルを表示し、記録どおりの通信を再生する。
+#
+#   python replay.py info capture.jgcap
+#   python replay.py dump capture.jgcap --limit 50
+#   python replay.py board capture.jgcap --host 127.0.0.1      # 基板・ステージ役としてアプリに対して再生
+#   python replay.py app capture.jgcap --speed 0               # アプリ役として模擬基板/実機に対して再生
+#
+# board: アプリが接続した先 (基板・ステージ) で待ち受け、アプリが受信したデータを送り返す。アプリのリスナーへの
+#        報告も記録どおりに送るため、実機なしでアプリのシーケンスを再現できる。
+# app:   アプリが送信したデータを送り、相手からの応答を記録と比較する (模擬基板の回帰試験・性能比較用)。
+# --speed 1 は記録どおりの間隔、2 は2倍速、0 は待たずに最速で再生する (受信は相手の応答を待つ)。
+# 記録と異なるデータを受信した場合は不一致として報告し、終了コード 1 を返す。
+
+DEFAULT_TIMEOUT = 10.0
+
+
+def _preview(protocol, data, width=24):
+    data = bytes(data)
+    if protocol == "stage":
+        return repr(data[:width * 2].decode('ascii', 'replace'))
+    text = data[:width].hex(" ")
+    if len(data) in (HEADER_SIZE, HEADER_SIZE + 4, HEADER_SIZE + 4 + STATUS_SIZE):
+        header = decode_header(data)
+        text += f"  (OP:{header.op_code:#04x} ID:{header.command_id:#04x} オフセット:{header.offset} サイズ:{header.data_size}"
+        if len(data) > HEADER_SIZE:
+            text += f" Data:{decode_status(data, HEADER_SIZE):#x}"
+        text += ")"
+    elif len(data) == STATUS_SIZE:
+        text += f"  (ステータス {decode_status(data):#010x})"
+    elif len(data) > width:
+        text += " ..."
+    return text
+
+
+def cmd_info(args):
+    wall_ns, start_ns, streams, records = capture.read_capture(args.file)
+    started = datetime.fromtimestamp(wall_ns / 1e9)
+    duration = (records[-1].timestamp - start_ns) / 1e9 if records else 0
+    print(f"記録開始: {started:%Y-%m-%d %H:%M:%S.%f}  記録時間: {duration:.3f}秒  レコード: {len(records)}")
+    totals = {number: [0, 0] for number in streams}
+    for record in records:
+        if record.event in (SEND, RECV) and record.stream in totals:
+            totals[record.stream][record.event == RECV] += len(record.data)
+    print(f"{'#':>4}  {'プロトコル':6} {'方向':8} {'ローカル':22} {'相手':22} {'送信':>12} {'受信':>12}")
+    for number, stream in streams.items():
+        sent, received = totals[number]
+        role = "アプリ→" if stream.role == "client" else "→アプリ"
+        print(f"{number:>4}  {stream.protocol:6} {role:8} {capture.format_address(stream.local):22} "
+              f"{capture.format_address(stream.peer):22} {sent:>12,} {received:>12,}")
+    return 0
+
+
+def cmd_dump(args):
+    wall_ns, start_ns, streams, records = capture.read_capture(args.file)
+    for record in records[:args.limit or None]:
+        stream = streams.get(record.stream)
+        elapsed = (record.timestamp - start_ns) / 1e6
+        name = EVENT_NAMES.get(record.event, record.event)
+        if record.event == OPEN:
+            detail = f"{stream.protocol} {stream.role} {capture.format_address(stream.local)} <-> {capture.format_address(stream.peer)}"
+        elif record.event == CLOSE:
+            detail = ""
+        else:
+            detail = f"{len(record.data):>9,} bytes  {_preview(stream.protocol, record.data)}"
+        print(f"{elapsed:12.3f} ms  #{record.stream:<4} {name:5} {detail}")
+    return 0
+
+
+class Player:
+    """キャプチャの片側 (role = "app" / "board") を演じて通信を再生する"""
+
+    def __init__(self, role, streams, records, speed=1.0, mapping=None, host=None, timeout=DEFAULT_TIMEOUT, log=print):
+        self.role = role
+        self.streams = streams
+        self.records = records
+        self.speed = speed
+        self.mapping = mapping or {}
+        self.host = host
+        self.timeout = timeout
+        self.log = log
+        self.servers = {}
+        self.sockets = {}
+        self.mismatches = 0
+        self.bytes = 0
+
+    def address(self, address):
+        """記録上のアドレスを再生時の接続先/待ち受け先に変換する (--map, --host)"""
+        if address in self.mapping:
+            return self.mapping[address]
+        return (self.host, address[1]) if self.host else address
+
+    def _we_connect(self, stream):
+        # アプリ役はアプリが接続した相手へ接続し、基板役はアプリのリスナーへ接続する
+        return (stream.role == "client") == (self.role == "app")
+
+    def _endpoint(self, stream):
+        """接続先/待ち受け先。アプリが接続したストリームは相手側、基板から受けたストリームはアプリ側のアドレス"""
+        return self.address(stream.peer if stream.role == "client" else stream.local)
+
+    def start_servers(self):
+        """相手からの接続を受けるアドレスで、再生開始前に待ち受けておく"""
+        for stream in self.streams.values():
+            if self._we_connect(stream):
+                continue
+            address = self._endpoint(stream)
+            if address not in self.servers:
+                server = socket.create_server(address)
+                server.settimeout(self.timeout)
+                self.servers[address] = server
+                self.log(f"{capture.format_address(address)} で待ち受けます。({stream.protocol})")
+
+    def close(self):
+        for sock in list(self.sockets.values()) + list(self.servers.values()):
+            sock.close()
+        self.sockets.clear()
+        self.servers.clear()
+
+    def _wait_until(self, started, timestamp):
+        if self.speed <= 0:
+            return
+        delay = started + (timestamp - self.records[0].timestamp) / 1e9 / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _receive(self, sock, expected):
+        view = memoryview(bytearray(len(expected)))
+        received = 0
+        while received < len(expected):
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError(f"受信途中で接続が切断されました ({received}/{len(expected)} bytes)")
+            received += n
+        return view
+
+    def play(self):
+        """記録の順に再生し、(所要秒, 記録上の所要秒) を返す"""
+        self.start_servers()
+        started = time.monotonic()
+        for record in self.records:
+            stream = self.streams[record.stream]
+            if record.event == OPEN:
+                self._wait_until(started, record.timestamp)
+                address = self._endpoint(stream)
+                if self._we_connect(stream):
+                    sock = socket.create_connection(address, timeout=self.timeout)
+                else:
+                    sock, _ = self.servers[address].accept()
+                    sock.settimeout(self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.sockets[record.stream] = sock
+            elif record.event == CLOSE:
+                sock = self.sockets.pop(record.stream, None)
+                if sock:
+                    sock.close()
+            elif record.stream in self.sockets:
+                sock = self.sockets[record.stream]
+                ours = (record.event == SEND) == (self.role == "app")
+                if ours:
+                    self._wait_until(started, record.timestamp)
+                    sock.sendall(record.data)
+                else:
+                    received = self._receive(sock, record.data)
+                    if received != record.data:
+                        self.mismatches += 1
+                        self.log(f"#{record.stream} 記録と異なるデータを受信しました: {_preview(stream.protocol, received)}"
+                                 f" (記録: {_preview(stream.protocol, record.data)})")
+                self.bytes += len(record.data)
+        elapsed = time.monotonic() - started
+        recorded = (self.records[-1].timestamp - self.records[0].timestamp) / 1e9 if self.records else 0
+        return elapsed, recorded
+
+
+def parse_mapping(items):
+    mapping = {}
+    for item in items or []:
+        source, sep, target = item.partition("=")
+        if not sep:
+            raise ValueError(f"--map は 記録上のIP:ポート=再生時のIP:ポート の形式で指定してください: {item}")
+        mapping[capture.parse_address(source)] = capture.parse_address(target)
+    return mapping
+
+
+def cmd_play(args):
+    _, _, streams, records = capture.read_capture(args.file)
+    protocols = set(args.protocol or ["board", "stage"])
+    numbers = {number for number, stream in streams.items() if stream.protocol in protocols}
+    records = [record for record in records if record.stream in numbers]
+    if not records:
+        print("再生するレコードがありません。", file=sys.stderr)
+        return 1
+    player = Player(args.command, {n: streams[n] for n in numbers}, records, args.speed, parse_mapping(args.map),
+                    args.host, args.timeout, log=lambda message: print(message, file=sys.stderr))
+    try:
+        elapsed, recorded = player.play()
+    except (OSError, ConnectionError) as e:
+        print(f"エラー: 再生を中断しました。({e})", file=sys.stderr)
+        return 1
+    finally:
+        player.close()
+    print(f"再生完了: {len(records)} レコード, {player.bytes:,} bytes, {elapsed:.3f}秒 (記録 {recorded:.3f}秒), 不一致 {player.mismatches} 件")
+    return 0 if player.mismatches == 0 else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="通信キャプチャの表示と再生")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("info", help="記録の概要 (ストリームごとの送受信量) を表示する")
+    p.add_argument("file")
+    p.set_defaults(func=cmd_info)
+    p = sub.add_parser("dump", help="レコードを順に表示する")
+    p.add_argument("file")
+    p.add_argument("--limit", type=int, default=0, help="表示するレコード数 (0 で全件)")
+    p.set_defaults(func=cmd_dump)
+    for role, help_text in (("board", "基板・ステージ役としてアプリに対して再生する"), ("app", "アプリ役として模擬基板/実機に対して再生する")):
+        p = sub.add_parser(role, help=help_text)
+        p.add_argument("file")
+        p.add_argument("--speed", type=float, default=1.0, help="再生速度 (1 で記録どおり, 0 で待たずに最速)")
+        p.add_argument("--host", help="記録上のIPをすべてこのIPに置き換える (ポートはそのまま)")
+        p.add_argument("--map", action="append", metavar="IP:ポート=IP:ポート", help="記録上のアドレスを置き換える (複数指定可)")
+        p.add_argument("--protocol", action="append", choices=["board", "stage"], help="再生するプロトコル (省略時は両方)")
+        p.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="接続・受信の制限時間 (秒)")
+        p.set_defaults(func=cmd_play)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,66 @@
+import numpy as np
+
+# --- スキャンデータ (ID:0x54 読み出し結果) の解析 ---
+# 受信したバイト列をコピーせずに np.frombuffer で型付き配列として解釈し、
+# 統計量の計算や表示用の間引きはすべて配列演算で行う。
+
+# 画面で選べるサンプル型
+DTYPES = {"uint8": "u1", "int8": "i1", "uint16": "u2", "int16": "i2", "uint32": "u4", "int32": "i4", "float32": "f4"}
+BYTEORDERS = {"ビッグエンディアン": ">", "リトルエンディアン": "<"}
+
+# グラフに送る1チャンネルあたりの最大点数 (min/max の2系列なので実際はこの2倍)
+MAX_PLOT_POINTS = 2000
+
+
+def decode(buf, dtype="uint16", byteorder=">", channels=1, interleaved=True):
+    """バイト列を (チャンネル数, サンプル数) の配列として解釈する (コピーしないビューを返す)
+
+    interleaved=True はサンプルごとに全チャンネルが並ぶ形式 (c0 c1 c0 c1 ...)、
+    False はチャンネルごとのブロックが続く形式 (c0 c0 ... c1 c1 ...)。
+    1フレームに満たない末尾のバイトは無視する。
+    """
+    dt = np.dtype(DTYPES.get(dtype, dtype)).newbyteorder(byteorder)
+    samples = len(buf) // (dt.itemsize * channels)
+    values = np.frombuffer(buf, dtype=dt, count=samples * channels)
+    if interleaved:
+        return values.reshape(samples, channels).T
+    return values.reshape(channels, samples)
+
+
+def unused_bytes(buf, dtype="uint16", channels=1):
+    """decode で無視される末尾のバイト数"""
+    return len(buf) % (np.dtype(DTYPES.get(dtype, dtype)).itemsize * channels)
+
+
+def summarize(data):
+    """チャンネルごとの統計量を {列名: 配列} で返す"""
+    if data.shape[1] == 0:
+        return {"チャンネル": np.arange(data.shape[0])}
+    return {
+        "チャンネル": np.arange(data.shape[0]),
+        "最小": data.min(axis=1),
+        "最大": data.max(axis=1),
+        "平均": data.mean(axis=1, dtype=np.float64),
+        "標準偏差": data.std(axis=1, dtype=np.float64),
+    }
+
+
+def decimate_minmax(data, max_points=MAX_PLOT_POINTS):
+    """区間ごとの最小値/最大値に間引き、(区間先頭のサンプル番号, 最小値, 最大値) を返す
+
+    単純な間引きと違い、区間内のピークがグラフから消えない。
+    """
+    channels, samples = data.shape
+    if samples <= max_points:
+        return np.arange(samples), data, data
+    step = -(-samples // max_points)
+    bins = samples // step
+    body = data[:, :bins * step].reshape(channels, bins, step)
+    lo, hi = body.min(axis=2), body.max(axis=2)
+    if bins * step < samples:
+        # 端数の区間も落とさずに加える
+        tail = data[:, bins * step:]
+        lo = np.concatenate([lo, tail.min(axis=1, keepdims=True)], axis=1)
+        hi = np.concatenate([hi, tail.max(axis=1, keepdims=True)], axis=1)
+        bins += 1
+    return np.arange(bins) * step, lo, hi
@@ -0,0 +1,185 @@
+import json
+import os
+
+# --- シーケンス定義 (JSON) ---
+# 状態・基板からの報告 (コマンドID/データ)・アクション・制限時間を宣言的に記述する。
+# アプリ側は sequences.DefinedSequence が、基板側は mock_board_defined.py が同じ定義で動くため、
+# 新しいシーケンスはコードを変更せずに定義ファイルを追加するだけで試験・模擬できる。
+#
+# {
+#   "name": "初期化シーケンス",
+#   "params": {"reconstruct": "0x2E"},          既定のパラメータ (数値の欄で "$名前" として参照する)
+#   "initial": "待機中",
+#   "timeout": 300,                              シーケンス全体の制限時間 (秒, 省略時は無制限)
+#   "states": {
+#     "待機中": {"on": [{"report": {"id": 3, "data": 0}, "next": "INITIALIZE"}]},
+#     "STANDBY": {"enter": [{"board": {"id": 1, "data": "$reconstruct"}}], "timeout": 30, "on": [...]},
+#     "完了": {"final": true}
+#   }
+# }
+#
+# 状態の項目:
+#   enter       状態に入ったときに順に実行するアクション
+#   on          基板からの報告ごとの遷移 [{"report": {"id", "data" (省略時は任意)}, "do": [アクション], "next": 状態}]
+#               "delay" は模擬基板がその報告を送るまでの秒数 (基板の内部処理の模擬。アプリ側では使わない)
+#   next        enter の実行後、報告を待たずに遷移する先
+#   timeout     報告を待つ制限時間 (秒)。超えた場合は on_timeout の状態へ (省略時はエラー)
+#   final       終了状態。状態名が最終フェーズになる ("完了" なら合格)
+# アクション:
+#   {"board": {"id", "data"}}                   基板へ4バイトデータ付きの書き込みコマンドを送信する
+#   {"read": {"id", "size", "offset"}}          基板から読み出す (受信データはシーケンスの scan_data になる)
+#   {"stage": {"home": true}}                   FC-511 の原点復帰 (軸は "axis" か、パラメータ axis)
+#   {"stage": {"move": "$pulses"}}              FC-511 の相対移動
+#   {"log": "メッセージ"}                       ログ出力 ({名前} でパラメータを埋め込める)
+# 数値の欄には 10進/"0x.." 形式の文字列/"$パラメータ名" を書ける。
+
+DEFINITION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sequence_defs")
+ACTIONS = ("board", "read", "stage", "log")
+
+
+class DefinitionError(ValueError):
+    """シーケンス定義の書式エラー"""
+
+
+def definition_path(name):
+    """名前だけの場合は sequence_defs/<名前>.json を指す"""
+    if os.path.splitext(name)[1] or os.path.dirname(name):
+        return name
+    return os.path.join(DEFINITION_DIR, name + ".json")
+
+
+def list_definitions():
+    """sequence_defs にある定義の名前の一覧"""
+    if not os.path.isdir(DEFINITION_DIR):
+        return []
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(DEFINITION_DIR) if name.endswith(".json"))
+
+
+def load_definition(name):
+    path = definition_path(name)
+    with open(path, encoding="utf-8") as f:
+        try:
+            definition = json.load(f)
+        except json.JSONDecodeError as e:
+            raise DefinitionError(f"{path}: JSONとして読み込めません ({e})") from None
+    try:
+        validate(definition)
+    except DefinitionError as e:
+        raise DefinitionError(f"{path}: {e}") from None
+    return definition
+
+
+def validate(definition):
+    """状態・遷移先・アクションの書式を確認する (パラメータの値は実行時に解決する)"""
+    states = definition.get("states")
+    if not isinstance(states, dict) or not states:
+        raise DefinitionError("states がありません。")
+    if definition.get("initial") not in states:
+        raise DefinitionError(f"初期状態 {definition.get('initial')!r} が states にありません。")
+    if not any(spec.get("final") for spec in states.values()):
+        raise DefinitionError("終了状態 (final) がありません。")
+
+    def check_target(state, target):
+        if target not in states:
+            raise DefinitionError(f"状態「{state}」の遷移先 {target!r} が states にありません。")
+
+    def check_actions(state, actions):
+        for action in actions:
+            if not isinstance(action, dict) or len(action) != 1 or next(iter(action)) not in ACTIONS:
+                raise DefinitionError(f"状態「{state}」のアクション {action!r} を解釈できません。({' / '.join(ACTIONS)})")
+
+    for state, spec in states.items():
+        check_actions(state, spec.get("enter", []))
+        if spec.get("final"):
+            continue
+        if "next" in spec:
+            check_target(state, spec["next"])
+            continue
+        if not spec.get("on"):
+            raise DefinitionError(f"状態「{state}」に遷移 (on / next) がありません。")
+        for transition in spec["on"]:
+            if "id" not in transition.get("report", {}):
+                raise DefinitionError(f"状態「{state}」の遷移に報告のコマンドID (report.id) がありません。")
+            check_target(state, transition.get("next"))
+            check_actions(state, transition.get("do", []))
+        if "on_timeout" in spec:
+            check_target(state, spec["on_timeout"])
+
+
+def resolve(value, params):
+    """数値の欄の値を整数にする ("$名前" はパラメータ、文字列は 10進/0x.. として解釈)"""
+    if isinstance(value, str) and value.startswith("$"):
+        try:
+            value = params[value[1:]]
+        except KeyError:
+            raise DefinitionError(f"パラメータ {value[1:]} が指定されていません。") from None
+    if isinstance(value, str):
+        try:
+            return int(value, 0)
+        except ValueError:
+            raise DefinitionError(f"数値として解釈できません: {value!r}") from None
+    return value
+
+
+def merge_params(definition, params=None):
+    """定義の既定値に呼び出し側のパラメータを上書きする"""
+    return {**definition.get("params", {}), **(params or {})}
+
+
+def parse_params(items):
+    """["名前=値", ...] を {名前: 値} にする (値は文字列のまま。数値の欄で使うときに解釈する)"""
+    params = {}
+    for item in items or []:
+        name, sep, value = item.partition("=")
+        if not sep or not name.strip():
+            raise DefinitionError(f"パラメータは 名前=値 の形式で指定してください: {item}")
+        params[name.strip()] = value.strip()
+    return params
+
+
+def uses_stage(definition):
+    """定義に FC-511 を動かすアクションがあるか"""
+    specs = definition["states"].values()
+    actions = [action for spec in specs for action in spec.get("enter", [])]
+    actions += [action for spec in specs for transition in spec.get("on", []) for action in transition.get("do", [])]
+    return any("stage" in action for action in actions)
+
+
+def _board_side(actions, params):
+    """アプリ側のアクションのうち、基板が受け取るコマンドを模擬基板の手順にする"""
+    steps = []
+    for action in actions:
+        kind, arg = next(iter(action.items()))
+        if kind in ("board", "read"):
+            steps.append(("expect", resolve(arg["id"], params)))
+    return steps
+
+
+def board_script(definition, params=None):
+    """定義の正常系 (各状態の最初の遷移) をたどり、模擬基板の手順を返す
+
+    手順は ("expect", コマンドID) = アプリからのコマンドを待つ、
+    ("report", コマンドID, データ, 遅延秒) = アプリへ報告する、のリスト。
+    """
+    params = merge_params(definition, params)
+    states = definition["states"]
+    state = definition["initial"]
+    steps = []
+    visited = set()
+    while True:
+        if state in visited:
+            raise DefinitionError(f"正常系の遷移が状態「{state}」でループしています。")
+        visited.add(state)
+        spec = states[state]
+        steps += _board_side(spec.get("enter", []), params)
+        if spec.get("final"):
+            return steps
+        if "next" in spec:
+            state = spec["next"]
+            continue
+        transition = spec["on"][0]
+        report = transition["report"]
+        steps.append(("report", resolve(report["id"], params), resolve(report.get("data", 0), params),
+                      float(transition.get("delay", 0))))
+        steps += _board_side(transition.get("do", []), params)
+        state = transition["next"]
@@ -0,0 +1,372 @@
+import queue
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from board_client import get_pool
+from protocol import create_command_packet, encode_value_command, decode_status, OP_READ
+from listener import BoardListener, APP_SERVER_ADDRESS
+from stage_client import Fc511Client, StageError
+from sequence_def import load_definition, merge_params, resolve, uses_stage
+import metrics
+
+# --- 基板との連携シーケンス ---
+# 各シーケンスは BoardListener のスレッド上で基板からのフレームを即座に処理し、
+# UIへの通知 (ログ/フェーズ/受信データ) を events キューに積む。UI側はキューを取り出して表示する。
+
+# 基板側サーバー (アプリからの指令を受け付けるポート)
+BOARD_SERVER_ADDRESS = ('127.0.0.1', 60202)
+
+
+class BoardSequence(ABC):
+    """基板からの要求に応答するシーケンスの共通部分"""
+
+    def __init__(self, listen_address=APP_SERVER_ADDRESS, board_address=BOARD_SERVER_ADDRESS, pool=None, payload_store=None):
+        self.listen_address = listen_address
+        self.board_address = board_address
+        self.pool = pool or get_pool()
+        # 指定した場合、読み出しデータは scan_data (bytes) ではなく一時ファイル (scan_payload) に受信する
+        self.payload_store = payload_store
+        self.scan_payload = None
+        self.events = queue.Queue()
+        self.phase = "未開始"
+        self.listener = None
+        self._shared_listener = False
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.listener is not None and self.listener.running and not self._finished.is_set()
+
+    def log(self, message, level="info"):
+        self.events.put(("log", (datetime.now(), level, message)))
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self.events.put(("phase", phase))
+
+    def start(self, listener=None):
+        """listener を渡した場合は、自前で待ち受けずに共有のリスナー (ラック運用時) から attach() で接続を受け取る"""
+        self._finished.clear()
+        self._shared_listener = listener is not None
+        if listener is None:
+            listener = BoardListener(self._on_frame, self.listen_address, on_error=self._on_error, on_connect=self._on_connect)
+            listener.start()
+        self.listener = listener
+
+    def receive(self, board, size, name, out=None):
+        """読み出しデータを受信して (データ, MB/s) を返す
+
+        out を指定した場合はそこへ、payload_store がある場合は一時ファイルへ直接受信する
+        (後者はデータを scan_payload に入れ、戻り値のデータは None)。
+        """
+        if out is not None:
+            return out, board.read_into(out)
+        if self.payload_store is None:
+            return board.read_bulk(size)
+        with self.payload_store.writing(size, name) as (payload, view):
+            mb_per_sec = board.read_into(view)
+        self.scan_payload = payload
+        return None, mb_per_sec
+
+    def stop(self):
+        self._finished.set()
+        if self.listener and not self._shared_listener:
+            self.listener.stop()
+
+    def attach(self, addr):
+        """共有のリスナーからこのシーケンス宛ての接続を引き受け、(handler, on_error) を返す"""
+        self._on_connect(addr)
+        return self._on_frame, self._on_error
+
+    def send_command(self, command_id, data_value):
+        """基板へ4バイトデータ付きの書き込みコマンドを送信し、ステータスを返す"""
+        status = self.pool.request(self.board_address, encode_value_command(command_id, data_value))
+        return decode_status(status)
+
+    def check_status(self, command_id, status):
+        """エラーステータスなら例外を送出する (ハンドラ内ならシーケンスはエラーで終了する)"""
+        if status != 0:
+            raise RuntimeError(f"基板がコマンド ID:{hex(command_id)} にエラーステータス {status:#010x} を返しました。")
+
+    @abstractmethod
+    def handle(self, frame):
+        """基板からのフレーム (ヘッダ) を1つ処理する (リスナーのスレッドから呼ばれる)"""
+
+    def _on_connect(self, addr):
+        self.log(f"基板から接続: {addr}")
+
+    def _on_frame(self, frame):
+        with self._lock:
+            if self._finished.is_set():
+                return
+            try:
+                self.handle(frame)
+            except Exception as e:
+                self._on_error(e)
+
+    def _on_error(self, e):
+        self.log(f"エラー: {e}", "error")
+        self.set_phase("エラー")
+        self.stop()
+
+
+class DefinedSequence(BoardSequence):
+    """シーケンス定義 (sequence_def.py) を状態機械として実行する
+
+    遷移は基板からの報告で起こり、報告待ちの制限時間は状態ごとの期限タイマーで監視する
+    (固定の待ち時間は入れない)。stage は定義で FC-511 を使う場合の (IP, ポート)。
+    """
+
+    def __init__(self, definition, params=None, stage=None, estimator=None, **kwargs):
+        super().__init__(**kwargs)
+        self.definition = load_definition(definition) if isinstance(definition, str) else definition
+        self.params = merge_params(self.definition, params)
+        self.stage_address = stage
+        self.estimator = estimator
+        self.stage = None
+        self.state = None
+        self.scan_data = None
+        self._state_timer = None
+        self._total_timer = None
+        self._waiting_since = None
+
+    @property
+    def name(self):
+        return self.definition.get("name", "シーケンス")
+
+    def start(self, listener=None):
+        # 基板からの報告を受けるため、先にサーバーを起動しておく。
+        # 初期状態に入るまでに届いた報告はロックで待たせる (state が決まる前に handle しない)
+        try:
+            with self._lock:
+                super().start(listener)
+                if uses_stage(self.definition):
+                    if self.stage_address is None:
+                        raise ValueError(f"{self.name}: ステージのIP:ポートが指定されていません。")
+                    self.log(f"ステージ ({self.stage_address[0]}:{self.stage_address[1]}) へ接続します...")
+                    self.stage = Fc511Client(*self.stage_address).connect()
+                total = self.definition.get("timeout")
+                if total:
+                    self._total_timer = self._start_timer(total, self._on_total_timeout)
+                self.enter(self.definition["initial"])
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        super().stop()
+        for timer in (self._state_timer, self._total_timer):
+            if timer:
+                timer.cancel()
+        if self.stage:
+            self.stage.close()
+
+    def _start_timer(self, seconds, callback, *args):
+        timer = threading.Timer(seconds, callback, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def enter(self, state):
+        """state に遷移し、enter のアクションを実行する (報告を待たない遷移は続けてたどる)"""
+        if self._state_timer:
+            self._state_timer.cancel()
+        while True:
+            self.state = state
+            spec = self.definition["states"][state]
+            self.set_phase(state)
+            self.run_actions(spec.get("enter", []))
+            if spec.get("final"):
+                state = self.on_final(state)
+                if state is None:
+                    return
+                continue
+            if "next" not in spec:
+                break
+            state = spec["next"]
+        self._waiting_since = time.perf_counter()
+        if spec.get("timeout"):
+            self._state_timer = self._start_timer(spec["timeout"], self._on_state_timeout, state)
+
+    def on_final(self, state):
+        """最終状態に入ったときの処理。状態を返すと、シーケンスを終えずにその状態から続ける"""
+        if state == "完了":
+            self.log(f"{self.name}が完了しました。", "success")
+        self.stop()
+        return None
+
+    def handle(self, frame):
+        cmd_id, data = frame.command_id, frame.data_value or 0
+        if self.state is None:
+            self.log(f"基板からコマンド受信 - ID:{hex(cmd_id)}, Data:{hex(data)} (開始前のため無視します)", "warning")
+            return
+        for transition in self.definition["states"][self.state].get("on", []):
+            report = transition["report"]
+            if cmd_id != resolve(report["id"], self.params):
+                continue
+            if "data" in report and data != resolve(report["data"], self.params):
+                continue
+            received, state = time.perf_counter(), self.state
+            metrics.observe("sequence_wait", received - self._waiting_since, sequence=self.name, state=state)
+            self.log(f"基板から報告を受信 - ID:{hex(cmd_id)}, Data:{hex(data)} -> {transition['next']}")
+            self.run_actions(transition.get("do", []))
+            self.enter(transition["next"])
+            metrics.observe("sequence_reaction", time.perf_counter() - received, sequence=self.name, state=state)
+            return
+        self.log(f"基板からコマンド受信 - ID:{hex(cmd_id)}, Data:{hex(data)} (状態「{self.state}」では想定外のため無視します)", "warning")
+
+    def run_actions(self, actions):
+        for action in actions:
+            kind, arg = next(iter(action.items()))
+            if kind == "log":
+                self.log(arg.format(**self.params))
+            elif kind == "board":
+                command_id, data = resolve(arg["id"], self.params), resolve(arg.get("data", 0), self.params)
+                self.check_status(command_id, self.send_command(command_id, data))
+            elif kind == "read":
+                self.read_data(resolve(arg["id"], self.params), resolve(arg["size"], self.params),
+                               resolve(arg.get("offset", 0), self.params))
+            elif kind == "stage":
+                self.move_stage(arg)
+
+    def read_data(self, command_id, size, offset=0, out=None):
+        """データを読み出して scan_data (payload_store がある場合は scan_payload) に入れる。out を指定した場合はそこへ直接受信する"""
+        self.log(f"データ(ID:{hex(command_id)}, {size} bytes)を読み出します。")
+        with self.pool.connection(self.board_address) as board:
+            board.sendall(create_command_packet(OP_READ, command_id, offset, size))
+            data, mb_per_sec = self.receive(board, size, f"data_{command_id:02x}.bin", out)
+            status = board.recv_exact(4)
+        self.scan_data = bytes(data) if data is not None else None
+        self.events.put(("scan_data", self.scan_payload if data is None else self.scan_data))
+        self.log(f"データ受信完了。ステータス: {status.hex()} ({mb_per_sec:.1f} MB/s)")
+
+    def move_stage(self, arg):
+        """FC-511 で原点復帰 / 相対移動し、停止を確認する (失敗時は例外でシーケンスをエラーにする)"""
+        axis = resolve(arg.get("axis", "$axis"), self.params)
+        pulses = resolve(arg["move"], self.params) if "move" in arg else None
+        setup_command = f"H:{axis}" if pulses is None else Fc511Client.move_command(axis, pulses)
+        self.log(f"コマンド送信: {setup_command} / G")
+        try:
+            record = self.stage.move(axis, setup_command, self.estimator, pulses, timeout=120)
+        except socket.timeout:
+            raise StageError("ステージとの通信がタイムアウトしました。") from None
+        self.log(f"ステージ停止を確認しました。(実測 {record.actual:.2f}秒, ポーリング {record.polls}回)")
+
+    def _on_state_timeout(self, state):
+        with self._lock:
+            if self._finished.is_set() or self.state != state:
+                return
+            spec = self.definition["states"][state]
+            try:
+                if "on_timeout" not in spec:
+                    raise TimeoutError(f"状態「{state}」で {spec['timeout']}秒以内に基板からの報告がありませんでした。")
+                self.log(f"状態「{state}」で {spec['timeout']}秒以内に基板からの報告がありませんでした。-> {spec['on_timeout']}", "warning")
+                self.enter(spec["on_timeout"])
+            except Exception as e:
+                self._on_error(e)
+
+    def _on_total_timeout(self):
+        with self._lock:
+            if not self._finished.is_set():
+                self._on_error(TimeoutError(f"{self.name}が {self.definition['timeout']}秒以内に終了しませんでした。(状態: {self.state})"))
+
+
+class InitSequence(DefinedSequence):
+    """初期化シーケンス (sequence_defs/init.json): 基板の状態遷移報告を監視し、STANDBYでRECONSTRUCT指令を送る"""
+
+    def __init__(self, **kwargs):
+        super().__init__("init", **kwargs)
+
+
+class LineScanSequence(DefinedSequence):
+    """ラインスキャンシーケンス (sequence_defs/linescan.json): 基板からのステージ移動依頼に応じてFC-511を動かし、最後にデータを読み出す"""
+
+    def __init__(self, param_data, stage_ip, stage_port, axis_num, pulse_count, scan_data_size, estimator=None, **kwargs):
+        params = {"param": param_data, "axis": axis_num, "pulses": pulse_count, "size": scan_data_size}
+        super().__init__("linescan", params, stage=(stage_ip, stage_port), estimator=estimator, **kwargs)
+        self.axis_num = axis_num
+        self.scan_data_size = scan_data_size
+
+
+class RasterScanSequence(LineScanSequence):
+    """ラスタースキャン: ラインスキャンを lines 回繰り返し、ライン間で第2軸を step_pulses ずつ送る
+
+    ライン k のデータ読み出し中に、ステージはライン k+1 の開始位置 (走査軸の原点復帰 + 第2軸の送り) へ
+    別スレッドで移動を始めておき、基板から次の助走位置移動依頼 (0x05) が来た時点で完了を待つ。
+    各ラインのデータはメモリマップした出力ファイル (.npy, lines x scan_data_size) の k 行目へ直接受信する。
+    ラインごとの手順は linescan.json をたどり、「完了」に入るたびに次のラインとして初期状態から繰り返す。
+    """
+
+    def __init__(self, param_data, stage_ip, stage_port, axis_num, pulse_count, scan_data_size,
+                 lines, step_axis, step_pulses, output_path, **kwargs):
+        super().__init__(param_data, stage_ip, stage_port, axis_num, pulse_count, scan_data_size, **kwargs)
+        self.lines = lines
+        self.step_axis = step_axis
+        self.step_pulses = step_pulses
+        self.output_path = output_path
+        self.output = None
+        self.line = 0
+        self._positioning = None
+        self._positioning_ok = False
+
+    def start(self, listener=None):
+        import numpy as np  # ラスタースキャンだけが使うので、ここで読み込む
+        self.output = np.lib.format.open_memmap(self.output_path, mode='w+', dtype=np.uint8,
+                                                shape=(self.lines, self.scan_data_size))
+        self.log(f"出力ファイル: {self.output_path} ({self.lines} x {self.scan_data_size} bytes)")
+        super().start(listener)
+
+    def set_phase(self, phase):
+        if phase not in ("完了", "エラー"):
+            phase = f"[ライン {self.line + 1}/{self.lines}] {phase}"
+        super().set_phase(phase)
+
+    def move_stage(self, arg):
+        if self.line > 0 and "move" not in arg:
+            # 2ライン目以降の助走位置は、前ラインの読み出し中に移動を始めている
+            self.set_phase("次ライン開始位置への移動完了待ち...")
+            self._positioning.join()
+            if not self._positioning_ok:
+                raise StageError("次ライン開始位置への移動に失敗しました。")
+            return
+        super().move_stage(arg)
+
+    def read_data(self, command_id, size, offset=0, out=None):
+        if self.line + 1 < self.lines:
+            self.start_positioning()
+        super().read_data(command_id, size, offset, out=self.output[self.line])
+        self.output.flush()
+        self.log(f"ライン {self.line + 1}/{self.lines} のデータを書き込みました。")
+
+    def on_final(self, state):
+        if state == "完了" and self.line + 1 < self.lines:
+            self.line += 1
+            return self.definition["initial"]
+        if state == "完了":
+            if self.payload_store is not None:
+                # 画面の表示用に最終ラインだけを一時ファイルに置く (全ラインは出力ファイルにある)
+                self.scan_payload = self.payload_store.put(self.output[self.line], "scan_data.bin")
+            self.log(f"ラスタースキャン完了 ({self.lines} ライン)。", "success")
+        self.stop()
+        return None
+
+    def start_positioning(self):
+        """次ラインの開始位置 (走査軸の原点 + 第2軸を1ステップ送った位置) への移動を別スレッドで始める"""
+        def run():
+            try:
+                LineScanSequence.move_stage(self, {"home": True})
+                LineScanSequence.move_stage(self, {"axis": self.step_axis, "move": self.step_pulses})
+                self._positioning_ok = True
+            except Exception as e:
+                self.log(f"エラー: {e}", "error")
+        self._positioning_ok = False
+        self._positioning = threading.Thread(target=run, name="RasterPositioning", daemon=True)
+        self._positioning.start()
+
+    def stop(self):
+        super().stop()
+        if self.output is not None:
+            self.output.flush()
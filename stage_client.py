@@ -0,0 +1,323 @@
+import math
+import socket
+import time
+from collections import deque, namedtuple
+import capture
+import metrics
+
+# --- ステージコントローラ (ASCII行プロトコル) 用クライアント ---
+# 応答をまとめて受信してバッファから行単位で切り出すため、1文字ごとの recv は行わない。
+# 複数コマンドを続けて送信し (パイプライン)、応答を送信順に対応付けることもできる。
+
+RECV_SIZE = 4096
+
+# 1回の移動の記録 (予測時間と実際の待ち時間を比較し、モデルの補正に使う)
+MoveRecord = namedtuple('MoveRecord', 'axis command pulses estimated actual polls poll_interval')
+
+
+class StageError(Exception):
+    """ステージの応答異常・動作完了待ちのタイムアウト"""
+
+
+class LineClient:
+    """CR/LF 区切りのASCIIコマンドプロトコル用のバッファ付きクライアント"""
+
+    # 計測 (metrics) のラベルに使うコントローラ名
+    controller = "stage"
+
+    def __init__(self, ip, port, timeout=5.0, terminator='\r\n'):
+        self.address = (ip, int(port))
+        self.timeout = timeout
+        self.terminator = terminator
+        self.sock = None
+        self._buf = bytearray()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = capture.wrap(sock, "stage", self.address)
+        self._buf.clear()
+        return self
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        if self.sock is None:
+            self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def send(self, *commands):
+        """コマンドを (複数ならまとめて1回で) 送信する。応答は待たない"""
+        payload = ''.join(command + self.terminator for command in commands)
+        self.sock.sendall(payload.encode('ascii'))
+
+    def read_line(self):
+        """応答を1行読む。CR, LF, CRLF のいずれも行末として扱い、空行は読み飛ばす"""
+        while True:
+            line = self._pop_line()
+            if line is not None:
+                return line
+            chunk = self.sock.recv(RECV_SIZE)
+            if not chunk:
+                raise ConnectionError("ステージとの接続が切断されました。")
+            self._buf += chunk
+
+    def _pop_line(self):
+        while True:
+            ends = [i for i in (self._buf.find(b'\r'), self._buf.find(b'\n')) if i >= 0]
+            if not ends:
+                return None
+            end = min(ends)
+            line = self._buf[:end].decode('ascii').strip()
+            del self._buf[:end + 1]
+            if line:
+                return line
+
+    def query(self, command):
+        """コマンドを送信し、応答1行を返す"""
+        self.send(command)
+        return self.read_line()
+
+    def pipeline(self, *commands):
+        """複数コマンドを続けて送信し、応答を送信順のリストで返す (往復1回分の待ち時間で済む)"""
+        self.send(*commands)
+        return [self.read_line() for _ in commands]
+
+
+class AriesClient(LineClient):
+    """神津精機 ARIES コントローラ用クライアント (CRLF 終端)"""
+
+    controller = "aries"
+
+    def execute(self, setup_command, pipelined=True):
+        """セットアップコマンド (ORG, MVR など) と実行(G)コマンドを送信し、応答の組を返す
+
+        pipelined=True の場合は2つを続けて送信し、応答を順に対応付ける。
+        """
+        with metrics.timer("stage_command", controller=self.controller):
+            if pipelined:
+                return tuple(self.pipeline(setup_command, 'G'))
+            response = self.query(setup_command)
+            if response != "OK":
+                return response, None
+            return response, self.query('G')
+
+    def status(self, axis):
+        """?S:{axis} で軸の状態を問い合わせる ("0": READY, "1": BUSY)"""
+        return self.query(f"?S:{axis}")
+
+    def start_moves(self, setup_commands):
+        """複数軸のセットアップコマンドと G をまとめて送信し、全軸の動作を同時に開始する"""
+        commands = []
+        for setup_command in setup_commands:
+            commands += [setup_command, 'G']
+        with metrics.timer("stage_command", controller=self.controller):
+            responses = self.pipeline(*commands)
+        for command, response in zip(commands, responses):
+            if response != "OK":
+                raise StageError(f"{command} が受理されませんでした。({response})")
+
+    def move_axes(self, moves, estimator=None, **wait_options):
+        """[(軸, セットアップコマンド, パルス数 or None), ...] を同時に実行し、全軸の完了を待って MoveRecord のリストを返す"""
+        self.start_moves([setup_command for _, setup_command, _ in moves])
+        estimates = {axis: estimator.estimate(axis, pulses) if estimator else None for axis, _, pulses in moves}
+        results = wait_until_ready_all(self, estimates, **wait_options)
+        records = []
+        for axis, setup_command, pulses in moves:
+            actual, polls, interval = results[axis]
+            record = MoveRecord(axis, setup_command, pulses, estimates[axis], actual, polls, interval)
+            metrics.observe("stage_wait", actual, controller=self.controller, axis=axis)
+            if estimator:
+                estimator.record(record)
+            records.append(record)
+        return records
+
+    def move(self, axis, setup_command, estimator=None, pulses=None, **wait_options):
+        """移動を開始して完了まで待ち、MoveRecord を返す (pulses=None は原点復帰)"""
+        setup_response, go_response = self.execute(setup_command)
+        if setup_response != "OK":
+            raise StageError(f"コマンドが受理されませんでした。({setup_response})")
+        if go_response != "OK":
+            raise StageError(f"Gコマンドが受理されませんでした。({go_response})")
+        estimated = estimator.estimate(axis, pulses) if estimator else None
+        actual, polls, interval = wait_until_ready(self, axis, estimated, **wait_options)
+        record = MoveRecord(axis, setup_command, pulses, estimated, actual, polls, interval)
+        metrics.observe("stage_wait", actual, controller=self.controller, axis=axis)
+        if estimator:
+            estimator.record(record)
+        return record
+
+
+class Fc511Client(LineClient):
+    """FC-511 コントローラ用クライアント (CR 終端)
+
+    スキャン中は1本の接続を開いたまま使い、コマンドは待ち時間を挟まずに続けて送信する。
+    移動完了は !: (状態問い合わせ, "B": BUSY / "R": READY) のポーリングで確認する。
+    """
+
+    controller = "fc511"
+
+    def __init__(self, ip, port, timeout=10.0, terminator='\r'):
+        super().__init__(ip, port, timeout, terminator)
+
+    def execute(self, setup_command):
+        """セットアップコマンド (H:, M: など) と実行(G)コマンドを続けて送信し、両方の応答を確認する"""
+        with metrics.timer("stage_command", controller=self.controller):
+            responses = self.pipeline(setup_command, 'G')
+        for command, response in zip((setup_command, 'G'), responses):
+            if "OK" not in response:
+                raise StageError(f"{command} が受理されませんでした。({response})")
+
+    @staticmethod
+    def move_command(axis, pulses):
+        """相対移動のセットアップコマンド (例: M:1+P1000, M:2-P500)"""
+        return f"M:{axis}{'+' if pulses >= 0 else '-'}P{abs(pulses)}"
+
+    def is_ready(self):
+        with metrics.timer("stage_poll", controller=self.controller):
+            response = self.query('!:')
+        if response not in ("B", "R"):
+            raise StageError(f"不明なステータス応答です。({response})")
+        return response == "R"
+
+    def move(self, axis, setup_command, estimator=None, pulses=None, **wait_options):
+        """移動を開始して停止まで待ち、MoveRecord を返す (pulses=None は原点復帰)"""
+        self.execute(setup_command)
+        estimated = estimator.estimate(axis, pulses) if estimator else None
+        actual, polls, interval = poll_until_ready(self.is_ready, estimated, **wait_options)
+        record = MoveRecord(axis, setup_command, pulses, estimated, actual, polls, interval)
+        metrics.observe("stage_wait", actual, controller=self.controller, axis=axis)
+        if estimator:
+            estimator.record(record)
+        return record
+
+
+# --- 移動時間の予測と完了待ち ---
+
+class MotionEstimator:
+    """パルス数と速度/加速度設定から移動時間を予測する (台形速度プロファイル)
+
+    実測値を記録するたびに補正係数を更新し、予測を実機に合わせていく。
+    原点復帰 (パルス数不明) は軸ごとの前回実測値を予測値とする。
+    """
+
+    def __init__(self, speed=10000, accel=50000, settle=0.05, history=200):
+        self.speed = speed      # 最高速度 [pulse/s]
+        self.accel = accel      # 加減速度 [pulse/s^2]
+        self.settle = settle    # 停止判定までの固定時間 [s]
+        self.scale = 1.0
+        self.records = deque(maxlen=history)
+        self._homing = {}
+
+    def profile_time(self, pulses):
+        distance = abs(pulses)
+        ramp_distance = self.speed ** 2 / self.accel   # 加速 + 減速に必要な距離
+        if distance >= ramp_distance:
+            return distance / self.speed + self.speed / self.accel
+        return 2 * math.sqrt(distance / self.accel)
+
+    def estimate(self, axis, pulses=None):
+        """予測移動時間 [s] を返す。予測できない場合は None"""
+        if pulses is None:
+            return self._homing.get(axis)
+        return self.profile_time(pulses) * self.scale + self.settle
+
+    def record(self, record):
+        self.records.append(record)
+        if record.pulses is None:
+            self._homing[record.axis] = record.actual
+            return
+        base = self.profile_time(record.pulses)
+        if base > 0:
+            # 実測値は停止を確認したポーリングの時刻なので、実際の停止は最後に BUSY だったポーリングとの間にある。
+            # そのまま使うと補正係数が毎回最大 max_interval 分ずつ大きい側へずれるため、その区間の中点を使う
+            # (1回目で停止済みなら BUSY を見ていないので区間が分からず、実測値のまま)
+            actual = record.actual
+            if record.polls > 1:
+                actual -= record.poll_interval / 2
+            # 指数移動平均で補正係数を更新する
+            ratio = max(actual - self.settle, 0) / base
+            self.scale = 0.8 * self.scale + 0.2 * ratio
+
+
+def poll_until_ready(is_ready, estimate=None, min_interval=0.02, max_interval=0.5, timeout=120, margin=0.1):
+    """is_ready() が真になるまでポーリングし、(経過時間, ポーリング回数, 最終ポーリング間隔) を返す
+
+    予測移動時間がある場合はその少し前まで眠ってから、BUSYが続くたびに間隔を倍にして問い合わせる。
+    最終ポーリング間隔は最後に BUSY だったポーリングから停止を確認するまでの実測 (1回目で停止済みなら min_interval)。
+    """
+    start = time.monotonic()
+    if estimate:
+        time.sleep(max(estimate * (1 - margin) - min_interval, 0))
+    interval = min_interval
+    polls = 0
+    last_busy = None
+    while True:
+        polls += 1
+        ready = is_ready()
+        elapsed = time.monotonic() - start
+        if ready:
+            return elapsed, polls, elapsed - last_busy if last_busy is not None else min_interval
+        last_busy = elapsed
+        if elapsed > timeout:
+            raise StageError(f"動作完了の確認がタイムアウトしました。({timeout}秒)")
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def wait_until_ready(client, axis, estimate=None, **options):
+    """1軸の動作完了を待ち、(経過時間, ポーリング回数, 最終ポーリング間隔) を返す"""
+    return wait_until_ready_all(client, {axis: estimate}, **options)[axis]
+
+
+def wait_until_ready_all(client, estimates, min_interval=0.02, max_interval=0.5, timeout=120, margin=0.1):
+    """複数軸の動作完了を1本の接続・1つのループで待ち、軸ごとの (経過時間, ポーリング回数, 最終ポーリング間隔) を返す
+
+    estimates は {軸番号: 予測移動時間 (不明なら None)}。全軸の予測がある場合は、最も早く終わる軸の
+    終了予定の少し前 (予測の margin 割 + min_interval 分) まで眠る。その後は未完了の全軸の ?S を
+    まとめて送信してポーリングし、BUSYが続くたびに間隔を倍にする (max_interval まで)。
+    最終ポーリング間隔の意味は poll_until_ready と同じ。
+    """
+    start = time.monotonic()
+    pending = dict(estimates)
+    polls = {axis: 0 for axis in pending}
+    results = {}
+    interval = min_interval
+    last_busy = None  # 未完了の軸はすべて毎回問い合わせるため、前回のポーリング時刻は全軸共通
+    while pending:
+        if all(pending.values()):
+            wake = min(pending.values()) * (1 - margin) - min_interval
+            now = time.monotonic() - start
+            if wake > now:
+                time.sleep(wake - now)
+                interval = min_interval
+        axes = list(pending)
+        with metrics.timer("stage_poll", controller=client.controller):
+            responses = client.pipeline(*(f"?S:{axis}" for axis in axes))
+        elapsed = time.monotonic() - start
+        for axis, response in zip(axes, responses):
+            polls[axis] += 1
+            if response == "0":
+                results[axis] = (elapsed, polls[axis], elapsed - last_busy if last_busy is not None else min_interval)
+                del pending[axis]
+            elif response != "1":
+                raise StageError(f"軸{axis}: 不明なステータス応答です。({response})")
+        if not pending:
+            break
+        last_busy = elapsed
+        if elapsed > timeout:
+            raise StageError(f"動作完了の確認がタイムアウトしました。({timeout}秒, 未完了の軸: {list(pending)})")
+        if len(pending) < len(axes):
+            interval = min_interval  # 完了した軸があれば、残りの軸に向けて間隔を戻す
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return results
@@ -0,0 +1,47 @@
+import os
+import socket
+import threading
+
+from board_client import stream_write
+from capture import RECV, SEND, CapturedSocket, Recorder, read_capture
+
+
+def test_sendall_and_recv_are_recorded(tmp_path):
+    path = tmp_path / "test.jgcap"
+    recorder = Recorder(path)
+    a, b = socket.socketpair()
+    with a, b:
+        captured = CapturedSocket(a, recorder, 0)
+        captured.sendall(b"command")
+        b.sendall(b"status")
+        assert b.recv(16) == b"command"
+        assert captured.recv(16) == b"status"
+    recorder.close()
+    records = read_capture(path)[3]
+    assert [(r.event, bytes(r.data)) for r in records] == [(SEND, b"command"), (RECV, b"status")]
+
+
+def test_sendfile_records_sent_range(tmp_path):
+    data = os.urandom(300000)
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    path = tmp_path / "test.jgcap"
+    recorder = Recorder(path)
+    a, b = socket.socketpair()
+    received = bytearray()
+
+    def receive():
+        while len(received) < 200000:
+            received.extend(b.recv(65536))
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    with a, b, open(source, 'rb') as f:
+        f.seek(1000)
+        stream_write(CapturedSocket(a, recorder, 0), f, 200000, chunk_size=65536)
+        thread.join()
+        # 記録のための読み直しでファイル位置を変えない
+        assert f.tell() == 1000 + 200000
+    recorder.close()
+    sent = b"".join(bytes(r.data) for r in read_capture(path)[3] if r.event == SEND)
+    assert sent == data[1000:201000] == received
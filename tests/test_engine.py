@@ -0,0 +1,154 @@
+import random
+import socket
+import threading
+import zlib
+
+import pytest
+
+import mock_server
+from board_client import BoardConnectionPool
+from engine import chunked_write, plan_segments, segmented_read
+from mock_async import BoardMemory, BoardServerThread, get_pattern
+from protocol import MAX_24BIT
+
+MIB = 1024 * 1024
+
+
+def test_plan_segments_covers_data():
+    segments = plan_segments(10 * MIB + 5, 4 * MIB, offset=7)
+    assert segments == [(0, 7, 4 * MIB), (4 * MIB, 7 + 4 * MIB, 4 * MIB), (8 * MIB, 7 + 8 * MIB, 2 * MIB + 5)]
+    assert plan_segments(0, 4 * MIB) == []
+
+
+def test_plan_segments_offset_unit():
+    segments = plan_segments(64 * MIB, 4 * MIB, offset_unit=4)
+    assert len(segments) == 16
+    assert segments[-1] == (60 * MIB, 15 * MIB, 4 * MIB)
+
+
+def test_plan_segments_offset_field_overflow():
+    # オフセット単位1では 16MiB 以降のオフセットが24bitに収まらない
+    with pytest.raises(ValueError):
+        plan_segments(64 * MIB, 4 * MIB)
+    with pytest.raises(ValueError):
+        plan_segments(4 * MIB, 1 * MIB, offset=MAX_24BIT - 1 * MIB)
+    assert plan_segments(16 * MIB, 4 * MIB)[-1] == (12 * MIB, 12 * MIB, 4 * MIB)
+
+
+@pytest.mark.parametrize("segment_size, offset_unit", [(0, 1), (MAX_24BIT + 1, 1), (4 * MIB + 2, 4), (4 * MIB, 0)])
+def test_plan_segments_rejects_bad_segment_size(segment_size, offset_unit):
+    with pytest.raises(ValueError):
+        plan_segments(8 * MIB, segment_size, offset_unit=offset_unit)
+
+
+@pytest.fixture
+def board():
+    """書き込まれたデータを保持し、それ以外は ramp パターンを返す模擬基板 (mock_async.py) を起動する"""
+    servers = []
+
+    def start(**options):
+        server = BoardServerThread([0], host="127.0.0.1", quiet=True, **options)
+        servers.append(server)
+        mock = server.boards[0]
+        return ('127.0.0.1', mock.server.sockets[0].getsockname()[1]), mock
+
+    pool = BoardConnectionPool()
+    yield start, pool
+    pool.close_all()
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def server_board(monkeypatch):
+    """「手動コマンド」タブ用の模擬サーバー (mock_server.py) を空きポートで起動する"""
+    monkeypatch.setattr(mock_server, "MEMORY", BoardMemory(get_pattern("ramp")))
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def accept():
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=mock_server.handle_client, args=(conn, addr), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    pool = BoardConnectionPool()
+    yield listener.getsockname(), pool
+    pool.close_all()
+    listener.close()
+
+
+def ramp(size, start=0):
+    return bytes((start + i) % 256 for i in range(size))
+
+
+@pytest.mark.parametrize("offset, offset_unit", [(0, 1), (3, 4)])
+def test_chunked_write_verify_matches(board, offset, offset_unit):
+    start, pool = board
+    address, _ = start(offset_unit=offset_unit)
+    data = ramp(100000, offset * offset_unit)
+    result = chunked_write(address, 0x14, data, len(data), offset=offset, segment_size=4096,
+                           offset_unit=offset_unit, verify=True, pool=pool)
+    assert result.verified is True
+    assert result.crc == zlib.crc32(data)
+    assert result.written == len(data)
+    assert result.statuses == [0] * 25
+
+
+@pytest.mark.parametrize("offset, offset_unit", [(0, 1), (3, 4)])
+def test_chunked_write_verify_random_data(board, offset, offset_unit):
+    # 読み出しパターンと異なるデータでも、書き込んだデータが読み返される
+    start, pool = board
+    address, _ = start(offset_unit=offset_unit)
+    data = random.Random(1).randbytes(100000)
+    result = chunked_write(address, 0x14, data, len(data), offset=offset, segment_size=4096,
+                           offset_unit=offset_unit, verify=True, pool=pool)
+    assert result.verified is True
+    read = segmented_read(address, 0x14, len(data), offset, segment_size=16384, offset_unit=offset_unit, pool=pool)
+    assert bytes(read.data) == data
+
+
+def test_chunked_write_verify_random_data_mock_server(server_board):
+    address, pool = server_board
+    data = random.Random(2).randbytes(256 * 1024)
+    result = chunked_write(address, 1, data, len(data), segment_size=64 * 1024, verify=True, pool=pool)
+    assert result.verified is True
+    assert result.written == len(data)
+
+
+def test_chunked_write_verify_detects_mismatch(board):
+    start, pool = board
+    address, mock = start()
+    data = random.Random(3).randbytes(100000)
+    mock.memory.write(0x15, 0, data)  # 照合用の読み出しID (0x15) には正しいデータを置いておく
+    corrupted = bytearray(data)
+    corrupted[50000] ^= 0xFF
+    logs = []
+    result = chunked_write(address, 0x14, bytes(corrupted), len(data), segment_size=4096, verify=True, read_id=0x15,
+                           pool=pool, log=lambda level, message: logs.append((level, message)))
+    assert result.verified is False
+    assert result.crc == zlib.crc32(corrupted)
+    assert any(level == "error" and "(1/25)" in message and "オフセット 49152" in message for level, message in logs)
+
+
+def test_chunked_write_verify_after_resume(board):
+    start, pool = board
+    address, mock = start()
+    data = random.Random(4).randbytes(100000)
+    mock.memory.write(0x14, 0, data[:8192])  # 中断前に送信済みの範囲
+    result = chunked_write(address, 0x14, data, len(data), segment_size=4096, resume_from=8192, verify=True, pool=pool)
+    assert result.verified is True
+    assert result.crc == zlib.crc32(data)  # 送信済みの範囲も含めた CRC
+    assert len(result.statuses) == 23
+
+
+def test_chunked_write_stops_on_error_status(board):
+    start, pool = board
+    address, _ = start(status=1)
+    data = ramp(10000)
+    result = chunked_write(address, 0x14, data, len(data), segment_size=4096, verify=True, pool=pool)
+    assert result.statuses == [1]
+    assert result.written == 0
+    assert result.verified is None
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from payload_store import PayloadStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = PayloadStore(budget=1000, directory=tmp_path)
+    yield store
+    store.close()
+
+
+def test_put_and_view(store):
+    payload = store.put(b"abc" * 100, "data.bin")
+    assert payload.exists and payload.size == 300 and payload.name == "data.bin"
+    with payload.view() as view:
+        assert bytes(view) == b"abc" * 100
+    assert payload.read() == b"abc" * 100
+    assert store.total == 300
+
+
+def test_evicts_least_recently_used(store):
+    first, second, third = (store.put(bytes(400)) for _ in range(3))
+    assert not first.exists and not os.path.exists(first.path)
+    assert second.exists and third.exists
+    assert store.total == 800
+    assert store.evicted == 1
+
+
+def test_touch_updates_order(store):
+    first = store.put(bytes(400))
+    second = store.put(bytes(400))
+    with first.view():
+        pass
+    third = store.put(bytes(400))
+    assert first.exists and not second.exists and third.exists
+    assert [payload.id for payload in store.items()] == [first.id, third.id]
+
+
+def test_keeps_payload_larger_than_budget(store):
+    small = store.put(bytes(100))
+    large = store.put(bytes(1500))
+    assert large.exists and not small.exists
+    assert store.total == 1500
+
+
+def test_set_budget_evicts(store):
+    payloads = [store.put(bytes(300)) for _ in range(3)]
+    store.set_budget(500)
+    assert [payload.exists for payload in payloads] == [False, False, True]
+
+
+def test_writing_discards_file_on_error(store, tmp_path):
+    with pytest.raises(RuntimeError):
+        with store.writing(100) as (payload, out):
+            out[:4] = b"abcd"
+            raise RuntimeError("受信失敗")
+    assert not payload.exists and not os.path.exists(payload.path)
+    assert store.items() == []
+
+
+def test_writing_empty_payload(store):
+    with store.writing(0) as (payload, out):
+        assert len(out) == 0
+    with payload.view() as view:
+        assert bytes(view) == b""
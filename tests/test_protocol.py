@@ -0,0 +1,113 @@
+import socket
+import threading
+
+import pytest
+
+from protocol import (MAX_24BIT, OP_READ, OP_WRITE, FrameReader, create_command_packet, decode_header,
+                      decode_headers, decode_status, encode_header, encode_headers, encode_report,
+                      encode_reports, encode_status, encode_value_command)
+
+
+@pytest.mark.parametrize("offset, data_size", [(0, 0), (1, 4), (0x123456, 0xABCDEF), (MAX_24BIT, MAX_24BIT)])
+def test_header_round_trip(offset, data_size):
+    packet = encode_header(OP_READ, 0x54, offset, data_size)
+    assert len(packet) == 12
+    assert decode_header(packet) == (OP_READ, 0x54, offset, data_size)
+
+
+def test_header_layout():
+    # OP(1) 予約(1) ID(1) オフセット(3) データサイズ(3) 予約(3)
+    assert encode_header(OP_WRITE, 0x14, 0x010203, 0x040506) == bytes.fromhex("3b0014010203040506000000")
+
+
+@pytest.mark.parametrize("offset, data_size", [(-1, 0), (MAX_24BIT + 1, 0), (0, MAX_24BIT + 1)])
+def test_header_rejects_out_of_range(offset, data_size):
+    with pytest.raises(ValueError):
+        encode_header(OP_WRITE, 1, offset, data_size)
+    assert create_command_packet(OP_WRITE, 1, offset, data_size) is None
+
+
+def test_batch_encode_decode():
+    commands = [(OP_WRITE, 1, 0, 4), (OP_READ, 0x54, 100, 43400), (OP_READ, 0x54, MAX_24BIT, 1)]
+    assert decode_headers(encode_headers(commands)) == commands
+    assert encode_headers(commands[:1]) == encode_header(*commands[0])
+    assert encode_reports([(3, 0x08), (3, 0x10)]) == encode_report(3, 0x08) + encode_report(3, 0x10)
+
+
+def test_status_round_trip():
+    assert decode_status(encode_status(0xDEADBEEF)) == 0xDEADBEEF
+
+
+def feed(chunks):
+    """chunks を1つずつ送信し、送り終えたら閉じるソケットペアの受信側を返す"""
+    reader_sock, writer_sock = socket.socketpair()
+
+    def send():
+        with writer_sock:
+            for chunk in chunks:
+                writer_sock.sendall(chunk)
+
+    thread = threading.Thread(target=send, daemon=True)
+    thread.start()
+    return reader_sock, thread
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("piece", [1, 7, 64 * 1024])
+def test_frame_reader_round_trip(piece):
+    payload = bytes(range(256)) * 40
+    stream = (encode_report(3, 0x08, 0)
+              + encode_header(OP_WRITE, 0x14, 5, len(payload)) + payload + encode_status(0)
+              + encode_header(OP_READ, 0x54, 0, 43400) + encode_status(1)
+              + encode_report(3, 0x10, 2))
+    sock, thread = feed(split(stream, piece))
+    with sock:
+        frames = list(FrameReader(sock, recv_size=16).frames())
+    thread.join()
+
+    assert [(f.op_code, f.command_id, f.offset, f.data_size, f.status) for f in frames] == [
+        (OP_WRITE, 3, 0, 4, 0),
+        (OP_WRITE, 0x14, 5, len(payload), 0),
+        (OP_READ, 0x54, 0, 43400, 1),
+        (OP_WRITE, 3, 0, 4, 2),
+    ]
+    assert frames[0].data_value == 0x08
+    assert frames[1].data == payload and frames[1].data_value is None
+    assert frames[2].data == b''  # 読み出しコマンドはデータを伴わない
+    assert frames[3].data_value == 0x10
+
+
+def test_frame_reader_headers_without_status():
+    sock, thread = feed(split(encode_value_command(1, 0x2E) + encode_header(OP_READ, 0x54, 0, 8), 5))
+    with sock:
+        frames = list(FrameReader(sock).frames(with_status=False))
+    thread.join()
+    assert [(f.command_id, f.data_value, f.status) for f in frames] == [(1, 0x2E, None), (0x54, None, None)]
+
+
+def test_frame_reader_read_bulk_uses_buffered_data():
+    payload = bytes(range(256)) * 1024
+    sock, thread = feed(split(encode_header(OP_WRITE, 0x14, 0, len(payload)) + payload, 1000))
+    with sock:
+        reader = FrameReader(sock, recv_size=4096)
+        header = reader.read_header()
+        assert reader.read_bulk(header.data_size) == payload
+        assert reader.read_header() is None
+    thread.join()
+
+
+def test_frame_reader_disconnect_mid_frame():
+    sock, thread = feed([encode_report(3, 0x08)[:15]])
+    with sock:
+        with pytest.raises(ConnectionError):
+            FrameReader(sock).read_frame()
+    thread.join()
+
+    sock, thread = feed([encode_header(OP_READ, 0x54, 0, 8)[:5]])
+    with sock:
+        with pytest.raises(ConnectionError):
+            FrameReader(sock).read_header()
+    thread.join()
@@ -0,0 +1,138 @@
+import threading
+
+import pytest
+
+from protocol import OP_WRITE, BoardFrame, encode_status, encode_value_command
+from sequences import BoardSequence, DefinedSequence, InitSequence
+
+
+def report(command_id, value):
+    return BoardFrame(OP_WRITE, command_id, 0, 4, b'', value, 0)
+
+
+class FakeListener:
+    """共有リスナーの代わり (start(listener=...) では待ち受けを起動しない)"""
+    running = True
+
+
+class FakePool:
+    """基板への指令を記録し、ステータス 0 を返す"""
+
+    def __init__(self, on_request=None):
+        self.sent = []
+        self.on_request = on_request
+
+    def request(self, address, packet, payload=b'', status_size=4):
+        self.sent.append(packet)
+        if self.on_request:
+            self.on_request()
+        return encode_status(0)
+
+
+def drain(sequence):
+    events = []
+    while not sequence.events.empty():
+        events.append(sequence.events.get_nowait())
+    return events
+
+
+def logs(events, level=None):
+    return [value[2] for kind, value in events if kind == "log" and (level is None or value[1] == level)]
+
+
+@pytest.fixture
+def sequences():
+    started = []
+    yield started
+    for sequence in started:
+        sequence.stop()
+
+
+def start(sequences, sequence):
+    sequences.append(sequence)
+    sequence.start(listener=FakeListener())
+    return sequence
+
+
+def test_board_sequence_is_abstract():
+    with pytest.raises(TypeError):
+        BoardSequence(pool=FakePool())
+
+
+def test_init_sequence_transitions(sequences):
+    pool = FakePool()
+    sequence = start(sequences, InitSequence(pool=pool))
+    assert sequence.state == "待機中" and sequence.running
+
+    for value, state in [(0x00, "INITIALIZE"), (0x08, "STANDBY"), (0x2E, "RECONSTRUCT"), (0x10, "完了")]:
+        sequence._on_frame(report(3, value))
+        assert sequence.state == state
+    # STANDBY に入ったときだけ RECONSTRUCT 指令を送る
+    assert pool.sent == [encode_value_command(1, 0x2E)]
+    assert not sequence.running
+
+    events = drain(sequence)
+    assert [value for kind, value in events if kind == "phase"] == ["待機中", "INITIALIZE", "STANDBY", "RECONSTRUCT", "完了"]
+    assert logs(events, "success") == ["初期化シーケンスが完了しました。"]
+    assert logs(events, "error") == []
+
+
+def test_unexpected_report_is_ignored(sequences):
+    sequence = start(sequences, InitSequence(pool=FakePool()))
+    sequence._on_frame(report(3, 0x08))  # 待機中に INITIALIZE 完了の報告
+    sequence._on_frame(report(9, 0x00))
+    assert sequence.state == "待機中" and sequence.running
+    assert len(logs(drain(sequence), "warning")) == 2
+
+
+def test_report_before_start_is_ignored():
+    sequence = InitSequence(pool=FakePool())
+    sequence._on_frame(report(3, 0x00))
+    assert sequence.state is None and sequence.phase == "未開始"
+    events = drain(sequence)
+    assert logs(events, "error") == [] and len(logs(events, "warning")) == 1
+
+
+def test_report_during_start_waits_for_initial_state(sequences):
+    # 初期状態の enter (指令の送信) 中に基板の報告が届いても、初期状態に入ってから処理する
+    definition = {
+        "name": "テスト",
+        "initial": "開始",
+        "states": {
+            "開始": {"enter": [{"board": {"id": 1, "data": 1}}], "on": [{"report": {"id": 3, "data": 1}, "next": "完了"}]},
+            "完了": {"final": True},
+        },
+    }
+    threads = []
+
+    def deliver_report():
+        thread = threading.Thread(target=sequence._on_frame, args=(report(3, 1),))
+        thread.start()
+        thread.join(0.1)  # ロックで待たされる
+        threads.append(thread)
+
+    sequence = DefinedSequence(definition, pool=FakePool(on_request=deliver_report))
+    start(sequences, sequence)
+    threads[0].join(5)
+    assert sequence.state == "完了" and not sequence.running
+    assert logs(drain(sequence), "error") == []
+
+
+def test_chained_states_and_state_timeout(sequences):
+    definition = {
+        "name": "テスト",
+        "initial": "A",
+        "states": {
+            "A": {"enter": [{"log": "A ({value})"}], "next": "B"},
+            "B": {"timeout": 0.05, "on_timeout": "C", "on": [{"report": {"id": 3, "data": 2}, "next": "完了"}]},
+            "C": {"timeout": 0.05},
+            "完了": {"final": True},
+        },
+    }
+    sequence = start(sequences, DefinedSequence(definition, params={"value": 5}, pool=FakePool()))
+    assert sequence.state == "B"
+    assert sequence._finished.wait(5)
+    events = drain(sequence)
+    assert [value for kind, value in events if kind == "phase"] == ["A", "B", "C", "エラー"]
+    assert "A (5)" in logs(events)
+    assert len(logs(events, "error")) == 1
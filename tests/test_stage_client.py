@@ -0,0 +1,72 @@
+import pytest
+
+from stage_client import MotionEstimator, MoveRecord, poll_until_ready
+
+
+def record(estimator, axis, pulses, actual, polls=1, poll_interval=0.02):
+    estimator.record(MoveRecord(axis, "", pulses, estimator.estimate(axis, pulses), actual, polls, poll_interval))
+
+
+def test_profile_time_trapezoid_and_triangle():
+    estimator = MotionEstimator(speed=10000, accel=50000, settle=0.05)
+    # 加速 + 減速に 2000 パルス必要。それ以上は等速区間がある
+    assert estimator.profile_time(12000) == pytest.approx(1.2 + 0.2)
+    assert estimator.profile_time(2000) == pytest.approx(0.4)
+    assert estimator.profile_time(500) == pytest.approx(0.2)
+    assert estimator.profile_time(-12000) == estimator.profile_time(12000)
+    assert estimator.profile_time(0) == 0
+
+
+def test_estimate_adds_settle_time():
+    estimator = MotionEstimator(speed=10000, accel=50000, settle=0.05)
+    assert estimator.estimate(1, 12000) == pytest.approx(1.45)
+
+
+def test_homing_uses_last_actual_per_axis():
+    estimator = MotionEstimator()
+    assert estimator.estimate(1) is None
+    record(estimator, 1, None, 3.0)
+    record(estimator, 2, None, 5.0)
+    record(estimator, 1, None, 2.5)
+    assert estimator.estimate(1) == 2.5
+    assert estimator.estimate(2) == 5.0
+    assert estimator.scale == 1.0
+
+
+def test_record_corrects_scale():
+    estimator = MotionEstimator(speed=10000, accel=50000, settle=0.05)
+    # 実機が予測の2倍かかる場合、補正係数は 0.2 ずつ 2 に近づく
+    record(estimator, 1, 12000, 2 * 1.4 + 0.05)
+    assert estimator.scale == pytest.approx(1.2)
+    for _ in range(100):
+        record(estimator, 1, 12000, 2 * 1.4 + 0.05)
+    assert estimator.scale == pytest.approx(2.0, abs=1e-6)
+    assert estimator.estimate(1, 12000) == pytest.approx(2 * 1.4 + 0.05, abs=1e-5)
+
+
+def test_record_excludes_poll_interval():
+    estimator = MotionEstimator(speed=10000, accel=50000, settle=0.05)
+    # 予測どおりに停止しても、確認は最後に BUSY だったポーリングから最大 0.5秒 遅れる。
+    # 停止はその区間の中点とみなすため、補正係数は大きい側へずれない
+    for _ in range(20):
+        record(estimator, 1, 12000, 1.45 + 0.25, polls=4, poll_interval=0.5)
+    assert estimator.scale == pytest.approx(1.0)
+    # 1回目で停止済みなら区間が分からないため、実測値をそのまま使う
+    record(estimator, 1, 12000, 1.45, polls=1, poll_interval=0.02)
+    assert estimator.scale == pytest.approx(1.0)
+
+
+def test_poll_until_ready_reports_last_busy_gap():
+    answers = iter([False, False, True])
+    elapsed, polls, gap = poll_until_ready(lambda: next(answers), min_interval=0.01)
+    assert polls == 3
+    # 2回目 (BUSY) のあとの間隔は 0.02秒
+    assert 0.02 <= gap < elapsed < 0.2
+    assert poll_until_ready(lambda: True, min_interval=0.01)[1:] == (1, 0.01)
+
+
+def test_history_is_bounded():
+    estimator = MotionEstimator(history=3)
+    for pulses in range(1, 6):
+        record(estimator, 1, pulses * 1000, 1.0)
+    assert [r.pulses for r in estimator.records] == [3000, 4000, 5000]